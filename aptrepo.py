@@ -0,0 +1,243 @@
+import email.utils
+import fcntl
+import functools
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import subprocess
+import tarfile
+
+import dpkgstatus
+import util
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+supportedLayouts = ['flat', 'pool']
+defaultLayout = 'flat'
+defaultKeep = 3  # versions per package, 0 keeps all
+defaultDist = "stable"
+defaultComponent = "main"
+defaultArchitectures = ["amd64"]  # packages with Architecture: all are listed for these
+origin = "package-jetbrains-ide"
+stanzaFile = ".stanzas.json"  # cached control stanzas and hashes of all packages in the repository
+versionKey = functools.cmp_to_key(dpkgstatus.compare_versions)
+hashes = [["MD5Sum", "MD5sum", "md5"], ["SHA1", "SHA1", "sha1"], ["SHA256", "SHA256", "sha256"]]
+
+
+# Returns the content of the control file of a .deb without unpacking anything else
+def read_control(deb):
+    with open(deb, "rb") as file:
+        if file.read(8) != b"!<arch>\n":
+            raise ValueError("%s is not a debian package" % deb)
+        while True:
+            header = file.read(60)
+            if len(header) < 60:
+                raise ValueError("No control archive in %s" % deb)
+            name = header[0:16].decode('ascii').strip().rstrip("/")
+            size = int(header[48:58].decode('ascii').strip())
+            if not name.startswith("control.tar"):
+                file.seek(size + size % 2, os.SEEK_CUR)
+                continue
+            data = file.read(size)
+            break
+    if name.endswith(".xz"):
+        data = lzma.decompress(data)
+    elif name.endswith(".gz"):
+        data = gzip.decompress(data)
+    elif name.endswith(".zst"):
+        data = subprocess.run(["zstd", "-d", "-c", "-q"], input=data, stdout=subprocess.PIPE, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as tar:
+        for member in tar:
+            if member.name in ("./control", "control"):
+                return tar.extractfile(member).read().decode('utf-8')
+    raise ValueError("No control file in %s" % deb)
+
+
+# Returns a list of [field, value], value keeps its continuation lines
+def parse_control(text):
+    fields = []
+    for line in text.rstrip("\n").split("\n"):
+        if line[:1] in (" ", "\t") and len(fields) > 0:
+            fields[-1][1] += "\n" + line
+        elif ":" in line:
+            name, value = line.split(":", 1)
+            fields.append([name, value.strip()])
+    return fields
+
+
+def get_field(fields, name):
+    for field in fields:
+        if field[0] == name:
+            return field[1]
+    return None
+
+
+# Index entry of deb: control fields plus Filename, Size and hashes in front of Description
+def get_stanza(deb, filename):
+    fields = parse_control(read_control(deb))
+    hashers = [hashlib.new(algorithm) for _, _, algorithm in hashes]
+    with open(deb, "rb") as file:
+        for data in iter(lambda: file.read(1024 * 1024), b""):
+            for hasher in hashers:
+                hasher.update(data)
+    added = [["Filename", filename], ["Size", str(os.path.getsize(deb))]]
+    added += [[field, hasher.hexdigest()] for (_, field, _), hasher in zip(hashes, hashers)]
+    position = len(fields)
+    for index, field in enumerate(fields):
+        if field[0] == "Description":
+            position = index
+    fields[position:position] = added
+    return {"package": get_field(fields, "Package"), "version": get_field(fields, "Version"),
+            "architecture": get_field(fields, "Architecture"),
+            "stanza": "".join("%s: %s\n" % (name, value) for name, value in fields)}
+
+
+def get_pool_path(package):
+    prefix = package[:4] if package.startswith("lib") else package[:1]
+    return "/".join(["pool", defaultComponent, prefix, package])
+
+
+def load_stanzas(repo):
+    try:
+        with open(os.path.join(repo, stanzaFile), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_stanzas(repo, stanzas):
+    with open(os.path.join(repo, stanzaFile + ".tmp"), "w") as file:
+        json.dump(stanzas, file, sort_keys=True)
+    os.replace(os.path.join(repo, stanzaFile + ".tmp"), os.path.join(repo, stanzaFile))
+
+
+# All .deb files of the repository relative to repo, only directory entries are read
+def find_debs(repo, layout):
+    debs = []
+    if layout == 'flat':
+        return sorted(name for name in os.listdir(repo) if name.endswith(".deb"))
+    for dirpath, dirnames, filenames in os.walk(os.path.join(repo, "pool")):
+        for filename in filenames:
+            if filename.endswith(".deb"):
+                debs.append(os.path.relpath(os.path.join(dirpath, filename), repo))
+    return sorted(debs)
+
+
+# Brings the cached stanzas in line with the files: removed files are dropped, new or changed files are read
+def update_stanzas(repo, layout, stanzas, logger):
+    current = {}
+    for path in find_debs(repo, layout):
+        stat = os.stat(os.path.join(repo, path))
+        cached = stanzas.get(path)
+        if cached is not None and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime:
+            current[path] = cached
+            continue
+        try:
+            entry = get_stanza(os.path.join(repo, path), "./" + path if layout == 'flat' else path)
+        except (OSError, ValueError, tarfile.TarError, lzma.LZMAError, subprocess.CalledProcessError):
+            logger.warning("Could not read %s, it is not listed in the repository." % os.path.join(repo, path),
+                           exc_info=True)
+            continue
+        entry.update({"size": stat.st_size, "mtime": stat.st_mtime})
+        current[path] = entry
+    return current
+
+
+# Removes all but the keep newest versions of every package (and architecture)
+def prune(repo, stanzas, keep, logger):
+    if keep <= 0:
+        return stanzas
+    versions = {}
+    for path, entry in stanzas.items():
+        versions.setdefault((entry["package"], entry["architecture"]), []).append(path)
+    for paths in versions.values():
+        paths.sort(key=lambda path: versionKey(stanzas[path]["version"]), reverse=True)
+        for path in paths[keep:]:
+            if util.delete_file(os.path.join(repo, path), logger, False):
+                logger.info("Removed %s from the repository." % path)
+                del stanzas[path]
+    return stanzas
+
+
+def write_file(path, data):
+    with open(path + ".tmp", "wb") as file:
+        file.write(data)
+    os.replace(path + ".tmp", path)
+
+
+# Writes Packages, Packages.gz and Packages.xz to folder, returns {name relative to base: data}
+def write_packages(folder, base, stanzas):
+    packages = "\n".join(stanzas).encode('utf-8')
+    files = {"Packages": packages,
+             "Packages.gz": gzip.compress(packages, 9, mtime=0),
+             "Packages.xz": lzma.compress(packages)}
+    os.makedirs(folder, exist_ok=True)
+    result = {}
+    for name, data in files.items():
+        write_file(os.path.join(folder, name), data)
+        result[os.path.relpath(os.path.join(folder, name), base)] = data
+    return result
+
+
+def write_release(folder, files, fields):
+    lines = ["%s: %s" % (name, value) for name, value in fields]
+    lines.append("Date: %s" % email.utils.formatdate(usegmt=True))
+    for section, _, algorithm in hashes:
+        lines.append("%s:" % section)
+        for name in sorted(files.keys()):
+            lines.append(" %s %16d %s" % (hashlib.new(algorithm, files[name]).hexdigest(), len(files[name]), name))
+    write_file(os.path.join(folder, "Release"), ("\n".join(lines) + "\n").encode('utf-8'))
+
+
+def write_indices(repo, layout, stanzas):
+    entries = sorted(stanzas.values(), key=lambda entry: (entry["package"], versionKey(entry["version"])))
+    if layout == 'flat':
+        files = write_packages(repo, repo, [entry["stanza"] for entry in entries])
+        write_release(repo, files, [["Origin", origin], ["Label", origin]])
+        return
+    architectures = sorted(set(defaultArchitectures + [entry["architecture"] for entry in entries
+                                                       if entry["architecture"] != "all"]))
+    distDir = os.path.join(repo, "dists", defaultDist)
+    files = {}
+    for architecture in architectures:
+        files.update(write_packages(os.path.join(distDir, defaultComponent, "binary-%s" % architecture), distDir,
+                                    [entry["stanza"] for entry in entries
+                                     if entry["architecture"] in (architecture, "all")]))
+    write_release(distDir, files, [["Origin", origin], ["Label", origin], ["Suite", defaultDist],
+                                   ["Codename", defaultDist], ["Architectures", " ".join(architectures)],
+                                   ["Components", defaultComponent]])
+
+
+# Copies deb into the repository and updates its indices. Only deb itself is read, all other packages are
+# known from the cached stanzas. Returns the path of the published package or None.
+def publish(repo, deb, logger, layout=defaultLayout, keep=defaultKeep):
+    if not util.check_folder(repo, logger, False, True):
+        if not util.create_folder(repo):
+            logger.error("%s does not exist and can not be created." % repo)
+            return None
+    try:
+        with open(os.path.join(repo, ".lock"), "w") as lock:
+            # several builds of a batch may publish to the same repository
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            fields = parse_control(read_control(deb))
+            folder = repo
+            if layout == 'pool':
+                folder = os.path.join(repo, get_pool_path(get_field(fields, "Package")))
+                os.makedirs(folder, exist_ok=True)
+            dest = os.path.join(folder, os.path.basename(deb))
+            if not util.copy_file(deb, dest + ".tmp", logger, True):
+                return None
+            os.replace(dest + ".tmp", dest)
+
+            stanzas = update_stanzas(repo, layout, load_stanzas(repo), logger)
+            stanzas = prune(repo, stanzas, keep, logger)
+            write_indices(repo, layout, stanzas)
+            save_stanzas(repo, stanzas)
+    except (OSError, ValueError, tarfile.TarError, lzma.LZMAError, subprocess.CalledProcessError):
+        logger.error("Error while publishing '%s' to '%s'." % (deb, repo), exc_info=True)
+        return None
+    return dest
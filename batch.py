@@ -0,0 +1,91 @@
+import concurrent.futures
+import time
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+defaultJobs = 2
+
+
+# Reads a matrix file, one job per line: "<ide> <edition> [y|n]", '#' starts a comment
+def parse_matrix(path, supported_ides, supported_editions, logger):
+    jobs = []
+    try:
+        file = open(path, "r")
+    except OSError:
+        logger.error("%s does not exist or is not readable." % path)
+        return None
+    with file:
+        for number, line in enumerate(file, 1):
+            fields = line.split("#")[0].split()
+            if len(fields) == 0:
+                continue
+            if len(fields) not in (2, 3) or fields[0] not in supported_ides or fields[1] not in supported_editions \
+                    or (len(fields) == 3 and fields[2] not in ('y', 'n')):
+                logger.error("Invalid job in %s line %d: '%s'." % (path, number, line.strip()))
+                return None
+            jobs.append((fields[0], fields[1], fields[2] if len(fields) == 3 else 'y'))
+    return jobs
+
+
+def get_jobs(ides, editions, java):
+    jobs = []
+    for ide in ides:
+        for edition in editions:
+            if (ide, edition, java) not in jobs:
+                jobs.append((ide, edition, java))
+    return jobs
+
+
+def get_result(job, package, message, duration):
+    ide, edition, java = job
+    return {"ide": ide, "edition": edition, "java": java, "returncode": 0 if package is not None else -1,
+            "status": "OK" if package is not None else "FAILED", "package": package, "message": message,
+            "duration": duration}
+
+
+# Runs build(ide, edition, java) for one job, it returns the path of the package or raises an exception
+def run_job(job, build):
+    ide, edition, java = job
+    start = time.monotonic()
+    package = None
+    try:
+        package = build(ide, edition, java)
+        message = ""
+    except Exception as error:
+        message = str(error) or error.__class__.__name__
+    return get_result(job, package, message, time.monotonic() - start)
+
+
+# Runs every job in a process of a pool, at most concurrency at the same time. Unpacking and writing the
+# package is mostly Python code, builds in threads of one process would wait for each other.
+# build has to be picklable (a function of a module or a functools.partial of one), the processes share nothing
+# but the caches on disk (e.g. the release metadata).
+def run_batch(jobs, build, concurrency):
+    results = []
+    start = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = dict((executor.submit(run_job, job, build), job) for job in jobs)
+        for future in concurrent.futures.as_completed(futures.keys()):
+            try:
+                results.append(future.result())
+            except concurrent.futures.process.BrokenProcessPool:
+                results.append(get_result(futures[future], None, "build process died",
+                                          time.monotonic() - start))
+    return sorted(results, key=lambda result: jobs.index((result["ide"], result["edition"], result["java"])))
+
+
+def print_summary(results):
+    print("%-10s %-13s %-5s %-8s %8s  %s" % ("IDE", "EDITION", "JAVA", "STATUS", "TIME", "RESULT"))
+    for result in results:
+        print("%-10s %-13s %-5s %-8s %7.1fs  %s" % (result["ide"], result["edition"], result["java"], result["status"],
+                                                     result["duration"],
+                                                     result["package"] if result["package"] is not None
+                                                     else result["message"]))
+
+
+# 0 if all jobs succeeded, -1 if one failed
+def get_returncode(results):
+    if any(result["status"] == "FAILED" for result in results):
+        return -1
+    return 0
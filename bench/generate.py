@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import gzip
+import hashlib
+import io
+import math
+import os
+import random
+import sys
+import tarfile
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+# Names like JetBrains uses them in build.txt, for the archive and for its top level folder
+buildPrefixes = {"pycharm": {"community": "pycharm-community", "professional": "pycharm"},
+                 "idea": {"community": "ideaIC", "professional": "ideaIU"}}
+archivePrefixes = {"pycharm": {"community": "pycharm-community", "professional": "pycharm-professional"},
+                   "idea": {"community": "ideaIC", "professional": "ideaIU"}}
+topFolders = {"pycharm": {"community": "pycharm-community-%s", "professional": "pycharm-%s"},
+              "idea": {"community": "idea-IC-%s", "professional": "idea-IU-%s"}}
+mtime = 1600000000
+
+
+def get_archive_name(ide, edition, version):
+    return "%s-%s.tar.gz" % (archivePrefixes[ide][edition], version)
+
+
+# Lognormal file sizes with the given median, limited to [min_size, max_size]
+def get_size(rand, median, sigma, min_size, max_size):
+    return int(min(max_size, max(min_size, rand.lognormvariate(math.log(median), sigma))))
+
+
+# Random data where compressible is the share of bytes that compress well (text like) and the rest does not
+def get_data(rand, size, compressible):
+    words = [b"public ", b"class ", b"static ", b"void ", b"import ", b"return ", b"final ", b"\n"]
+    text = int(size * compressible)
+    return b"".join(rand.choices(words, k=text // 5 + 1))[:text] + rand.randbytes(size - text)
+
+
+def add(tar, name, data=None, mode=0o644, type=tarfile.REGTYPE, linkname=""):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.mode = mode
+    info.mtime = mtime
+    info.linkname = linkname
+    if data is not None:
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    else:
+        tar.addfile(info)
+
+
+# Writes a JetBrains-shaped archive: bin/ with start script and vmoptions, lib/ with jars and plugins/<n>/lib/.
+# The same arguments (and seed) always give the same archive.
+def generate(path, ide, edition, version, files, median, sigma, min_size, max_size, compressible, plugins, seed,
+             level=6):
+    rand = random.Random(seed)
+    top = topFolders[ide][edition] % version
+    # gzip without name and with a fixed time, otherwise the checksum changes with every run
+    with open(path, "wb") as file, \
+            gzip.GzipFile(filename="", fileobj=file, mode="wb", compresslevel=level, mtime=mtime) as compressed, \
+            tarfile.open(fileobj=compressed, mode="w", format=tarfile.GNU_FORMAT) as tar:
+        for folder in ["", "bin", "lib", "plugins", "jbr", "jbr/bin"]:
+            add(tar, "/".join([top, folder]).rstrip("/"), mode=0o755, type=tarfile.DIRTYPE)
+        add(tar, "%s/bin/%s.sh" % (top, ide), b"#!/bin/sh\nexec java -jar \"$0\"/../lib/app.jar \"$@\"\n", 0o755)
+        add(tar, "%s/bin/%s64.vmoptions" % (top, ide), b"-Xms128m\n-Xmx750m\n")
+        add(tar, "%s/bin/%s.vmoptions" % (top, ide),
+            b"-Xms128m\n-Xmx750m\n-XX:ReservedCodeCacheSize=240m\n-agentlib:yjpagent=probe_disable=*\n")
+        add(tar, "%s/bin/libyjpagent-linux64.so" % top, get_data(rand, 65536, 0.0), 0o755)
+        add(tar, "%s/jbr/bin/java" % top, get_data(rand, 16384, 0.0), 0o755)
+        add(tar, "%s/build.txt" % top, ("%s-%s\n" % (buildPrefixes[ide][edition], version)).encode())
+        for number in range(plugins):
+            add(tar, "%s/plugins/plugin%d" % (top, number), mode=0o755, type=tarfile.DIRTYPE)
+            add(tar, "%s/plugins/plugin%d/lib" % (top, number), mode=0o755, type=tarfile.DIRTYPE)
+        for number in range(files):
+            if plugins > 0 and number % 2 == 1:
+                name = "%s/plugins/plugin%d/lib/file%d.jar" % (top, rand.randrange(plugins), number)
+            else:
+                name = "%s/lib/file%d.jar" % (top, number)
+            add(tar, name, get_data(rand, get_size(rand, median, sigma, min_size, max_size), compressible))
+        add(tar, "%s/bin/%s" % (top, ide), type=tarfile.SYMTYPE, linkname="%s.sh" % ide)
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="generate.py",
+                                     description="Generates a synthetic JetBrains IDE archive for benchmarks.")
+    parser.add_argument("-i", "--ide", default="pycharm", choices=list(buildPrefixes.keys()))
+    parser.add_argument("-e", "--edition", default="community", choices=["community", "professional"])
+    parser.add_argument("--version", dest="ideVersion", metavar="VERSION", default="2099.1.0",
+                        help="version in the archive name (default: %(default)s)")
+    parser.add_argument("--files", metavar="N", type=int, default=20000,
+                        help="number of files below lib/ and plugins/ (default: %(default)s)")
+    parser.add_argument("--median-size", metavar="BYTES", type=int, default=8192,
+                        help="median file size, sizes are lognormal distributed (default: %(default)s)")
+    parser.add_argument("--sigma", type=float, default=1.5,
+                        help="sigma of the lognormal size distribution (default: %(default)s)")
+    parser.add_argument("--min-size", metavar="BYTES", type=int, default=0, help="(default: %(default)s)")
+    parser.add_argument("--max-size", metavar="BYTES", type=int, default=64 * 1024 * 1024,
+                        help="(default: %(default)s)")
+    parser.add_argument("--compressible", metavar="SHARE", type=float, default=0.3,
+                        help="share of every file that compresses well (default: %(default)s)")
+    parser.add_argument("--plugins", metavar="N", type=int, default=200,
+                        help="number of plugin folders, half of the files go there (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="(default: %(default)s)")
+    parser.add_argument("-o", "--output", metavar="DIR", default=".",
+                        help="folder the archive is written to (default: %(default)s)")
+    args = parser.parse_args()
+
+    archive = os.path.join(args.output, get_archive_name(args.ide, args.edition, args.ideVersion))
+    checksum = generate(archive, args.ide, args.edition, args.ideVersion, args.files, args.median_size, args.sigma,
+                        args.min_size, args.max_size, args.compressible, args.plugins, args.seed)
+    print("%s  %s" % (checksum, archive))
+    sys.exit(0)
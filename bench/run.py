@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import generate
+import server
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+benchPath = os.path.dirname(os.path.realpath(__file__))
+packagePath = os.path.dirname(benchPath)
+
+
+def get_commit():
+    try:
+        output = subprocess.run(["git", "-C", packagePath, "describe", "--always", "--dirty"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    except OSError:
+        return None
+    return output.decode('utf-8', 'replace').strip() or None
+
+
+# Generates the archive unless an archive with the same parameters exists already
+def prepare_archive(folder, ide, edition, params):
+    name = generate.get_archive_name(ide, edition, params["version"])
+    paramsFile = os.path.join(folder, name + ".json")
+    try:
+        with open(paramsFile, "r") as file:
+            if json.load(file) == params and os.path.isfile(os.path.join(folder, name)):
+                return name
+    except (OSError, ValueError):
+        pass
+    print("Generating %s..." % name)
+    os.makedirs(folder, exist_ok=True)
+    generate.generate(os.path.join(folder, name), ide, edition, params["version"], params["files"],
+                      params["median"], params["sigma"], params["min"], params["max"], params["compressible"],
+                      params["plugins"], params["seed"])
+    with open(paramsFile, "w") as file:
+        json.dump(params, file)
+    return name
+
+
+# Runs package.py once, returns its metrics records
+def run_once(ide, edition, url, cache_dir, argv):
+    fd, metricsFile = tempfile.mkstemp(prefix="bench-", suffix=".json")
+    os.close(fd)
+    cmd = [sys.executable, os.path.join(packagePath, "package.py"), "-i", ide, "-e", edition,
+           "--releases-url", url, "--cache-dir", cache_dir, "--metrics-json", metricsFile] + argv
+    try:
+        process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            print("'%s' failed with %d:\n%s" % (" ".join(cmd), process.returncode,
+                                                 process.stderr.decode('utf-8', 'replace')))
+            return None
+        with open(metricsFile, "r") as file:
+            return [json.loads(line) for line in file if line.strip() != ""]
+    finally:
+        if os.path.exists(metricsFile):
+            os.unlink(metricsFile)
+
+
+# {phase: {"median": s, "min": s, "max": s}} over all runs, "total" included
+def summarize(runs):
+    seconds = {}
+    for records in runs:
+        for record in records:
+            seconds.setdefault(record["phase"], []).append(record["seconds"])
+    summary = {}
+    for phase, values in seconds.items():
+        summary[phase] = {"median": statistics.median(values), "min": min(values), "max": max(values),
+                          "runs": len(values)}
+    totals = [records[-1] for records in runs]
+    summary["total"]["peak_disk_bytes"] = statistics.median(record["peak_disk_bytes"] or 0 for record in totals)
+    summary["total"]["package_bytes"] = statistics.median(record.get("package_bytes", 0) for record in totals)
+    return summary
+
+
+def print_summary(summary, other=None):
+    print("%-20s %10s %10s %10s %10s %8s" % ("PHASE", "MEDIAN", "MIN", "MAX", "BEFORE", "CHANGE"))
+    phases = sorted(summary.keys(), key=lambda phase: phase == "total")
+    for phase in phases:
+        line = "%-20s %9.3fs %9.3fs %9.3fs" % (phase, summary[phase]["median"], summary[phase]["min"],
+                                                 summary[phase]["max"])
+        if other is not None and phase in other.keys() and other[phase]["median"] > 0:
+            line += " %9.3fs %+7.1f%%" % (other[phase]["median"],
+                                          (summary[phase]["median"] / other[phase]["median"] - 1) * 100)
+        print(line)
+    print("peak disk usage (filesystem) %d bytes, package %d bytes" % (summary["total"]["peak_disk_bytes"],
+                                                                       summary["total"]["package_bytes"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="run.py", description="Runs package.py against a local server with a "
+                                                                "synthetic archive and stores the phase timings. "
+                                                                "Arguments after -- are passed to package.py.")
+    parser.add_argument("-i", "--ide", default="pycharm", choices=list(generate.archivePrefixes.keys()))
+    parser.add_argument("-e", "--edition", default="community", choices=["community", "professional"])
+    parser.add_argument("-n", "--runs", metavar="N", type=int, default=3, help="(default: %(default)s)")
+    parser.add_argument("--warm", action='store_true',
+                        help="keep the cache between runs, an untimed first run fills it")
+    parser.add_argument("--name", default="bench", help="name of the results file (default: %(default)s)")
+    parser.add_argument("--results", metavar="DIR", default=os.path.join(benchPath, "results"),
+                        help="where results are stored (default: %(default)s)")
+    parser.add_argument("--compare", metavar="FILE", help="results file of an earlier run to compare with")
+    parser.add_argument("--archives", metavar="DIR", default=os.path.join(benchPath, "archives"),
+                        help="where generated archives are kept (default: %(default)s)")
+    parser.add_argument("--files", metavar="N", type=int, default=20000, help="(default: %(default)s)")
+    parser.add_argument("--median-size", metavar="BYTES", type=int, default=8192, help="(default: %(default)s)")
+    parser.add_argument("--sigma", type=float, default=1.5, help="(default: %(default)s)")
+    parser.add_argument("--compressible", metavar="SHARE", type=float, default=0.3, help="(default: %(default)s)")
+    parser.add_argument("--plugins", metavar="N", type=int, default=200, help="(default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="(default: %(default)s)")
+    parser.add_argument("--bandwidth", metavar="BYTES", type=int, default=0,
+                        help="bytes per second and connection the server sends, 0 is unlimited "
+                             "(default: %(default)s)")
+    parser.add_argument("--latency", metavar="SECONDS", type=float, default=0.0, help="(default: %(default)s)")
+    parser.add_argument("argv", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    argv = args.argv[1:] if args.argv[:1] == ["--"] else args.argv
+
+    params = {"version": "2099.1.0", "files": args.files, "median": args.median_size, "sigma": args.sigma,
+              "min": 0, "max": 64 * 1024 * 1024, "compressible": args.compressible, "plugins": args.plugins,
+              "seed": args.seed}
+    prepare_archive(args.archives, args.ide, args.edition, params)
+
+    httpd = server.serve(args.archives, 0, args.bandwidth, args.latency)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = "http://%s:%d/products/releases?code=%%s&latest=true&type=release" % httpd.server_address[:2]
+
+    cacheDir = tempfile.mkdtemp(prefix="bench-cache-")
+    runs = []
+    try:
+        if args.warm and run_once(args.ide, args.edition, url, cacheDir, argv) is None:
+            sys.exit(-1)
+        for number in range(args.runs):
+            if not args.warm:
+                shutil.rmtree(cacheDir, ignore_errors=True)
+            records = run_once(args.ide, args.edition, url, cacheDir, argv)
+            if records is None:
+                sys.exit(-1)
+            print("Run %d: %.3fs" % (number + 1, records[-1]["seconds"]))
+            runs.append(records)
+    finally:
+        httpd.shutdown()
+        shutil.rmtree(cacheDir, ignore_errors=True)
+
+    summary = summarize(runs)
+    other = None
+    if args.compare is not None:
+        with open(args.compare, "r") as file:
+            other = json.load(file)["summary"]
+    print_summary(summary, other)
+
+    os.makedirs(args.results, exist_ok=True)
+    resultFile = os.path.join(args.results, "%s-%s.json" % (args.name, time.strftime("%Y%m%d-%H%M%S")))
+    with open(resultFile, "w") as file:
+        json.dump({"name": args.name, "time": time.time(), "commit": get_commit(), "host": platform.node(),
+                   "cpus": os.cpu_count(), "python": platform.python_version(), "ide": args.ide,
+                   "edition": args.edition, "warm": args.warm, "argv": argv, "archive": params,
+                   "runs": runs, "summary": summary}, file, indent=1, sort_keys=True)
+    print("Results written to %s." % resultFile)
+    sys.exit(0)
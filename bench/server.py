@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import email.utils
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import re
+import sys
+import time
+import urllib.parse
+
+import generate
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+# Product codes of the releases endpoint, same as in package.py
+codes = {"PCC": ["pycharm", "community"], "PCP": ["pycharm", "professional"],
+         "IIC": ["idea", "community"], "IIU": ["idea", "professional"]}
+
+
+def get_version_key(version):
+    return [int(part) if part.isdigit() else part for part in re.split(r"[.-]", version)]
+
+
+# Returns (archive name, version) of the newest archive for code in folder, None if there is none
+def find_archive(folder, code):
+    ide, edition = codes[code]
+    prefix = generate.archivePrefixes[ide][edition] + "-"
+    found = []
+    for name in os.listdir(folder):
+        if name.startswith(prefix) and name.endswith(".tar.gz"):
+            version = name[len(prefix):-len(".tar.gz")]
+            if re.match(r"^[0-9]+(\.[0-9]+)*$", version):
+                found.append((get_version_key(version), name, version))
+    if len(found) == 0:
+        return None
+    found.sort()
+    return found[-1][1], found[-1][2]
+
+
+def get_checksum(path, checksums):
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in checksums.keys():
+        hasher = hashlib.sha256()
+        with open(path, "rb") as file:
+            for data in iter(lambda: file.read(1024 * 1024), b""):
+                hasher.update(data)
+        checksums[key] = hasher.hexdigest()
+    return checksums[key]
+
+
+# Answers like data.services.jetbrains.com (releases) and download.jetbrains.com (archives, checksums)
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    folder = "."
+    bandwidth = 0
+    latency = 0.0
+    checksums = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.answer(False)
+
+    def do_GET(self):
+        self.answer(True)
+
+    def get_base(self):
+        return "http://%s" % self.headers.get("Host", "%s:%d" % self.server.server_address[:2])
+
+    def send(self, status, headers, body, send_body):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def answer(self, send_body):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path == "/products/releases":
+            self.answer_releases(urllib.parse.parse_qs(parts.query), send_body)
+            return
+        name = os.path.basename(urllib.parse.unquote(parts.path))
+        if name.endswith(".sha256") and os.path.isfile(os.path.join(self.folder, name[:-len(".sha256")])):
+            archive = name[:-len(".sha256")]
+            body = ("%s *%s\n" % (get_checksum(os.path.join(self.folder, archive), self.checksums), archive))
+            self.send(200, {"Content-Type": "text/plain"}, body.encode(), send_body)
+        elif name.endswith(".tar.gz") and os.path.isfile(os.path.join(self.folder, name)):
+            self.answer_file(os.path.join(self.folder, name), send_body)
+        else:
+            self.send(404, {"Content-Type": "text/plain"}, b"not found\n", send_body)
+
+    def answer_releases(self, query, send_body):
+        result = {}
+        modified = 0
+        for code in ",".join(query.get("code", [])).split(","):
+            if code not in codes.keys():
+                continue
+            found = find_archive(self.folder, code)
+            if found is None:
+                result[code] = []
+                continue
+            name, version = found
+            path = os.path.join(self.folder, name)
+            modified = max(modified, os.path.getmtime(path))
+            download = {"link": "%s/%s" % (self.get_base(), name), "size": os.path.getsize(path),
+                        "checksumLink": "%s/%s.sha256" % (self.get_base(), name)}
+            result[code] = [{"date": time.strftime("%Y-%m-%d", time.gmtime(os.path.getmtime(path))),
+                             "type": "release", "version": version,
+                             "downloads": {"linux": download, "linuxWithoutJDK": download}}]
+        body = json.dumps(result, sort_keys=True).encode()
+        headers = {"Content-Type": "application/json", "ETag": '"%s"' % hashlib.sha1(body).hexdigest(),
+                   "Last-Modified": email.utils.formatdate(modified, usegmt=True)}
+        if self.headers.get("If-None-Match") == headers["ETag"]:
+            self.send(304, headers, b"", False)
+            return
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        self.send(200, headers, body, send_body)
+
+    def answer_file(self, path, send_body):
+        size = os.path.getsize(path)
+        start = 0
+        end = size - 1
+        status = 200
+        headers = {"Content-Type": "application/x-gzip", "Accept-Ranges": "bytes"}
+        match = re.match(r"^bytes=([0-9]*)-([0-9]*)$", self.headers.get("Range", ""))
+        if match is not None and match.group(1) != "":
+            start = int(match.group(1))
+            if match.group(2) != "":
+                end = min(end, int(match.group(2)))
+            if start > end:
+                headers["Content-Range"] = "bytes */%d" % size
+                self.send(416, headers, b"", send_body)
+                return
+            status = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if not send_body:
+            return
+        started = time.monotonic()
+        sent = 0
+        with open(path, "rb") as file:
+            file.seek(start)
+            while sent < end - start + 1:
+                data = file.read(min(256 * 1024, end - start + 1 - sent))
+                if not data:
+                    break
+                self.wfile.write(data)
+                sent += len(data)
+                if self.bandwidth > 0:
+                    # bandwidth is per connection like a download mirror limits it
+                    delay = float(sent) / self.bandwidth - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+
+
+def serve(folder, port, bandwidth=0, latency=0.0, host="127.0.0.1"):
+    handler = type("BenchHandler", (Handler,), {"folder": folder, "bandwidth": bandwidth, "latency": latency,
+                                                "checksums": {}})
+    return http.server.ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="server.py",
+                                     description="Serves the releases endpoint and archives out of a folder, "
+                                                 "the newest archive of every product is the latest release.")
+    parser.add_argument("-d", "--dir", metavar="DIR", default=".",
+                        help="folder with archives written by generate.py (default: %(default)s)")
+    parser.add_argument("-p", "--port", metavar="PORT", type=int, default=8765,
+                        help="0 picks a free port (default: %(default)s)")
+    parser.add_argument("--bandwidth", metavar="BYTES", type=int, default=0,
+                        help="bytes per second and connection for downloads, 0 is unlimited (default: %(default)s)")
+    parser.add_argument("--latency", metavar="SECONDS", type=float, default=0.0,
+                        help="delay before every answer (default: %(default)s)")
+    args = parser.parse_args()
+
+    server = serve(args.dir, args.port, args.bandwidth, args.latency)
+    print("Serving %s on http://%s:%d/products/releases?code=%%s&latest=true&type=release" %
+          (args.dir, server.server_address[0], server.server_address[1]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
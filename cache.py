@@ -0,0 +1,361 @@
+import concurrent.futures
+import fcntl
+import hashlib
+import http.client
+import json
+import os
+import re
+import shutil
+import sys
+import time
+import urllib.request
+from urllib.error import URLError
+
+import download as downloader
+import extract
+import util
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+defaultCacheSize = 8192  # MiB
+hashThreads = 8
+
+
+def get_default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "package-jetbrains-ide")
+
+
+def get_archive_dir(cache_dir):
+    return os.path.join(cache_dir, "archives")
+
+
+def get_tree_dir(cache_dir):
+    return os.path.join(cache_dir, "trees")
+
+
+# Name of the cached tree of the archive checksum, variant tells apart trees that were unpacked differently
+# (e.g. with a pruning profile)
+def get_tree_key(checksum, variant=None):
+    if variant is None:
+        return checksum
+    return "%s-%s" % (checksum, variant)
+
+
+# Reads the sha256 out of a checksumLink file ("<sha256> *<filename>")
+def fetch_checksum(checksum_link, logger):
+    try:
+        response = urllib.request.urlopen(checksum_link, timeout=10)
+        content = response.read().decode('utf-8')
+    except (URLError, UnicodeDecodeError):
+        logger.error("Error while retrieving %s. Error was '%s'." % (checksum_link, sys.exc_info()[0]))
+        return None
+    match = re.match(r"\s*([0-9a-fA-F]{64})\b", content)
+    if match is None:
+        logger.error("Could not parse sha256 out of '%s'." % checksum_link)
+        return None
+    return match.group(1).lower()
+
+
+# Returns the path of the cached archive and marks it as recently used
+def lookup(cache_dir, checksum):
+    path = os.path.join(get_archive_dir(cache_dir), checksum)
+    if not util.check_file_exists(path):
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return path
+
+
+# Hashes everything that is read through it and writes a copy to copyfile
+class CachingReader(object):
+    def __init__(self, fileobj, copyfile):
+        self.fileobj = fileobj
+        self.copyfile = copyfile
+        self.hasher = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data:
+            self.hasher.update(data)
+            self.copyfile.write(data)
+        return data
+
+    def drain(self, blocksize=1024 * 1024):
+        while self.read(blocksize):
+            pass
+
+
+def open_download(link, logger, hook=None):
+    try:
+        response = urllib.request.urlopen(link, timeout=30)
+    except URLError:
+        logger.error("Error while opening %s. Error was '%s'." % (link, sys.exc_info()[0]))
+        return None
+    totalsize = int(response.headers.get("Content-Length", "-1"))
+    if response.status != 200 or 0 <= totalsize < 100000:
+        logger.error("Error while downloading '%s': status %s, size %s." % (link, response.status, totalsize))
+        response.close()
+        return None
+    return response, extract.ProgressReader(response, totalsize, hook)
+
+
+# Partial downloads keep their name between runs so an interrupted download can be resumed
+def part_path(cache_dir, checksum):
+    return os.path.join(get_archive_dir(cache_dir), "%s.part" % checksum)
+
+
+# Moves a completely downloaded archive into the cache if its hash matches
+def commit(cache_dir, checksum, partfile, digest, logger):
+    if digest != checksum:
+        logger.error("Checksum mismatch for downloaded archive: expected %s, got %s." % (checksum, digest))
+        util.delete_file(partfile, logger, True)
+        return None
+    path = os.path.join(get_archive_dir(cache_dir), checksum)
+    try:
+        os.replace(partfile, path)
+    except OSError:
+        logger.error("Failed to move %s to %s." % (partfile, path), exc_info=True)
+        util.delete_file(partfile, logger, True)
+        return None
+    return path
+
+
+# Downloads link into the cache, the checksum is verified while the bytes arrive
+def download(link, cache_dir, checksum, logger, hook=None, connections=downloader.defaultConnections):
+    if not util.check_folder(get_archive_dir(cache_dir), logger, False, True):
+        if not util.create_folder(get_archive_dir(cache_dir)):
+            logger.error("%s does not exist and can not be created." % get_archive_dir(cache_dir))
+            return None
+    partfile = part_path(cache_dir, checksum)
+    try:
+        lockfile = open(partfile + ".lock", "w")
+    except OSError:
+        logger.error("Error while opening '%s'." % (partfile + ".lock"), exc_info=True)
+        return None
+    with lockfile:
+        # another build may be downloading the same archive right now
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        path = lookup(cache_dir, checksum)
+        if path is not None:
+            return path
+        hasher = hashlib.sha256()
+        if not downloader.ranged_download(link, partfile, logger, connections, hook=hook, hasher=hasher):
+            return None
+        return commit(cache_dir, checksum, partfile, hasher.hexdigest(), logger)
+
+
+# Like extract.stream_extract, but also stores the archive in the cache while unpacking it
+def stream_extract(link, cache_dir, checksum, path, logger, components=1, hook=None, threads=None, exclude=None,
+                   record=None):
+    if not util.check_folder(get_archive_dir(cache_dir), logger, False, True):
+        if not util.create_folder(get_archive_dir(cache_dir)):
+            logger.error("%s does not exist and can not be created." % get_archive_dir(cache_dir))
+            return False
+    opened = open_download(link, logger, hook)
+    if opened is None:
+        return False
+    response, progress = opened
+    # not resumable, so every build uses its own file
+    partfile = "%s.%s.part" % (os.path.join(get_archive_dir(cache_dir), checksum), util.get_tmp_suffix())
+    try:
+        with open(partfile, "wb") as copyfile:
+            reader = CachingReader(progress, copyfile)
+            if not extract.extract_stream(reader, path, logger, components, threads=threads, exclude=exclude,
+                                          record=record):
+                util.delete_file(partfile, logger, True)
+                return False
+            # tar stops reading at the end-of-archive marker, the hash needs the rest as well
+            reader.drain()
+    except (OSError, http.client.HTTPException):
+        logger.error("Error while downloading '%s' to '%s'." % (link, partfile), exc_info=True)
+        util.delete_file(partfile, logger, True)
+        return False
+    finally:
+        response.close()
+    return commit(cache_dir, checksum, partfile, reader.hasher.hexdigest(), logger) is not None
+
+
+def hash_file(path, algorithm="sha256"):
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as file:
+        while True:
+            data = file.read(1024 * 1024)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+# Returns the manifest of a tree: one entry per path with type, mode, size, mtime, sha256 and link target
+def get_manifest(root):
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            stat = os.lstat(path)
+            entry = {"path": os.path.relpath(path, root), "mode": stat.st_mode & 0o7777,
+                     "size": stat.st_size, "mtime": stat.st_mtime}
+            if os.path.islink(path):
+                entry["type"] = "symlink"
+                entry["link"] = os.readlink(path)
+            elif os.path.isdir(path):
+                entry["type"] = "dir"
+            else:
+                entry["type"] = "file"
+            entries.append(entry)
+    files = [entry for entry in entries if entry["type"] == "file"]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=hashThreads) as executor:
+        for entry, digest in zip(files, executor.map(hash_file, [os.path.join(root, entry["path"])
+                                                                 for entry in files])):
+            entry["sha256"] = digest
+    return entries
+
+
+# Stores the unpacked tree src for the archive checksum, files are hardlinked or reflinked if possible.
+# info (e.g. what was left out while unpacking) is kept in the manifest, load_tree_info() returns it.
+# md5sums ({path: md5}, computed while unpacking) are kept as well, populate_tree() passes them on.
+def store_tree(cache_dir, checksum, src, logger, variant=None, info=None, md5sums=None):
+    target = os.path.join(get_tree_dir(cache_dir), get_tree_key(checksum, variant))
+    if util.check_folder(target, logger, False, True):
+        return True
+    tmp = "%s.%s.tmp" % (target, util.get_tmp_suffix())
+    shutil.rmtree(tmp, ignore_errors=True)
+    if not util.create_folder(get_tree_dir(cache_dir)) and \
+            not util.check_folder(get_tree_dir(cache_dir), logger, False, True):
+        logger.error("%s does not exist and can not be created." % get_tree_dir(cache_dir))
+        return False
+    if not util.copy_folder(src, os.path.join(tmp, "tree"), logger, True, True):
+        shutil.rmtree(tmp, ignore_errors=True)
+        return False
+    try:
+        manifest = get_manifest(os.path.join(tmp, "tree"))
+        if md5sums is not None:
+            for entry in manifest:
+                if entry["path"] in md5sums.keys():
+                    entry["md5"] = md5sums[entry["path"]]
+        with open(os.path.join(tmp, "manifest.json"), "w") as file:
+            json.dump({"archive": checksum, "variant": variant, "info": info, "entries": manifest}, file)
+        os.rename(tmp, target)
+    except OSError:
+        # another build may have stored the same tree in the meantime
+        logger.warning("Could not store unpacked tree in %s." % target, exc_info=True)
+        shutil.rmtree(tmp, ignore_errors=True)
+        return util.check_folder(target, logger, False, True)
+    return True
+
+
+def load_tree(cache_dir, key):
+    try:
+        with open(os.path.join(get_tree_dir(cache_dir), key, "manifest.json"), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def load_manifest(cache_dir, key):
+    return (load_tree(cache_dir, key) or {}).get("entries")
+
+
+def load_tree_info(cache_dir, checksum, variant=None):
+    return (load_tree(cache_dir, get_tree_key(checksum, variant)) or {}).get("info")
+
+
+# Fills dest with the cached tree of the archive checksum. Returns False if there is none or it does not match
+# its manifest (size and mtime are checked, the hashes are only checked if verify is True).
+# record(path, md5, size) is called for every entry like extract.extract_stream() does.
+def populate_tree(cache_dir, checksum, dest, logger, verify=False, variant=None, record=None):
+    key = get_tree_key(checksum, variant)
+    manifest = load_manifest(cache_dir, key)
+    if manifest is None:
+        return False
+    tree = os.path.join(get_tree_dir(cache_dir), key, "tree")
+    for entry in manifest:
+        if entry["type"] != "file":
+            continue
+        try:
+            stat = os.lstat(os.path.join(tree, entry["path"]))
+        except OSError:
+            stat = None
+        if stat is None or stat.st_size != entry["size"] or stat.st_mtime != entry["mtime"] or \
+                (verify and hash_file(os.path.join(tree, entry["path"])) != entry["sha256"]):
+            logger.warning("Cached tree %s does not match its manifest (%s), removing it." %
+                           (key, entry["path"]))
+            shutil.rmtree(os.path.join(get_tree_dir(cache_dir), key), ignore_errors=True)
+            return False
+    try:
+        os.utime(os.path.join(get_tree_dir(cache_dir), key, "manifest.json"))
+        dirs = []
+        for entry in manifest:
+            path = os.path.join(dest, entry["path"])
+            if entry["type"] == "dir":
+                os.makedirs(path, exist_ok=True)
+                dirs.append(entry)
+            elif entry["type"] == "symlink":
+                os.symlink(entry["link"], path)
+            else:
+                util.fast_copy(os.path.join(tree, entry["path"]), path, True)
+            if record is not None and entry["type"] != "file":
+                record(entry["path"], None, 0)
+            elif record is not None:
+                # trees stored before the md5 was kept are hashed once more
+                record(entry["path"], entry.get("md5") or hash_file(path, "md5"), entry["size"])
+        # after the files, creating them changes the mtime of the directories
+        for entry in dirs:
+            os.chmod(os.path.join(dest, entry["path"]), entry["mode"])
+            os.utime(os.path.join(dest, entry["path"]), (entry["mtime"], entry["mtime"]))
+    except OSError:
+        logger.error("Error while copying cached tree %s to %s." % (key, dest), exc_info=True)
+        return False
+    return True
+
+
+def get_tree_size(cache_dir, key):
+    manifest = load_manifest(cache_dir, key)
+    if manifest is None:
+        return 0
+    return sum(entry["size"] for entry in manifest if entry["type"] == "file")
+
+
+# Deletes least recently used archives and trees until the cache is smaller than max_size bytes
+def evict(cache_dir, max_size, logger, keep=()):
+    entries = []
+    if util.check_folder(get_tree_dir(cache_dir), logger, False, True):
+        for name in os.listdir(get_tree_dir(cache_dir)):
+            path = os.path.join(get_tree_dir(cache_dir), name)
+            try:
+                mtime = os.stat(os.path.join(path, "manifest.json")).st_mtime
+            except OSError:
+                # not finished yet (or broken)
+                continue
+            entries.append((mtime, get_tree_size(cache_dir, name), path))
+    if util.check_folder(get_archive_dir(cache_dir), logger, False, True):
+        for name in os.listdir(get_archive_dir(cache_dir)):
+            path = os.path.join(get_archive_dir(cache_dir), name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith(".part") or name.endswith(".state") or name.endswith(".lock"):
+                # leftovers of interrupted downloads
+                if stat.st_mtime < time.time() - 24 * 60 * 60:
+                    util.delete_file(path, logger, True)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        if path in keep:
+            continue
+        if os.path.isdir(path):
+            if not util.delete_folder(path, logger):
+                return False
+        elif not util.delete_file(path, logger):
+            return False
+        total -= size
+    return True
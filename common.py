@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import shutil
+
+import cache
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+packagePrefix = "jetbrains-common-"
+packageVersion = "1.0"  # the content is identified by the hash in the name
+installDir = "/usr/share/jetbrains"
+hashLength = 12
+minSize = 4096  # smaller files stay in every package, a symlink would hardly save anything
+# Bundled runtimes find their files relative to their real path, they are only shared as a whole
+wholeDirs = ["jbr"]
+# The launchers in bin/ find the IDE relative to their real path as well, they are never shared
+keepDirs = ["bin"]
+
+
+def get_dir_key(entries, folder):
+    prefix = folder + os.sep
+    content = [[entry["path"][len(prefix):], entry["type"], entry["mode"], entry.get("sha256"), entry.get("link")]
+               for entry in entries if entry["path"].startswith(prefix)]
+    return hashlib.sha256(json.dumps(content).encode('utf-8')).hexdigest()
+
+
+def in_dirs(path, folders):
+    return any(path == folder or path.startswith(folder + os.sep) for folder in folders)
+
+
+# Finds what is identical in at least two trees ({name: root}). Returns a list of [kind, path in the common
+# package, {name: path in that tree}, size] where kind is "dir" or "file", sorted by the common path.
+def find_shared(trees):
+    manifests = {}
+    for name, root in trees.items():
+        manifests[name] = cache.get_manifest(root)
+    shared = []
+    for folder in wholeDirs:
+        groups = {}
+        for name, root in trees.items():
+            if os.path.isdir(os.path.join(root, folder)) and not os.path.islink(os.path.join(root, folder)):
+                groups.setdefault(get_dir_key(manifests[name], folder), []).append(name)
+        for names in groups.values():
+            if len(names) > 1:
+                size = sum(entry["size"] for entry in manifests[names[0]]
+                           if entry["type"] == "file" and entry["path"].startswith(folder + os.sep))
+                shared.append(["dir", folder, dict((name, folder) for name in names), size])
+    files = {}
+    for name in sorted(trees.keys()):
+        for entry in manifests[name]:
+            if entry["type"] != "file" or entry["size"] < minSize or in_dirs(entry["path"], wholeDirs + keepDirs):
+                continue
+            files.setdefault((entry["sha256"], entry["mode"]), {}).setdefault(name, entry["path"])
+    used = set(path for kind, path, names, size in shared)
+    for (digest, mode), paths in files.items():
+        if len(paths) < 2:
+            continue
+        # stored under the path of the first tree, content that would collide with other content is not shared
+        path = paths[sorted(paths.keys())[0]]
+        if path in used:
+            continue
+        used.add(path)
+        entry = [entry for entry in manifests[sorted(paths.keys())[0]] if entry["path"] == path][0]
+        shared.append(["file", path, paths, entry["size"]])
+    return sorted(shared, key=lambda item: item[1])
+
+
+def get_package_name(shared):
+    content = [[kind, path, size] + sorted(names.items()) for kind, path, names, size in shared]
+    return packagePrefix + hashlib.sha256(json.dumps(content).encode('utf-8')).hexdigest()[:hashLength]
+
+
+# Moves everything that is identical in several trees to dest and replaces it by symlinks to
+# installDir/<package name>. trees is {name: root of the tree}.
+# Returns a dict with the package name, the names of the trees that use it, the bytes saved and the items of
+# find_shared(), None if nothing is shared.
+def share(trees, dest, logger):
+    shared = find_shared(trees)
+    if len(shared) == 0:
+        return None
+    name = get_package_name(shared)
+    commonDir = os.path.join(dest, installDir.lstrip("/"), name)
+    users = set()
+    saved = 0
+    for kind, path, paths, size in shared:
+        first = sorted(paths.keys())[0]
+        target = os.path.join(commonDir, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(os.path.join(trees[first], paths[first]), target)
+        for user, userPath in paths.items():
+            source = os.path.join(trees[user], userPath)
+            if user != first:
+                if kind == "dir":
+                    shutil.rmtree(source)
+                else:
+                    os.remove(source)
+            os.symlink(os.path.join(installDir, name, path), source)
+            users.add(user)
+        saved += size * (len(paths) - 1)
+        logger.debug("Shared %s between %s." % (path, ", ".join(sorted(paths.keys()))))
+    return {"name": name, "dir": os.path.join(installDir, name), "users": sorted(users), "entries": len(shared),
+            "bytes": sum(item[3] for item in shared), "saved": saved, "items": shared}
+
+
+# Adds package to the Depends field of a control file, the field is added if there is none
+def add_depends(control, package):
+    with open(control, "r") as file:
+        lines = file.read().split("\n")
+    for index, line in enumerate(lines):
+        if line.startswith("Depends:"):
+            lines[index] = "%s, %s" % (line.rstrip(), package)
+            break
+    else:
+        position = len(lines)
+        for index, line in enumerate(lines):
+            if line.startswith("Description:"):
+                position = index
+        lines.insert(position, "Depends: %s" % package)
+    with open(control, "w") as file:
+        file.write("\n".join(lines))
+
+
+# Control file of the common package, Maintainer and Section are taken from one of the packages using it
+def write_control(control, name, users, template):
+    fields = {"Maintainer": None, "Section": "devel"}
+    with open(template, "r") as file:
+        for line in file:
+            if ":" in line and line.split(":", 1)[0] in fields.keys():
+                fields[line.split(":", 1)[0]] = line.split(":", 1)[1].strip()
+    with open(control, "w") as file:
+        file.write("Package: %s\n" % name)
+        file.write("Section: %s\n" % fields["Section"])
+        file.write("Version: %s\n" % packageVersion)
+        file.write("Maintainer: %s\n" % fields["Maintainer"])
+        file.write("Architecture: all\n")
+        file.write("Description: Files shared by JetBrains IDEs\n")
+        file.write(" Files that are identical in %s, installed to %s.\n" % (", ".join(users),
+                                                                          os.path.join(installDir, name)))
@@ -0,0 +1,266 @@
+import ctypes
+import io
+import lzma
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import zlib
+
+import util
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+supportedCompressors = ['xz', 'zstd', 'gzip', 'none']
+defaultCompressor = 'xz'
+defaultLevels = {"xz": 6, "zstd": 3, "gzip": 9, "none": 0}  # same as dpkg-deb
+extensions = {"xz": ".xz", "zstd": ".zst", "gzip": ".gz", "none": ""}
+levelRanges = {"xz": [0, 9], "zstd": [1, 22], "gzip": [1, 9], "none": [0, 9]}  # levels above 19 are zstd --ultra
+
+# Candidates that are benchmarked in auto mode, list of [compressor, level]
+autoCandidates = [["gzip", 6], ["zstd", 3], ["zstd", 19], ["xz", 6]]
+autoSampleSize = 64 * 1024 * 1024
+autoSizeTolerance = 1.25  # speed: fastest candidate that is at most 25% bigger than the smallest one
+autoTimeTolerance = 4.0   # size: smallest candidate that is at most 4 times slower than the fastest one
+
+dpkgDebOptions = {}  # what the installed dpkg-deb supports, probed once per process
+dpkgDebLock = util.ForkSafeLock()
+
+
+def get_threads(threads):
+    if threads is None or threads <= 0:
+        return os.cpu_count() or 1
+    return threads
+
+
+def get_dpkg_deb_help():
+    with dpkgDebLock:
+        if "help" not in dpkgDebOptions.keys():
+            try:
+                dpkgDebOptions["help"] = subprocess.run(["dpkg-deb", "--help"], stdout=subprocess.PIPE,
+                                                        stderr=subprocess.DEVNULL, check=False).stdout
+            except OSError:
+                dpkgDebOptions["help"] = b""
+        return dpkgDebOptions["help"]
+
+
+# e.g. "dpkg-deb 1.21.22", None if dpkg-deb is not installed
+def get_dpkg_deb_version():
+    try:
+        output = subprocess.run(["dpkg-deb", "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                check=True).stdout.decode('utf-8', 'replace')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.search(r"version ([^ ]+)", output)
+    return "dpkg-deb %s" % match.group(1) if match is not None else None
+
+
+# dpkg-deb knows --threads-max since dpkg 1.21.9, older ones (e.g. Debian 11, Ubuntu 22.04) refuse to run with it
+def dpkg_deb_has_threads():
+    return b"--threads-max" in get_dpkg_deb_help()
+
+
+# True if dpkg-deb -Z accepts compressor, zstd only since dpkg 1.21.18 (not e.g. on Debian 11)
+def dpkg_deb_has_compressor(compressor):
+    match = re.search(rb"Allowed types: ([^.\n]*)", get_dpkg_deb_help())
+    if match is None:
+        # older help texts do not list the types, those dpkg-debs know gzip, xz and none
+        return compressor in ('gzip', 'xz', 'none')
+    return compressor.encode('ascii') in [name.strip() for name in match.group(1).split(b",")]
+
+
+# Version of what Compressor uses for compressor and threads, e.g. "xz (XZ Utils) 5.6.4" for the command line tool
+# or "liblzma 5.4.1" for the lzma module. Other versions may write different bytes. None if it is not known.
+def get_version(compressor, threads):
+    threads = get_threads(threads)
+    if compressor == 'gzip':
+        return "zlib %s" % zlib.ZLIB_RUNTIME_VERSION
+    if compressor == 'xz' and (threads == 1 or shutil.which("xz") is None):
+        try:
+            import _lzma
+            function = ctypes.CDLL(_lzma.__file__).lzma_version_string
+            function.restype = ctypes.c_char_p
+            return "liblzma %s" % function().decode('ascii')
+        except (ImportError, OSError, AttributeError):
+            return None
+    if compressor in ('xz', 'zstd'):
+        try:
+            output = subprocess.run([compressor, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    check=True).stdout.decode('utf-8', 'replace')
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return output.strip("\n* ").split("\n")[0].split(", by")[0].strip("* ")
+    return "none"
+
+
+# Returns why level can not be used with compressor (all candidates for auto) or None if it can
+def check_level(compressor, level):
+    if level is None:
+        return None
+    for name in [candidate[0] for candidate in autoCandidates] if compressor == 'auto' else [compressor]:
+        low, high = levelRanges[name]
+        if not low <= level <= high:
+            return "Compression level %d is not supported by %s, it needs %d to %d." % (level, name, low, high)
+    return None
+
+
+# native: the package is written by debwriter, otherwise dpkg-deb has to support compressor as well
+def is_available(compressor, native=True):
+    if not native and not dpkg_deb_has_compressor(compressor):
+        return False
+    if compressor == 'zstd':
+        return shutil.which("zstd") is not None
+    return compressor in supportedCompressors
+
+
+# Candidates of auto mode that can be used for the package
+def get_candidates(native=True):
+    return [candidate for candidate in autoCandidates if is_available(candidate[0], native)]
+
+
+# Compresses everything written to it into out (anything with a write method)
+class Compressor(object):
+    def __init__(self, compressor, level, threads, out):
+        self.out = out
+        self.process = None
+        self.thread = None
+        self.error = None
+        threads = get_threads(threads)
+        if compressor == 'gzip':
+            self.compressobj = zlib.compressobj(level, zlib.DEFLATED, 31)
+        elif compressor == 'xz' and (threads == 1 or shutil.which("xz") is None):
+            self.compressobj = lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=level)
+        elif compressor in ('xz', 'zstd'):
+            # multi-threaded compression is only available in the command line tools
+            self.compressobj = None
+            self.process = subprocess.Popen([compressor, "-T%d" % threads, "-%d" % level, "-c", "-q"] +
+                                            (["--ultra"] if compressor == 'zstd' and level > 19 else []),
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.thread = threading.Thread(target=self.pump)
+            self.thread.start()
+        else:
+            self.compressobj = None
+
+    def pump(self):
+        try:
+            while True:
+                data = self.process.stdout.read(1024 * 1024)
+                if not data:
+                    break
+                self.out.write(data)
+        except OSError as error:
+            # the writer gets a broken pipe instead of waiting for a tool that can not write anymore
+            self.error = error
+            self.process.kill()
+
+    def write(self, data):
+        if self.process is not None:
+            try:
+                self.process.stdin.write(data)
+            except BrokenPipeError:
+                if self.error is not None:
+                    raise self.error
+                raise
+        elif self.compressobj is not None:
+            compressed = self.compressobj.compress(data)
+            if compressed:
+                self.out.write(compressed)
+        else:
+            self.out.write(data)
+        return len(data)
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.thread.join()
+            if self.process.wait() != 0:
+                raise OSError("%s exited with %s" % (self.process.args[0], self.process.returncode))
+            if self.error is not None:
+                raise self.error
+        elif self.compressobj is not None:
+            self.out.write(self.compressobj.flush())
+
+    # Stops the command line tool after an error, nothing is written to out afterwards
+    def abort(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        for pipe in [self.process.stdin, self.process.stdout]:
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        self.process.wait()
+        self.thread.join()
+
+
+# Reads about sample_size bytes spread over all regular files below root, returns (sample, total size)
+def get_sample(root, sample_size=autoSampleSize):
+    files = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if os.path.isfile(path) and not os.path.islink(path):
+                size = os.path.getsize(path)
+                files.append((path, size))
+                total += size
+    sample = io.BytesIO()
+    # whole files spread evenly over the tree until sample_size is reached
+    step = max(1, int(total / sample_size))
+    for path, size in files[::step]:
+        try:
+            with open(path, "rb") as file:
+                sample.write(file.read(sample_size - sample.tell()))
+        except OSError:
+            pass
+        if sample.tell() >= sample_size:
+            break
+    return sample.getvalue(), total
+
+
+def benchmark(sample, compressor, level, threads):
+    out = io.BytesIO()
+    start = time.monotonic()
+    compressorObj = Compressor(compressor, level, threads, out)
+    for offset in range(0, len(sample), 1024 * 1024):
+        compressorObj.write(sample[offset:offset + 1024 * 1024])
+    compressorObj.close()
+    return time.monotonic() - start, len(out.getvalue())
+
+
+# Benchmarks the candidates on a sample of root. Returns ([compressor, level], estimated results) where
+# the results are a list of [compressor, level, seconds, bytes] extrapolated to the whole tree.
+def choose(root, prefer, threads, logger, candidates=None):
+    if candidates is None:
+        candidates = get_candidates()
+    sample, total = get_sample(root)
+    if total == 0 or len(sample) == 0:
+        return [defaultCompressor, defaultLevels[defaultCompressor]], []
+    factor = float(total) / len(sample)
+    results = []
+    for compressor, level in candidates:
+        try:
+            seconds, size = benchmark(sample, compressor, level, threads)
+        except OSError:
+            logger.warning("Benchmark of %s -%d failed." % (compressor, level), exc_info=True)
+            continue
+        results.append([compressor, level, seconds * factor, size * factor])
+    if len(results) == 0:
+        return [defaultCompressor, defaultLevels[defaultCompressor]], []
+    smallest = min(result[3] for result in results)
+    fastest = min(result[2] for result in results)
+    if prefer == 'speed':
+        chosen = min([result for result in results if result[3] <= smallest * autoSizeTolerance],
+                     key=lambda result: result[2])
+    else:
+        chosen = min([result for result in results if result[2] <= fastest * autoTimeTolerance],
+                     key=lambda result: result[3])
+    for result in results:
+        logger.info("Compression benchmark: %s -%d, estimated %.1fs and %d bytes." % tuple(result))
+    return chosen[:2], results
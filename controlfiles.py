@@ -0,0 +1,128 @@
+import concurrent.futures
+import hashlib
+import os
+import threading
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+hashThreads = min(8, (os.cpu_count() or 1) * 2)
+
+
+def hash_file(path):
+    hasher = hashlib.md5()
+    size = 0
+    with open(path, "rb") as file:
+        while True:
+            data = file.read(1024 * 1024)
+            if not data:
+                break
+            hasher.update(data)
+            size += len(data)
+    return hasher.hexdigest(), size
+
+
+# What is written into the root of a package (paths relative to it): md5 and size of the regular files and the
+# other entries (directories, symlinks). Filled while the files are written, by several threads at once.
+class Contents(object):
+    def __init__(self):
+        self.files = {}
+        self.others = set()
+        self.lock = threading.Lock()
+
+    # digest is None for everything but regular files
+    def add(self, path, digest, size):
+        path = os.path.normpath(path)
+        with self.lock:
+            if digest is None:
+                self.files.pop(path, None)
+                self.others.add(path)
+            else:
+                self.others.discard(path)
+                self.files[path] = [digest, size]
+
+    # Hashes files that were written without recording them (paths relative to root), in a pool of threads
+    def hash_files(self, root, paths):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=hashThreads) as executor:
+            for path, (digest, size) in zip(paths, executor.map(hash_file, [os.path.join(root, path)
+                                                                           for path in paths])):
+                self.add(path, digest, size)
+
+    # Removes path and everything below it, returns the removed entries as (path relative to path, digest, size)
+    def take(self, path):
+        path = os.path.normpath(path)
+        taken = []
+        with self.lock:
+            for name in [name for name in list(self.files.keys()) + list(self.others)
+                         if name == path or name.startswith(path + os.sep)]:
+                entry = self.files.pop(name, None)
+                if entry is None:
+                    self.others.discard(name)
+                    entry = [None, 0]
+                taken.append((os.path.relpath(name, path), entry[0], entry[1]))
+        return taken
+
+    # md5 of the files below folder, by their path relative to it
+    def get_digests(self, folder):
+        folder = os.path.normpath(folder)
+        with self.lock:
+            return dict((os.path.relpath(path, folder), entry[0]) for path, entry in self.files.items()
+                        if path.startswith(folder + os.sep))
+
+    # Same as dpkg-gencontrol: the size of every file rounded up to KiB plus one KiB per directory, symlink etc.
+    def get_installed_size(self):
+        with self.lock:
+            entries = set(self.others)
+            for path in list(self.files.keys()) + list(self.others):
+                path = os.path.dirname(path)
+                while path != "":
+                    entries.add(path)
+                    path = os.path.dirname(path)
+            return sum((size + 1023) // 1024 for digest, size in self.files.values()) + \
+                len(entries - set(self.files.keys()))
+
+    def get_md5sums(self):
+        with self.lock:
+            return "".join("%s  %s\n" % (self.files[path][0], path) for path in sorted(self.files.keys()))
+
+    # Absolute paths of the files below one of folders (absolute paths as well)
+    def get_conffiles(self, folders):
+        with self.lock:
+            return ["/" + path for path in sorted(self.files.keys())
+                    if any(("/" + path).startswith(folder.rstrip("/") + "/") for folder in folders)]
+
+
+# Sets field in a control file, it is added in front of Description if there is none
+def set_field(control, field, value):
+    with open(control, "r") as file:
+        lines = file.read().split("\n")
+    for index, line in enumerate(lines):
+        if line.startswith("%s:" % field):
+            lines[index] = "%s: %s" % (field, value)
+            break
+    else:
+        position = len(lines)
+        for index, line in enumerate(lines):
+            if line.startswith("Description:"):
+                position = index
+        lines.insert(position, "%s: %s" % (field, value))
+    with open(control, "w") as file:
+        file.write("\n".join(lines))
+
+
+# Writes DEBIAN/md5sums and DEBIAN/conffiles (files below conffileFolders, e.g. /etc/idea) of root and sets
+# Installed-Size in DEBIAN/control. Returns False if one of them can not be written.
+def write(root, contents, conffileFolders, logger):
+    debian = os.path.join(root, "DEBIAN")
+    try:
+        with open(os.path.join(debian, "md5sums"), "w") as file:
+            file.write(contents.get_md5sums())
+        conffiles = contents.get_conffiles(conffileFolders)
+        if len(conffiles) > 0:
+            with open(os.path.join(debian, "conffiles"), "w") as file:
+                file.write("".join("%s\n" % path for path in conffiles))
+        set_field(os.path.join(debian, "control"), "Installed-Size", "%d" % contents.get_installed_size())
+    except OSError:
+        logger.error("Error while writing the control files to %s." % debian, exc_info=True)
+        return False
+    return True
@@ -0,0 +1,139 @@
+import io
+import lzma
+import os
+import tarfile
+import time
+import zlib
+
+import compression
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+arMagic = b"!<arch>\n"
+debianBinary = b"2.0\n"
+
+
+# Writes an ar archive as used by .deb files, a member's size is patched into its header when it is finished
+class ArWriter(object):
+    def __init__(self, fileobj, mtime):
+        self.fileobj = fileobj
+        self.mtime = mtime
+        self.headerOffset = None
+        self.size = 0
+        self.fileobj.write(arMagic)
+
+    def header(self, name, size):
+        return ("%-16s%-12d%-6d%-6d%-8s%-10d`\n" % (name, self.mtime, 0, 0, "100644", size)).encode('ascii')
+
+    def begin(self, name):
+        self.name = name
+        self.headerOffset = self.fileobj.tell()
+        self.size = 0
+        self.fileobj.write(self.header(name, 0))
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def end(self):
+        end = self.fileobj.tell()
+        self.fileobj.seek(self.headerOffset)
+        self.fileobj.write(self.header(self.name, self.size))
+        self.fileobj.seek(end)
+        if self.size % 2 == 1:
+            self.fileobj.write(b"\n")
+        self.headerOffset = None
+
+    def add(self, name, data):
+        self.begin(name)
+        self.write(data)
+        self.end()
+
+
+# Returns all paths below root in the order dpkg-deb uses: sorted by name, symlinks last.
+# skip is a list of top level names to leave out.
+def get_sorted_paths(root, skip=()):
+    paths = []
+    links = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == root:
+            dirnames[:] = [dirname for dirname in dirnames if dirname not in skip]
+            filenames = [filename for filename in filenames if filename not in skip]
+        for name in dirnames + filenames:
+            path = os.path.relpath(os.path.join(dirpath, name), root)
+            if os.path.islink(os.path.join(dirpath, name)):
+                links.append(path)
+            else:
+                paths.append(path)
+    return sorted(paths) + sorted(links)
+
+
+def root_tarinfo(tar, path, arcname):
+    info = tar.gettarinfo(path, arcname)
+    info.uid = 0
+    info.gid = 0
+    info.uname = "root"
+    info.gname = "root"
+    return info
+
+
+# Writes all paths (relative to root) into tar, owned by root:root, every file is read exactly once
+def add_tree(tar, root, paths):
+    tar.addfile(root_tarinfo(tar, root, "./"))
+    for path in paths:
+        info = root_tarinfo(tar, os.path.join(root, path), "./" + path)
+        if info.isreg():
+            with open(os.path.join(root, path), "rb") as file:
+                tar.addfile(info, file)
+        else:
+            tar.addfile(info)
+
+
+def check_control(root, logger):
+    try:
+        with open(os.path.join(root, "DEBIAN", "control"), "r") as file:
+            fields = [line.split(":")[0] for line in file if ":" in line and not line[0].isspace()]
+    except OSError:
+        logger.error("%s does not exist or is not readable." % os.path.join(root, "DEBIAN", "control"))
+        return False
+    for field in ["Package", "Version", "Architecture", "Maintainer", "Description"]:
+        if field not in fields:
+            logger.error("Field '%s' is missing in %s." % (field, os.path.join(root, "DEBIAN", "control")))
+            return False
+    return True
+
+
+# Builds dest out of root/DEBIAN and the rest of root, replaces "fakeroot chown -R root:root" and "dpkg-deb -b"
+def build_deb(root, dest, logger, compressor=compression.defaultCompressor, level=None, threads=None):
+    if level is None:
+        level = compression.defaultLevels[compressor]
+    if not check_control(root, logger):
+        return False
+    mtime = int(os.environ.get("SOURCE_DATE_EPOCH", time.time()))
+    try:
+        with open(dest, "wb") as file:
+            ar = ArWriter(file, mtime)
+            ar.add("debian-binary", debianBinary)
+
+            control = io.BytesIO()
+            with tarfile.open(fileobj=control, mode="w:xz", format=tarfile.GNU_FORMAT) as tar:
+                add_tree(tar, os.path.join(root, "DEBIAN"), get_sorted_paths(os.path.join(root, "DEBIAN")))
+            ar.add("control.tar.xz", control.getvalue())
+
+            ar.begin("data.tar" + compression.extensions[compressor])
+            compressed = compression.Compressor(compressor, level, threads, ar)
+            try:
+                with tarfile.open(fileobj=compressed, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+                    add_tree(tar, root, get_sorted_paths(root, ["DEBIAN"]))
+                compressed.close()
+            except BaseException:
+                compressed.abort()
+                raise
+            ar.end()
+    except (OSError, tarfile.TarError, ValueError, lzma.LZMAError, zlib.error):
+        # ValueError, LZMAError: e.g. a level the compressor does not support
+        logger.error("Error while building '%s' out of '%s'." % (dest, root), exc_info=True)
+        return False
+    return True
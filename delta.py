@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import functools
+import hashlib
+import io
+import json
+import logging
+import lzma
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import zlib
+
+import cache
+import compression
+import dpkgstatus
+import util
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+formatVersion = 1
+extension = ".delta"
+minPatchSize = 4096  # smaller changed files are stored compressed, a patch would hardly be smaller
+maxPatchSize = 1024 * 1024 * 1024  # zstd --patch-from needs a window as big as old and new file together
+patchLevel = 9
+blockSize = 1024 * 1024
+compressors = {".xz": "xz", ".zst": "zstd", ".gz": "gzip", "": "none"}
+
+
+# Returns the members of an ar archive (.deb) as list of [name, header, offset of the data, size]
+def read_ar(path):
+    members = []
+    with open(path, "rb") as file:
+        if file.read(8) != b"!<arch>\n":
+            raise ValueError("%s is not a debian package" % path)
+        while True:
+            header = file.read(60)
+            if len(header) == 0:
+                break
+            if len(header) < 60:
+                raise ValueError("Truncated ar header in %s" % path)
+            size = int(header[48:58].decode('ascii').strip())
+            members.append([header[0:16].decode('ascii').strip().rstrip("/"), header.decode('ascii'),
+                            file.tell(), size])
+            file.seek(size + size % 2, os.SEEK_CUR)
+    return members
+
+
+def get_data_member(members):
+    for member in members:
+        if member[0].startswith("data.tar"):
+            return member
+    raise ValueError("No data archive in package")
+
+
+def read_range(file, offset, size):
+    file.seek(offset)
+    while size > 0:
+        data = file.read(min(blockSize, size))
+        if not data:
+            raise ValueError("Unexpected end of file")
+        size -= len(data)
+        yield data
+
+
+# Writes the uncompressed data.tar of deb to dest
+def decompress(deb, member, dest):
+    name, header, offset, size = member
+    compressor = compressors[os.path.splitext(name)[1] if name != "data.tar" else ""]
+    with open(deb, "rb") as file, open(dest, "wb") as out:
+        if compressor == 'zstd':
+            process = subprocess.Popen(["zstd", "-d", "-c", "-q"], stdin=subprocess.PIPE, stdout=out)
+            for data in read_range(file, offset, size):
+                process.stdin.write(data)
+            process.stdin.close()
+            if process.wait() != 0:
+                raise OSError("zstd exited with %s" % process.returncode)
+            return
+        decompressor = None
+        if compressor == 'xz':
+            decompressor = lzma.LZMADecompressor()
+        elif compressor == 'gzip':
+            decompressor = zlib.decompressobj(31)
+        for data in read_range(file, offset, size):
+            out.write(decompressor.decompress(data) if decompressor is not None else data)
+
+
+# True if the xz data of member was written by the multi-threaded encoder (dpkg-deb and xz -T2 and more do
+# that, the block headers then carry the block sizes), the single-threaded encoder gives different output
+def is_threaded_xz(deb, member):
+    with open(deb, "rb") as file:
+        file.seek(member[2])
+        header = file.read(14)
+    return len(header) == 14 and header[12] != 0 and header[13] & 0xc0 != 0
+
+
+# Regular files of an uncompressed tar as list of [path, offset of the data, size, sha256]
+def get_manifest(path):
+    entries = []
+    with open(path, "rb") as file, open(path, "rb") as data, tarfile.open(fileobj=file, mode="r:") as tar:
+        for member in tar:
+            if member.issparse():
+                raise ValueError("Sparse file %s in %s is not supported" % (member.name, path))
+            if not member.isreg() or member.size == 0:
+                continue
+            hasher = hashlib.sha256()
+            for block in read_range(data, member.offset_data, member.size):
+                hasher.update(block)
+            entries.append([member.name, member.offset_data, member.size, hasher.hexdigest()])
+    return entries
+
+
+def get_window(size):
+    return min(31, max(27, size.bit_length()))
+
+
+# Runs zstd --patch-from, returns the patch of new against old (both bytes)
+def make_patch(old, new, tmp_dir, window):
+    paths = [os.path.join(tmp_dir, name) for name in ["base", "new", "patch"]]
+    try:
+        for path, data in zip(paths, [old, new]):
+            with open(path, "wb") as file:
+                file.write(data)
+        subprocess.run(["zstd", "-q", "-f", "-%d" % patchLevel, "--long=%d" % window, "--patch-from=%s" % paths[0],
+                        paths[1], "-o", paths[2]], check=True, stdin=subprocess.DEVNULL)
+        with open(paths[2], "rb") as file:
+            return file.read()
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def apply_patch(old, patch, tmp_dir, window):
+    paths = [os.path.join(tmp_dir, name) for name in ["base", "patch", "new"]]
+    try:
+        for path, data in zip(paths, [old, patch]):
+            with open(path, "wb") as file:
+                file.write(data)
+        subprocess.run(["zstd", "-d", "-q", "-f", "--long=%d" % window, "--patch-from=%s" % paths[0],
+                        paths[1], "-o", paths[2]], check=True, stdin=subprocess.DEVNULL)
+        with open(paths[2], "rb") as file:
+            return file.read()
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def add_member(container, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    container.addfile(info, io.BytesIO(data))
+
+
+# Writes the delta of new_deb against old_deb to dest. The uncompressed data.tar of the new package is described
+# as a list of chunks: tar headers (raw), files that are in the old package as well (copy, found by their
+# sha256 anywhere in the old tree), changed files with a zstd patch against the old file of the same path
+# (patch) and new files (literal, xz). The other members of the package are stored as they are.
+# level and (for zstd) threads must be the ones the package was built with, apply() compresses the same way.
+# native tells if new_deb was written by package.py --native or by dpkg-deb. dpkg-deb compresses zstd with libzstd,
+# the zstd command line tool that apply() uses writes other bytes, so there are no deltas of those packages.
+# Returns a dict with statistics or None.
+def create(old_deb, new_deb, dest, logger, level=None, threads=None, tmp_dir=None, native=False):
+    tmp = None
+    try:
+        oldMembers = read_ar(old_deb)
+        newMembers = read_ar(new_deb)
+        dataMember = get_data_member(newMembers)
+        compressor = compressors[dataMember[0][len("data.tar"):]]
+        if compressor == 'zstd' and not native:
+            logger.error("%s was built by dpkg-deb with zstd, the zstd command line tool can not compress it the "
+                         "same way again, so a delta could never be applied. Build it with --native to get a "
+                         "delta." % new_deb)
+            return None
+        threads = compression.get_threads(threads)
+        if compressor == 'xz':
+            threads = max(2, threads) if is_threaded_xz(new_deb, dataMember) else 1
+        tmp = tempfile.mkdtemp(prefix="delta-", dir=tmp_dir)
+        oldTar = os.path.join(tmp, "old.tar")
+        newTar = os.path.join(tmp, "new.tar")
+        decompress(old_deb, get_data_member(oldMembers), oldTar)
+        decompress(new_deb, dataMember, newTar)
+        oldEntries = get_manifest(oldTar)
+        oldByHash = dict((entry[3], entry) for entry in oldEntries)
+        oldByPath = dict((entry[0], entry) for entry in oldEntries)
+        usePatches = compression.is_available('zstd')
+        if not usePatches:
+            logger.warning("zstd not found, changed files are stored completely in the delta.")
+
+        stats = {"files": 0, "copied": 0, "patched": 0, "literal": 0, "copiedBytes": 0, "patchedBytes": 0,
+                 "literalBytes": 0}
+        chunks = []
+        raw = lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+        rawData = []
+        with open(dest + ".tmp", "wb") as out, tarfile.open(fileobj=out, mode="w:", format=tarfile.GNU_FORMAT) \
+                as container, open(newTar, "rb") as file, open(oldTar, "rb") as oldFile, \
+                open(new_deb, "rb") as deb:
+
+            def add_raw(start, end):
+                if end > start:
+                    for data in read_range(file, start, end - start):
+                        rawData.append(raw.compress(data))
+                    chunks.append(["raw", end - start])
+
+            for name, header, offset, size in newMembers:
+                if name != dataMember[0]:
+                    add_member(container, "ar/%s" % name, b"".join(read_range(deb, offset, size)))
+            position = 0
+            for path, offset, size, digest in get_manifest(newTar):
+                add_raw(position, offset)
+                position = offset + size
+                stats["files"] += 1
+                if digest in oldByHash.keys():
+                    chunks.append(["copy", oldByHash[digest][1], size])
+                    stats["copied"] += 1
+                    stats["copiedBytes"] += size
+                    continue
+                data = b"".join(read_range(file, offset, size))
+                base = oldByPath.get(path)
+                if usePatches and base is not None and minPatchSize <= size <= maxPatchSize and \
+                        base[2] <= maxPatchSize:
+                    window = get_window(size + base[2])
+                    patch = make_patch(b"".join(read_range(oldFile, base[1], base[2])), data, tmp, window)
+                    if len(patch) < size:
+                        add_member(container, "patch/%d" % len(chunks), patch)
+                        chunks.append(["patch", "patch/%d" % len(chunks), base[1], base[2], size, window, digest])
+                        stats["patched"] += 1
+                        stats["patchedBytes"] += size
+                        continue
+                literal = lzma.compress(data, format=lzma.FORMAT_XZ)
+                add_member(container, "literal/%d" % len(chunks), literal)
+                chunks.append(["literal", "literal/%d" % len(chunks), size, digest])
+                stats["literal"] += 1
+                stats["literalBytes"] += size
+            add_raw(position, os.path.getsize(newTar))
+            rawData.append(raw.flush())
+            add_member(container, "raw.xz", b"".join(rawData))
+
+            info = {"format": formatVersion,
+                    "old": {"name": os.path.basename(old_deb), "sha256": cache.hash_file(old_deb),
+                            "size": os.path.getsize(old_deb)},
+                    "new": {"name": os.path.basename(new_deb), "sha256": cache.hash_file(new_deb),
+                            "size": os.path.getsize(new_deb), "data": cache.hash_file(newTar)},
+                    "members": [[name, header] for name, header, offset, size in newMembers],
+                    "compressor": compressor,
+                    "encoder": "native" if native else "dpkg-deb",
+                    "compressorVersion": compression.get_version(compressor, threads) if native else
+                    compression.get_dpkg_deb_version(),
+                    "level": level if level is not None else compression.defaultLevels[compressor],
+                    "threads": threads,
+                    "chunks": chunks, "stats": stats}
+            add_member(container, "delta.json", json.dumps(info, sort_keys=True).encode('utf-8'))
+        os.replace(dest + ".tmp", dest)
+    except (OSError, ValueError, KeyError, tarfile.TarError, lzma.LZMAError, zlib.error,
+            subprocess.CalledProcessError):
+        logger.error("Error while creating delta of '%s' against '%s'." % (new_deb, old_deb), exc_info=True)
+        if os.path.exists(dest + ".tmp"):
+            os.remove(dest + ".tmp")
+        return None
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+    stats["size"] = os.path.getsize(dest)
+    stats["packageSize"] = info["new"]["size"]
+    return stats
+
+
+# Rebuilds the new package of delta out of old_deb and writes it to dest. Everything is verified: old_deb has to
+# be the package the delta was created against, every file and the data.tar must have their recorded sha256
+# and dest the one of the original package. The data.tar is compressed again, dest only matches if the compressor
+# here writes the same bytes as the one on the build host (same version). Returns dest or None.
+def apply(old_deb, delta, dest, logger, tmp_dir=None):
+    tmp = None
+    try:
+        with tarfile.open(delta, mode="r:") as container:
+            info = json.loads(container.extractfile("delta.json").read().decode('utf-8'))
+            if info.get("format") != formatVersion:
+                logger.error("%s has the unsupported format %s." % (delta, info.get("format")))
+                return None
+            if os.path.getsize(old_deb) != info["old"]["size"] or cache.hash_file(old_deb) != info["old"]["sha256"]:
+                logger.error("%s was not created against %s, it needs %s." % (delta, old_deb, info["old"]["name"]))
+                return None
+            buildVersion = info.get("compressorVersion")
+            localVersion = compression.get_version(info["compressor"], info["threads"])
+            # the version of dpkg-deb does not tell which liblzma or zlib it uses, only native builds are compared
+            if info.get("encoder", "native") == "native" and buildVersion is not None and \
+                    localVersion != buildVersion:
+                logger.warning("%s was created with %s, here it is %s. The rebuilt package will most likely not "
+                               "match the original." % (delta, buildVersion, localVersion or "unknown"))
+            tmp = tempfile.mkdtemp(prefix="delta-", dir=tmp_dir)
+            oldTar = os.path.join(tmp, "old.tar")
+            newTar = os.path.join(tmp, "new.tar")
+            decompress(old_deb, get_data_member(read_ar(old_deb)), oldTar)
+            raw = io.BytesIO(lzma.decompress(container.extractfile("raw.xz").read()))
+            hasher = hashlib.sha256()
+            with open(newTar, "wb") as out, open(oldTar, "rb") as oldFile:
+                for chunk in info["chunks"]:
+                    if chunk[0] == "raw":
+                        blocks = [raw.read(chunk[1])]
+                    elif chunk[0] == "copy":
+                        blocks = read_range(oldFile, chunk[1], chunk[2])
+                    else:
+                        if chunk[0] == "patch":
+                            data = apply_patch(b"".join(read_range(oldFile, chunk[2], chunk[3])),
+                                               container.extractfile(chunk[1]).read(), tmp, chunk[5])
+                        else:
+                            data = lzma.decompress(container.extractfile(chunk[1]).read())
+                        if hashlib.sha256(data).hexdigest() != chunk[-1]:
+                            logger.error("A file rebuilt out of %s has the wrong sha256, %s is corrupt." %
+                                         (delta, delta))
+                            return None
+                        blocks = [data]
+                    for data in blocks:
+                        hasher.update(data)
+                        out.write(data)
+            if hasher.hexdigest() != info["new"]["data"]:
+                logger.error("The data rebuilt out of %s has the wrong sha256, %s or %s is corrupt." %
+                             (delta, delta, old_deb))
+                return None
+
+            with open(dest + ".tmp", "wb") as out:
+                out.write(b"!<arch>\n")
+                for name, header in info["members"]:
+                    out.write(header.encode('ascii'))
+                    start = out.tell()
+                    if name.startswith("data.tar"):
+                        compressed = compression.Compressor(info["compressor"], info["level"], info["threads"], out)
+                        try:
+                            with open(newTar, "rb") as file:
+                                for data in iter(lambda: file.read(blockSize), b""):
+                                    compressed.write(data)
+                            compressed.close()
+                        except BaseException:
+                            compressed.abort()
+                            raise
+                    else:
+                        out.write(container.extractfile("ar/%s" % name).read())
+                    if (out.tell() - start) % 2 == 1:
+                        out.write(b"\n")
+        if cache.hash_file(dest + ".tmp") != info["new"]["sha256"]:
+            # the uncompressed data.tar was verified above, only the compression differs
+            logger.error("The package rebuilt out of %s has the wrong sha256. Its content is right (the data.tar has "
+                         "the recorded sha256), but %s compresses differently than on the build host (%s there, %s "
+                         "here). Use the same version or the complete package." %
+                         (delta, info["compressor"], info.get("compressorVersion") or "unknown",
+                          compression.get_version(info["compressor"], info["threads"]) or "unknown"))
+            os.remove(dest + ".tmp")
+            return None
+        os.replace(dest + ".tmp", dest)
+    except (OSError, ValueError, KeyError, tarfile.TarError, lzma.LZMAError, zlib.error,
+            subprocess.CalledProcessError):
+        logger.error("Error while applying '%s' to '%s'." % (delta, old_deb), exc_info=True)
+        if os.path.exists(dest + ".tmp"):
+            os.remove(dest + ".tmp")
+        return None
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return dest
+
+
+# Newest package "<prefix><version>.deb" in folder that is older than version, None if there is none
+def find_previous(folder, prefix, version):
+    found = []
+    for name in os.listdir(folder):
+        if not name.startswith(prefix) or not name.endswith(".deb"):
+            continue
+        other = name[len(prefix):-len(".deb")]
+        if re.match(r"^[0-9][A-Za-z0-9.+~]*$", other) and dpkgstatus.compare_versions(other, version) < 0:
+            found.append(other)
+    if len(found) == 0:
+        return None
+    found.sort(key=functools.cmp_to_key(dpkgstatus.compare_versions))
+    return os.path.join(folder, "%s%s.deb" % (prefix, found[-1]))
+
+
+# e.g. pycharm-community-2023.2.1_2023.2.2.delta for the delta from 2023.2.1 to 2023.2.2
+def get_delta_name(old_deb, new_version):
+    return "%s_%s%s" % (os.path.basename(old_deb)[:-len(".deb")], new_version, extension)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="delta.py", description="Creates and applies deltas between two "
+                                                                  "packages built by package.py.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    createParser = subparsers.add_parser("create", help="write the delta of NEW against OLD")
+    createParser.add_argument("old", metavar="OLD")
+    createParser.add_argument("new", metavar="NEW")
+    createParser.add_argument("-o", "--output", metavar="FILE", help="(default: NEW with %s)" % extension)
+    createParser.add_argument("--compress-level", metavar="LEVEL", type=int,
+                              help="compression level NEW was built with, defaults to the level dpkg-deb uses")
+    createParser.add_argument("--compress-threads", metavar="N", type=int, default=0,
+                              help="threads zstd compressed NEW with, 0 uses all cores (default: %(default)s)")
+    createParser.add_argument("--native", action='store_true',
+                              help="NEW was built with package.py --native instead of dpkg-deb, needed for zstd")
+    applyParser = subparsers.add_parser("apply", help="rebuild the new package out of OLD and DELTA")
+    applyParser.add_argument("old", metavar="OLD")
+    applyParser.add_argument("delta", metavar="DELTA")
+    applyParser.add_argument("-o", "--output", metavar="FILE",
+                             help="(default: name of the new package next to DELTA)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARN)
+    logger = logging.getLogger(__name__)
+
+    if args.command == "create":
+        output = args.output if args.output is not None else os.path.splitext(args.new)[0] + extension
+        stats = create(args.old, args.new, output, logger, args.compress_level, args.compress_threads,
+                       native=args.native)
+        if stats is None:
+            sys.exit(-1)
+        print("Wrote %s (%s, %.1f%% of the package)." % (output, util.format_size(stats["size"]),
+                                                        stats["size"] * 100 / max(1, stats["packageSize"])))
+    else:
+        output = args.output
+        if output is None:
+            with tarfile.open(args.delta, mode="r:") as container:
+                name = json.loads(container.extractfile("delta.json").read().decode('utf-8'))["new"]["name"]
+            output = os.path.join(os.path.dirname(os.path.abspath(args.delta)), name)
+        if apply(args.old, args.delta, output, logger) is None:
+            sys.exit(-1)
+        print("Rebuilt and verified %s." % output)
+    sys.exit(0)
@@ -0,0 +1,209 @@
+import concurrent.futures
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+from urllib.error import URLError
+
+import util
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+defaultConnections = 4
+defaultSegmentSize = 16 * 1024 * 1024
+chunkSize = 1024 * 1024
+segmentRetries = 3
+
+
+def get_state_path(dest):
+    return dest + ".state"
+
+
+# Returns (size, accepts ranges) of link or None
+def probe(link, logger):
+    request = urllib.request.Request(link, method="HEAD")
+    try:
+        response = urllib.request.urlopen(request, timeout=30)
+    except URLError:
+        logger.error("Error while opening %s. Error was '%s'." % (link, sys.exc_info()[0]))
+        return None
+    response.close()
+    if response.status != 200:
+        logger.error("Error while opening %s: status %s." % (link, response.status))
+        return None
+    size = int(response.headers.get("Content-Length", "-1"))
+    return size, size > 0 and response.headers.get("Accept-Ranges", "none").lower() == "bytes"
+
+
+def load_state(dest, link, size, segment_size):
+    try:
+        with open(get_state_path(dest), "r") as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        state = None
+    if state is not None and state.get("link") == link and state.get("size") == size \
+            and util.check_file_exists(dest) and os.path.getsize(dest) == size:
+        return state
+    segments = [[start, min(start + segment_size, size) - 1, 0] for start in range(0, size, segment_size)]
+    return {"link": link, "size": size, "segments": segments}
+
+
+def save_state(dest, state, lock):
+    with lock:
+        content = json.dumps(state)
+    with open(get_state_path(dest) + ".new", "w") as file:
+        file.write(content)
+    os.replace(get_state_path(dest) + ".new", get_state_path(dest))
+
+
+def fetch_segment(link, fd, segment, lock, stop):
+    start, end = segment[0], segment[1]
+    for attempt in range(segmentRetries):
+        with lock:
+            offset = start + segment[2]
+        if offset > end:
+            return True
+        request = urllib.request.Request(link, headers={"Range": "bytes=%d-%d" % (offset, end)})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                if response.status != 206 or \
+                        not response.headers.get("Content-Range", "").startswith("bytes %d-" % offset):
+                    raise URLError("server ignored range request (status %s)" % response.status)
+                while offset <= end and not stop.is_set():
+                    data = response.read(min(chunkSize, end - offset + 1))
+                    if not data:
+                        break
+                    os.pwrite(fd, data, offset)
+                    offset += len(data)
+                    with lock:
+                        segment[2] = offset - start
+        except (URLError, OSError):
+            if attempt == segmentRetries - 1:
+                raise
+            continue
+        if stop.is_set():
+            return False
+        if offset > end:
+            return True
+    raise URLError("segment %d-%d incomplete after %d attempts" % (start, end, segmentRetries))
+
+
+# Feeds the hasher with the part of the file that is complete from the beginning on
+def update_hasher(hasher, fd, state, lock, hashed):
+    limit = 0
+    with lock:
+        for start, end, written in state["segments"]:
+            limit = start + written
+            if start + written <= end:
+                break
+    while hashed < limit:
+        data = os.pread(fd, min(chunkSize, limit - hashed), hashed)
+        if not data:
+            break
+        hasher.update(data)
+        hashed += len(data)
+    return hashed
+
+
+def single_download(link, dest, logger, hook=None, hasher=None):
+    try:
+        with urllib.request.urlopen(link, timeout=30) as response, open(dest, "wb") as file:
+            totalsize = int(response.headers.get("Content-Length", "-1"))
+            if response.status != 200 or 0 <= totalsize < 100000:
+                logger.error("Error while downloading '%s': status %s, size %s." % (link, response.status, totalsize))
+                return False
+            done = 0
+            while True:
+                data = response.read(chunkSize)
+                if not data:
+                    break
+                file.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+                done += len(data)
+                if hook is not None:
+                    hook((done + chunkSize - 1) // chunkSize, chunkSize, totalsize)
+    except (URLError, OSError):
+        logger.error("Error while downloading '%s' to '%s'." % (link, dest), exc_info=True)
+        return False
+    return True
+
+
+# Downloads link to dest using several HTTP Range requests in parallel. Progress is kept in dest.state,
+# a later call with the same link and dest continues where an interrupted download stopped.
+def ranged_download(link, dest, logger, connections=defaultConnections, segment_size=defaultSegmentSize,
+                    hook=None, hasher=None):
+    probed = probe(link, logger)
+    if probed is None:
+        return False
+    size, ranges = probed
+    if 0 <= size < 100000:
+        logger.error("Error while downloading '%s': size %s." % (link, size))
+        return False
+    if not ranges or connections <= 1:
+        util.delete_file(get_state_path(dest), logger, True)
+        return single_download(link, dest, logger, hook, hasher)
+
+    state = load_state(dest, link, size, segment_size)
+    lock = threading.Lock()
+    stop = threading.Event()
+    try:
+        fd = os.open(dest, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+        logger.error("Error while opening '%s'." % dest, exc_info=True)
+        return False
+    try:
+        if os.fstat(fd).st_size != size:
+            os.ftruncate(fd, 0)
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                # not every platform/filesystem supports preallocation
+                os.ftruncate(fd, size)
+        save_state(dest, state, lock)
+        hashed = 0
+        if hook is not None:
+            # starts the rate measurement, a resumed download starts with the part that is already there
+            hook(sum(segment[2] for segment in state["segments"]) // chunkSize, chunkSize, size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [executor.submit(fetch_segment, link, fd, segment, lock, stop)
+                       for segment in state["segments"] if segment[2] <= segment[1] - segment[0]]
+            pending = set(futures)
+            lastSave = time.monotonic()
+            while pending:
+                finished, pending = concurrent.futures.wait(pending, timeout=0.5,
+                                                            return_when=concurrent.futures.FIRST_EXCEPTION)
+                if any(future.exception() is not None for future in finished):
+                    stop.set()
+                    break
+                if hasher is not None:
+                    hashed = update_hasher(hasher, fd, state, lock, hashed)
+                if hook is not None:
+                    with lock:
+                        done = sum(segment[2] for segment in state["segments"])
+                    hook((done + chunkSize - 1) // chunkSize, chunkSize, size)
+                if time.monotonic() - lastSave > 1:
+                    save_state(dest, state, lock)
+                    lastSave = time.monotonic()
+        save_state(dest, state, lock)
+        for future in futures:
+            if future.exception() is not None:
+                logger.error("Error while downloading '%s': %s. Run again to resume." % (link, future.exception()))
+                return False
+        if hook is not None:
+            hook((size + chunkSize - 1) // chunkSize, chunkSize, size)
+        if hasher is not None:
+            hashed = update_hasher(hasher, fd, state, lock, hashed)
+            if hashed != size:
+                logger.error("Error while downloading '%s': only %d of %d bytes written." % (link, hashed, size))
+                return False
+    except OSError:
+        logger.error("Error while downloading '%s' to '%s'." % (link, dest), exc_info=True)
+        return False
+    finally:
+        os.close(fd)
+    util.delete_file(get_state_path(dest), logger, True)
+    return True
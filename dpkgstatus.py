@@ -0,0 +1,91 @@
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+statusFile = "/var/lib/dpkg/status"
+
+
+# Returns {package name: version} of all installed packages out of dpkg's status file
+def get_installed(logger, path=statusFile):
+    installed = {}
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as file:
+            content = file.read()
+    except OSError:
+        logger.error("%s does not exist or is not readable." % path)
+        return None
+    for stanza in content.split("\n\n"):
+        fields = {}
+        for line in stanza.split("\n"):
+            if line[:8] in ("Package:", "Version:") or line[:7] == "Status:":
+                key, value = line.split(":", 1)
+                fields[key] = value.strip()
+        if "Package" in fields and "Version" in fields and \
+                fields.get("Status", "").split(" ")[-1] == "installed":
+            installed[fields["Package"]] = fields["Version"]
+    return installed
+
+
+# Sort weight of a character in a Debian version: ~ before everything (even the end), letters before the rest
+def order(char):
+    if char == "~":
+        return -1
+    if char.isdigit():
+        return 0
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+
+# Same as verrevcmp in dpkg: alternating non-digit and digit parts, compared lexically and numerically
+def compare_part(a, b):
+    i = 0
+    j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            orderA = order(a[i]) if i < len(a) else 0
+            orderB = order(b[j]) if j < len(b) else 0
+            if orderA != orderB:
+                return orderA - orderB
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == "0":
+            i += 1
+        while j < len(b) and b[j] == "0":
+            j += 1
+        firstDiff = 0
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if firstDiff == 0:
+                firstDiff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if firstDiff != 0:
+            return firstDiff
+    return 0
+
+
+# Returns (epoch, upstream version, revision)
+def split_version(version):
+    epoch = 0
+    if ":" in version:
+        epochString, version = version.split(":", 1)
+        epoch = int(epochString) if epochString.isdigit() else 0
+    revision = ""
+    if "-" in version:
+        version, revision = version.rsplit("-", 1)
+    return epoch, version, revision
+
+
+# < 0 if a is older than b, 0 if equal, > 0 if a is newer (Debian version semantics)
+def compare_versions(a, b):
+    epochA, upstreamA, revisionA = split_version(a)
+    epochB, upstreamB, revisionB = split_version(b)
+    if epochA != epochB:
+        return epochA - epochB
+    result = compare_part(upstreamA, upstreamB)
+    if result != 0:
+        return result
+    return compare_part(revisionA, revisionB)
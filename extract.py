@@ -0,0 +1,236 @@
+import concurrent.futures
+import hashlib
+import http.client
+import os
+import shutil
+import sys
+import tarfile
+import threading
+import urllib.request
+import zlib
+from urllib.error import URLError
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+defaultThreads = min(16, (os.cpu_count() or 1) * 2)
+queueSize = 64 * 1024 * 1024   # bytes of file data that wait for a writer at most
+inlineSize = 16 * 1024 * 1024  # bigger files are written by the reading thread without buffering them
+
+
+# Wraps a file object (e.g. a HTTP response) and reports progress in urlretrieve's reporthook format
+class ProgressReader(object):
+    def __init__(self, fileobj, totalsize, hook=None, blocksize=8192):
+        self.fileobj = fileobj
+        self.totalsize = totalsize
+        self.hook = hook
+        self.blocksize = blocksize
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data:
+            self.bytes_read += len(data)
+            if self.hook is not None:
+                self.hook((self.bytes_read + self.blocksize - 1) // self.blocksize, self.blocksize,
+                          self.totalsize)
+        return data
+
+
+# Same as tar's --strip-components, returns None if nothing is left of the name
+def strip_components(name, components):
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if len(parts) <= components:
+        return None
+    return "/".join(parts[components:])
+
+
+def strip_member(member, components):
+    name = strip_components(member.name, components)
+    if name is None:
+        return None
+    if os.path.isabs(name) or ".." in name.split("/"):
+        return None
+    member.name = name
+    if member.islnk():
+        linkname = strip_components(member.linkname, components)
+        if linkname is None or ".." in linkname.split("/"):
+            return None
+        member.linkname = linkname
+    return member
+
+
+# Limits the bytes of file data that are read but not yet written
+class Budget(object):
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            while self.used > 0 and self.used + size > self.size:
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+# Writes data (bytes or a file object) to target, hasher (e.g. hashlib.md5()) gets the data on the way
+def write_file(target, data, mode, mtime, hasher=None):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.lexists(target) and not os.path.isdir(target):
+        os.unlink(target)
+    fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+    with os.fdopen(fd, "wb") as file:
+        if isinstance(data, bytes):
+            file.write(data)
+            if hasher is not None:
+                hasher.update(data)
+        elif hasher is None:
+            shutil.copyfileobj(data, file, 1024 * 1024)
+        else:
+            while True:
+                block = data.read(1024 * 1024)
+                if not block:
+                    break
+                file.write(block)
+                hasher.update(block)
+        os.fchmod(file.fileno(), mode)
+    os.utime(target, (mtime, mtime))
+
+
+def write_link(target, source, symlink, mtime):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.lexists(target) and not os.path.isdir(target):
+        os.unlink(target)
+    if symlink:
+        os.symlink(source, target)
+        if os.utime in os.supports_follow_symlinks:
+            os.utime(target, (mtime, mtime), follow_symlinks=False)
+    else:
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+
+
+# Extracts a tar stream (no seeking needed) to path and applies strip components on the fly.
+# The calling thread decompresses and parses the stream, regular files are written by a pool of threads.
+# Links are created after all files exist, modes and times of directories are set at the end like tar does.
+# exclude(name, size) is called for every member (size is None for everything but regular files), the member is
+# skipped if it returns True. Hardlinks to skipped files are skipped as well. record(name, md5, size) is called for
+# every member that was written, the md5 is computed by the thread that writes the file and is None for everything
+# but regular files.
+def extract_stream(fileobj, path, logger, components=1, compression="gz", threads=None, exclude=None,
+                   record=None):
+    if threads is None or threads <= 0:
+        threads = defaultThreads
+    budget = Budget(queueSize)
+    futures = []
+    directories = []
+    links = []
+
+    def write(name, data, mode, mtime):
+        try:
+            write_hashed(name, data, mode, mtime, len(data))
+        finally:
+            budget.release(len(data))
+
+    def write_hashed(name, data, mode, mtime, size):
+        if record is None:
+            write_file(os.path.join(path, name), data, mode, mtime)
+            return
+        hasher = hashlib.md5()
+        write_file(os.path.join(path, name), data, mode, mtime, hasher)
+        record(name, hasher.hexdigest(), size)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    try:
+        with tarfile.open(fileobj=fileobj, mode="r|%s" % compression) as tar:
+            for member in tar:
+                if strip_member(member, components) is None:
+                    continue
+                if exclude is not None and (exclude(member.name, member.size if member.isreg() else None) or
+                                            (member.islnk() and exclude(member.linkname, None))):
+                    continue
+                target = os.path.join(path, member.name)
+                if member.isreg() and member.size <= inlineSize:
+                    data = tar.extractfile(member).read()
+                    budget.acquire(len(data))
+                    futures.append(executor.submit(write, member.name, data, member.mode, member.mtime))
+                elif member.isreg():
+                    write_hashed(member.name, tar.extractfile(member), member.mode, member.mtime, member.size)
+                elif member.isdir():
+                    os.makedirs(target, exist_ok=True)
+                    directories.append((target, member.mode, member.mtime))
+                    if record is not None:
+                        record(member.name, None, 0)
+                elif member.issym():
+                    links.append((member.name, member.linkname, True, member.mtime))
+                elif member.islnk():
+                    links.append((member.name, os.path.join(path, member.linkname), False, member.mtime))
+                else:
+                    tar.extract(member, path, set_attrs=True)
+                    if record is not None:
+                        record(member.name, None, 0)
+                # drop finished futures, errors are raised right away
+                if len(futures) > threads * 64:
+                    for future in [future for future in futures if future.done()]:
+                        future.result()
+                        futures.remove(future)
+            for future in futures:
+                future.result()
+        for name, source, symlink, mtime in links:
+            write_link(os.path.join(path, name), source, symlink, mtime)
+            if record is not None and symlink:
+                record(name, None, 0)
+            elif record is not None:
+                # the file was written (and hashed) under another name, hardlinks are rare
+                hasher = hashlib.md5()
+                with open(source, "rb") as file:
+                    for block in iter(lambda: file.read(1024 * 1024), b""):
+                        hasher.update(block)
+                record(name, hasher.hexdigest(), os.path.getsize(source))
+        for target, mode, mtime in sorted(directories, reverse=True):
+            os.chmod(target, mode)
+            os.utime(target, (mtime, mtime))
+    except (tarfile.TarError, OSError, EOFError, zlib.error, http.client.HTTPException):
+        # zlib.error: corrupt gzip data, HTTPException: the download ended early while streaming
+        logger.error("Error while unpacking to '%s'." % path, exc_info=True)
+        return False
+    finally:
+        # after an error the queued files are not written, the writes that already run are waited for
+        executor.shutdown(wait=True, cancel_futures=True)
+    return True
+
+
+def extract_file(archive, path, logger, components=1, threads=None, exclude=None, record=None):
+    try:
+        with open(archive, "rb") as fileobj:
+            return extract_stream(fileobj, path, logger, components, threads=threads, exclude=exclude,
+                                  record=record)
+    except OSError:
+        logger.error("Error while opening '%s'." % archive, exc_info=True)
+        return False
+
+
+# Downloads link and unpacks it while downloading, the archive is never written to disk
+def stream_extract(link, path, logger, components=1, hook=None, threads=None, exclude=None, record=None):
+    try:
+        response = urllib.request.urlopen(link, timeout=30)
+    except URLError:
+        logger.error("Error while opening %s. Error was '%s'." % (link, sys.exc_info()[0]))
+        return False
+    try:
+        totalsize = int(response.headers.get("Content-Length", "-1"))
+        if response.status != 200 or 0 <= totalsize < 100000:
+            logger.error("Error while downloading '%s': status %s, size %s." % (link, response.status, totalsize))
+            return False
+        return extract_stream(ProgressReader(response, totalsize, hook), path, logger, components, threads=threads,
+                              exclude=exclude, record=record)
+    finally:
+        response.close()
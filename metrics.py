@@ -0,0 +1,205 @@
+import fcntl
+import json
+import os
+import threading
+import time
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+sampleInterval = 0.5  # seconds between two samples of the free disk space
+promPrefix = "jetbrains_package_"
+promHelp = {"phase_seconds": "Duration of a packaging phase.",
+            "phase_bytes_per_second": "Bytes processed per second in a packaging phase.",
+            "phase_files_per_second": "Files processed per second in a packaging phase.",
+            "duration_seconds": "Duration of the whole packaging run.",
+            "peak_disk_bytes": "Peak disk usage on the filesystem of the workspace during the packaging run, "
+                               "sampled from its free space. Filesystem-wide: includes concurrent builds.",
+            "size_bytes": "Size of the built package.",
+            "pruned_bytes": "Bytes left out of the package by its pruning profile.",
+            "success": "1 if the last packaging run succeeded, 0 otherwise.",
+            "last_run_timestamp_seconds": "Unix time the last packaging run finished."}
+
+
+# Times consecutive phases of a run. begin() ends the current phase, phases with the same name add up.
+# The free space of the filesystem of path is sampled in the background to get the peak disk usage. That is
+# filesystem-wide, concurrent builds (batch mode) and other processes writing to the filesystem are counted as well.
+class Metrics(object):
+    def __init__(self, labels, path):
+        self.labels = labels
+        self.path = path
+        self.phases = {}
+        self.order = []
+        self.values = {}
+        self.current = None
+        self.currentStart = None
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.baseFree = self.get_free()
+        self.minFree = self.baseFree
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def get_free(self):
+        try:
+            stat = os.statvfs(self.path)
+        except OSError:
+            return None
+        return stat.f_bavail * stat.f_frsize
+
+    def sample(self):
+        free = self.get_free()
+        with self.lock:
+            if free is not None and (self.minFree is None or free < self.minFree):
+                self.minFree = free
+
+    def run(self):
+        while not self.stop.wait(sampleInterval):
+            self.sample()
+
+    def begin(self, name):
+        self.end()
+        if name not in self.phases.keys():
+            self.phases[name] = {"seconds": 0.0}
+            self.order.append(name)
+        self.current = name
+        self.currentStart = time.monotonic()
+
+    def end(self):
+        if self.current is not None:
+            self.phases[self.current]["seconds"] += time.monotonic() - self.currentStart
+            self.sample()
+        self.current = None
+
+    # Adds value to a counter (e.g. bytes or files) of phase, default is the current one
+    def add(self, key, value, phase=None):
+        if phase is None:
+            phase = self.current
+        if phase in self.phases.keys():
+            self.phases[phase][key] = self.phases[phase].get(key, 0) + value
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def get_peak_disk(self):
+        with self.lock:
+            if self.baseFree is None or self.minFree is None:
+                return None
+            return max(0, self.baseFree - self.minFree)
+
+    # Ends the run, returns one dict per phase and a last one with phase "total"
+    def finish(self, returncode):
+        self.end()
+        self.stop.set()
+        records = []
+        for name in self.order:
+            record = dict(self.labels)
+            record["phase"] = name
+            record.update(self.phases[name])
+            for key in ["bytes", "files"]:
+                if key in record.keys() and record["seconds"] > 0:
+                    record["%s_per_second" % key] = record[key] / record["seconds"]
+            records.append(record)
+        record = dict(self.labels)
+        record.update(self.values)
+        record.update({"phase": "total", "seconds": time.monotonic() - self.start, "returncode": returncode,
+                       "peak_disk_bytes": self.get_peak_disk(), "timestamp": time.time()})
+        records.append(record)
+        return records
+
+
+# Returns (number of regular files, their size) below root
+def count_files(root):
+    files = 0
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            try:
+                stat = os.lstat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            if not os.path.islink(os.path.join(dirpath, filename)):
+                files += 1
+                size += stat.st_size
+    return files, size
+
+
+# Appends one json object per line, several runs can share the file
+def write_json(path, records, logger):
+    try:
+        with open(path, "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            file.write("".join(json.dumps(record, sort_keys=True) + "\n" for record in records))
+    except OSError:
+        logger.warning("Could not write metrics to %s." % path, exc_info=True)
+        return False
+    return True
+
+
+def get_prom_labels(labels):
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def get_prom_samples(records, label_names):
+    samples = {}
+    for record in records:
+        labels = [(name, record[name]) for name in label_names]
+        if record["phase"] != "total":
+            labels.append(("phase", record["phase"]))
+            values = {"phase_seconds": record["seconds"],
+                      "phase_bytes_per_second": record.get("bytes_per_second"),
+                      "phase_files_per_second": record.get("files_per_second")}
+        else:
+            values = {"duration_seconds": record["seconds"],
+                      "peak_disk_bytes": record["peak_disk_bytes"],
+                      "size_bytes": record.get("package_bytes"),
+                      "pruned_bytes": record.get("pruned_bytes"),
+                      "success": 1 if record["returncode"] == 0 else 0,
+                      "last_run_timestamp_seconds": record["timestamp"]}
+        for name, value in values.items():
+            if value is not None:
+                samples.setdefault(promPrefix + name, []).append("%s%s %s" % (promPrefix + name,
+                                                                               get_prom_labels(labels), value))
+    return samples
+
+
+# Writes a file for the textfile collector of the node exporter. Samples of other runs (other labels) that are
+# already in the file are kept, so all jobs of a batch can use the same file.
+def write_prom(path, records, label_names, logger):
+    ownLabels = get_prom_labels([(name, records[-1][name]) for name in label_names])[:-1]
+    samples = {}
+    try:
+        with open(path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path, "r") as file:
+                    for line in file:
+                        line = line.strip()
+                        if line == "" or line.startswith("#"):
+                            continue
+                        name = line.split("{")[0].split(" ")[0]
+                        labels = line[len(name):]
+                        if labels.startswith(ownLabels + ",") or labels.startswith(ownLabels + "}"):
+                            continue
+                        samples.setdefault(name, []).append(line)
+            except OSError:
+                pass
+            for name, lines in get_prom_samples(records, label_names).items():
+                samples.setdefault(name, []).extend(lines)
+            with open(path + ".%d" % os.getpid(), "w") as file:
+                for name in sorted(samples.keys()):
+                    if name[len(promPrefix):] in promHelp.keys():
+                        file.write("# HELP %s %s\n" % (name, promHelp[name[len(promPrefix):]]))
+                    file.write("# TYPE %s gauge\n" % name)
+                    for line in samples[name]:
+                        file.write(line + "\n")
+            os.replace(path + ".%d" % os.getpid(), path)
+    except OSError:
+        logger.warning("Could not write metrics to %s." % path, exc_info=True)
+        return False
+    return True
@@ -1,16 +1,31 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import concurrent.futures
+import functools
 import logging
 import argparse
-from urllib.error import URLError
 
 import util
+import aptrepo
+import batch
+import cache
+import common
+import compression
+import controlfiles
+import debwriter
+import delta
+import download
+import dpkgstatus
+import extract
+import metrics
+import prune
+import releases
+import watch
+import workspace
 import sys
 import os
-import urllib.request
 import re
-import json
 
 __author__ = 'Andreas Bader'
 __version__ = '0.02'
@@ -27,331 +42,1016 @@ supportedIDEs = {"pycharm": [{"community": "PCC", "professional": "PCP"},
                  }
 supportedEditions = ['community', 'professional']
 
+logger = logging.getLogger(__name__)
+
+
+# Raised by the functions below if packaging can not go on, the message says why
+class PackageError(Exception):
+    pass
+
+
+# Paths and options of builds, computed once and shared by all builds of a process
+class Config(object):
+    def __init__(self, base_dir=None, work_dir=None, cache_dir=None, cache_size=cache.defaultCacheSize, no_cache=False,
+                 metadata_ttl=releases.defaultTTL, releases_url=newVersionURL,
+                 connections=download.defaultConnections, stream=False, extract_threads=0, native=False,
+                 compress=compression.defaultCompressor, compress_level=None, compress_threads=0,
+                 compress_prefer='size', apt_repo=None, apt_layout=aptrepo.defaultLayout,
+                 apt_keep=aptrepo.defaultKeep, delta=False, prune=None, metrics_json=None, metrics_prom=None):
+        levelError = compression.check_level(compress, compress_level)
+        if levelError is not None:
+            raise PackageError(levelError)
+        self.baseDir = base_dir if base_dir is not None else util.get_script_path()
+        self.dataDir = os.path.join(self.baseDir, "data")
+        self.outputDir = os.path.join(self.baseDir, "output")
+        # builds are staged in a folder per build below tmpDir, e.g. on a tmpfs if work_dir is given
+        self.workDir = work_dir
+        self.tmpDir = os.path.abspath(work_dir) if work_dir is not None else os.path.join(self.baseDir, "tmp")
+        self.cacheDir = cache_dir if cache_dir is not None else cache.get_default_cache_dir()
+        self.cacheSize = cache_size
+        self.noCache = no_cache
+        self.metadataTTL = metadata_ttl
+        self.releasesURL = releases_url
+        self.connections = connections
+        self.stream = stream
+        self.extractThreads = extract_threads
+        self.native = native
+        self.compress = compress
+        self.compressLevel = compress_level
+        self.compressThreads = compress_threads
+        self.compressPrefer = compress_prefer
+        self.aptRepo = apt_repo
+        self.aptLayout = apt_layout
+        self.aptKeep = apt_keep
+        self.delta = delta
+        self.prune = prune
+        self.metricsJSON = metrics_json
+        self.metricsProm = metrics_prom
+
+    def get_tmp_dir(self, ide, edition, jdk):
+        return os.path.join(self.tmpDir, "%s-%s%s" % (ide, edition, "" if jdk else "-nojava"))
+
+
+# Newest release of an IDE/edition as listed by the releases endpoint
+class Release(object):
+    def __init__(self, ide, edition, jdk, version, link, checksum_link=None, size=None):
+        self.ide = ide
+        self.edition = edition
+        self.jdk = jdk
+        self.version = version
+        self.link = link
+        self.checksumLink = checksum_link
+        self.size = size
+
 
-def cleanup(code, log):
-    if util.check_folder(os.path.join(util.get_script_path(), "tmp"), logger, False, False):
-        if not util.delete_folder(os.path.join(util.get_script_path(), "tmp"), logger, True):
-            log.error("%s does exist and can not be deleted." % os.path.join(util.get_script_path(), "tmp"))
-            sys.exit(-1)
-    sys.exit(code)
+# Result of build_package(): path of the package, its version and the seconds every phase took
+class BuildResult(object):
+    def __init__(self, release, path):
+        self.release = release
+        self.version = release.version
+        self.path = path
+        self.published = None
+        self.delta = None
+        self.deltaStats = None
+        self.pruned = None
+        self.shared = None
+        self.compressor = None
+        self.compressLevel = None
+        self.timings = {}
+        self.records = []
 
 
-def get_download_link(varnames, edition, log, embeddedJava):
+# Result of check_installed(): installed is None if the package is not installed
+class CheckResult(object):
+    def __init__(self, release, package, installed):
+        self.release = release
+        self.package = package
+        self.installed = installed
+        self.available = release.version
+
+    def is_installed(self):
+        return self.installed is not None
+
+    def is_update(self):
+        return self.installed is not None and dpkgstatus.compare_versions(self.available, self.installed) > 0
+
+
+# Comma separated list of values out of choices
+def choice_list(choices):
+    def parse(value):
+        values = [item.strip() for item in value.split(",") if item.strip() != ""]
+        for item in values:
+            if item not in choices:
+                raise argparse.ArgumentTypeError("invalid choice: '%s' (choose from %s)" %
+                                                 (item, ", ".join("'%s'" % choice for choice in choices)))
+        if len(values) == 0:
+            raise argparse.ArgumentTypeError("no value given")
+        return values
+    return parse
+
+
+def get_all_codes():
+    codes = []
+    for ide in supportedIDEs.keys():
+        for edition in supportedEditions:
+            codes.append(supportedIDEs[ide][0][edition])
+    return codes
+
+
+def get_download_info(varnames, edition, log, embeddedJava, cacheDir, ttl, releasesURL=newVersionURL):
     varname = varnames[edition]
-    try:
-        response = urllib.request.urlopen(newVersionURL % varname, timeout=10)
-    except URLError:
-        log.error("Error while opening %s. Error was '%s'." % (newVersionURL % varname, sys.exc_info()[0]))
+    url = releasesURL % ",".join(get_all_codes())
+    parsedjson = releases.get_releases(releasesURL, get_all_codes(), cacheDir, ttl, log)
+    if parsedjson is None:
         return None
-    try:
-        content = response.read().decode('utf-8')
-    except UnicodeDecodeError:
-        log.error("Error while retrieving %s. Error was '%s'." % (newVersionURL % varname, sys.exc_info()[0]))
-        return None
-    if response is not None and response.status == 200:
-        try:
-            parsedjson = json.loads(content)
-        except ValueError:
-            log.error("Error while parsing json from %s. Error was '%s'." %
-                      (newVersionURL % varname, sys.exc_info()[0]))
-            return None
-        linuxKey = 'linux'
-        if not embeddedJava:
-            linuxKey = 'linuxWithoutJDK'
-
-        if varname in parsedjson.keys():
-            if len(parsedjson[varname]) > 0:
-                if "downloads" in parsedjson[varname][0].keys():
-                    if linuxKey in parsedjson[varname][0]["downloads"].keys():
-                        if "link" in parsedjson[varname][0]["downloads"][linuxKey].keys():
-                            return parsedjson[varname][0]["downloads"][linuxKey]["link"]
-                        else:
-                            log.error("Error while parsing '%s': No 'link' in dictionary." % newVersionURL % varname)
+    linuxKey = 'linux'
+    if not embeddedJava:
+        linuxKey = 'linuxWithoutJDK'
+
+    if varname in parsedjson.keys():
+        if len(parsedjson[varname]) > 0:
+            if "downloads" in parsedjson[varname][0].keys():
+                if linuxKey in parsedjson[varname][0]["downloads"].keys():
+                    if "link" in parsedjson[varname][0]["downloads"][linuxKey].keys():
+                        return parsedjson[varname][0]["downloads"][linuxKey]
                     else:
-                        log.error("Error while parsing '%s': No '%' in dictionary." % newVersionURL % varname, linuxKey)
+                        log.error("Error while parsing '%s': No 'link' in dictionary." % url)
                 else:
-                    log.error("Error while parsing '%s': No 'downloads' in dictionary." % newVersionURL % varname)
+                    log.error("Error while parsing '%s': No '%s' in dictionary." % (url, linuxKey))
             else:
-                log.error("Error while parsing '%s': No entries in list." % newVersionURL % varname)
+                log.error("Error while parsing '%s': No 'downloads' in dictionary." % url)
         else:
-            log.error("Error while parsing '%s': No '%s' in dictionary." % (newVersionURL % varname, varname))
+            log.error("Error while parsing '%s': No entries in list." % url)
+    else:
+        log.error("Error while parsing '%s': No '%s' in dictionary." % (url, varname))
     return None
 
-# Configure ArgumentParser
-parser = argparse.ArgumentParser(prog="package.py", epilog="Supported IDEs: %s\nSupported Editions: %s"
-                                                           % (list(supportedIDEs.keys()), supportedEditions),
-                                 description="Packages Jetbrains IDEs for Debian/Ubuntu.",
-                                 formatter_class=argparse.RawDescriptionHelpFormatter)
-parser.add_argument("-e", "--edition", metavar="EDITION", default=supportedEditions[0],
-                    choices=supportedEditions, help="Which Edition should be packaged?")
-parser.add_argument("-i", "--ide", metavar="IDE", choices=supportedIDEs.keys(), default=list(supportedIDEs.keys())[0],
-                    help="Which IDE should be packaged?")
-parser.add_argument("-j", "--java", metavar="JAVA", choices={'y','n'}, default='y',
-                    help="Which IDE should be packaged?")
-parser.add_argument("-l", "--list", action='store_true', help="list all supported IDEs")
-parser.add_argument("-c", "--check", action='store_true',
-                    help="check if installed version is older than the newest version available (needs dpkg)")
-parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
-args = parser.parse_args()
-
-# Configure Logging
-logLevel = logging.WARN
-logging.basicConfig(level=logLevel)
-logger = logging.getLogger(__name__)
 
-if args.list:
-    print("Supported JetBrains IDEs:")
-    for key in supportedIDEs.keys():
-        print(key)
-    sys.exit(0)
-
-# Checking tools
-for tool in ["tar", "dpkg", "fakeroot", "dpkg-deb"]:
-    if not util.cmd_exists(tool):
-        logger.error("%s not found or not usable." % tool)
-        sys.exit(-1)
-
-# Get URL
-link = get_download_link(supportedIDEs[args.ide][0], args.edition, logger, args.java!='n')
-
-if link is None:
-    logger.error("Could not get url for %s." % args.ide)
-    sys.exit(-1)
-
-version = re.search(supportedIDEs[args.ide][1], link.split("/")[-1])
-if version is None:
-    logger.error("Could not parse version out of '%s'." % link.split("/")[-1])
-    sys.exit(-1)
-
-if args.check:
-    result = util.run_cmd("dpkg -l | grep '%s' | grep -E -o '%s' | cat" %
-                          (args.ide, supportedIDEs[args.ide][1]), logger, True, True).decode('utf-8').replace("\n", "")
-    if result is None:
-        logger.error("Error while running '%s'." % "dpkg -l | grep '%s' | grep -E -o '%s'" %
-                     (args.ide, supportedIDEs[args.ide][1]))
-        sys.exit(-1)
-    if result != version.group() and result != "":
-        print("There is a newer version (%s) than installed (%s) available!" % (version.group(), result))
-        sys.exit(1)
-    if result == "":
-        print("%s %s is not installed." % (args.ide, args.edition))
-    sys.exit(0)
-
-# Checking folders
-if not util.check_folder(os.path.join(util.get_script_path(), "output"), logger, False, True):
-    if not util.create_folder(os.path.join(util.get_script_path(), "output")):
-        logger.error("%s does not exist and can not be created." % os.path.join(util.get_script_path(), "output"))
-        sys.exit(-1)
-
-if util.check_folder(os.path.join(util.get_script_path(), "tmp"), logger, False, True):
-    if not util.delete_folder(os.path.join(util.get_script_path(), "tmp"), logger, True):
-        logger.error("%s does exist and can not be deleted." % os.path.join(util.get_script_path(), "tmp"))
-        sys.exit(-1)
-
-for folder in [os.path.join(util.get_script_path(), "tmp"),
-               os.path.join(util.get_script_path(), "tmp", "root", "usr", "share", "jetbrains", args.ide),
-               os.path.join(util.get_script_path(), "tmp", "root", "usr", "share", "applications"),
-               os.path.join(util.get_script_path(), "tmp", "root", "usr", "bin"),
-               os.path.join(util.get_script_path(), "tmp", "root", "etc", args.ide),
-               os.path.join(util.get_script_path(), "tmp", "root", "etc", "sysctl.d"),
-               os.path.join(util.get_script_path(), "tmp", "root", "DEBIAN")]:
-    if not util.create_folder(folder):
-        logger.error("%s can not be created." % folder)
-        sys.exit(-1)
-
-if not util.check_folder(os.path.join(util.get_script_path(), "data"), logger, False, False):
-    cleanup(-1, logger)
-
-if not util.check_folder(os.path.join(util.get_script_path(), "data", args.ide), logger, False, False):
-    cleanup(-1, logger)
-
-if not util.check_folder(os.path.join(util.get_script_path(), "data", args.ide, "debian"), logger, False, False):
-    cleanup(-1, logger)
-
-# Checking files
-for file in ["control.in", "postinst", "sysctl-99.conf"]:
-    if not util.check_file_exists(os.path.join(util.get_script_path(), "data", args.ide, "debian", file)) and not \
-            util.check_file_readable(os.path.join(util.get_script_path(), "data", args.ide, "debian", file)):
-        logger.error("%s does not exist or is not readable." % file)
-        cleanup(-1, logger)
-
-for file in ["LICENSE", "Makefile", "pkginfo.in", "prototype.in", "icon.desktop", "start.sh", "vmoptions.README"]:
-    if not util.check_file_exists(os.path.join(util.get_script_path(), "data", args.ide, file)) and not \
-            util.check_file_readable(os.path.join(util.get_script_path(), "data", args.ide, file)):
-        logger.error("%s does not exist or is not readable." % file)
-        cleanup(-1, logger)
-
-# Download URL
-if util.check_file_exists(os.path.join(util.get_script_path(), "tmp", link.split("/")[-1])):
-    if not util.delete_file(os.path.join(util.get_script_path(), "tmp", link.split("/")[-1]), logger, False):
-        cleanup(-1, logger)
-
-resp = urllib.request.urlretrieve(link, os.path.join(util.get_script_path(), "tmp", link.split("/")[-1]), util.progress_hook)
-if resp is None or resp[1]["Connection"] != "close" or int(resp[1]["Content-Length"]) < 100000:
-    logger.error("Error while downloading '%s'." % os.path.join(util.get_script_path(), "tmp", link.split("/")[-1]))
-    cleanup(-1, logger)
-
-if not util.run_cmd("tar --strip-components 1 -C %s -zxf %s" %
-                    (os.path.join(util.get_script_path(), "tmp", "root", "usr", "share", "jetbrains", args.ide),
-                     os.path.join(util.get_script_path(), "tmp", link.split("/")[-1])), logger, False):
-    logger.error("Error while unpacking '%s' to '%s'." %
-                 (os.path.join(util.get_script_path(), "tmp", link.split("/")[-1])),
-                 os.path.join(util.get_script_path(), "tmp", "root", "usr", "share", "jetbrains", args.ide))
-    cleanup(-1, logger)
-
-# Copy Files
-copyList = [[os.path.join(util.get_script_path(), "data", args.ide, "start.sh"),
-             os.path.join(util.get_script_path(), "tmp", "root", "usr", "bin", args.ide)],
-            [os.path.join(util.get_script_path(), "data", args.ide, "icon.desktop"),
-             os.path.join(util.get_script_path(), "tmp", "root", "usr", "share",
-                          "applications", "%s.desktop" % args.ide)],
-            [os.path.join(util.get_script_path(), "data", args.ide, "vmoptions.README"),
-             os.path.join(util.get_script_path(), "tmp", "root", "etc", args.ide, "%s.vmoptions.README" % args.ide)],
-            [os.path.join(util.get_script_path(), "data", args.ide, "debian", "sysctl-99.conf"),
-             os.path.join(util.get_script_path(), "tmp", "root", "etc", "sysctl.d", "99-%s.conf" % args.ide)],
-            ]
-
-for copyTuple in copyList:
-    if not util.copy_file(copyTuple[0], copyTuple[1], logger):
-        cleanup(-1, logger)
-
-# Fixing vmoptions file(s)
-file1 = open(os.path.join(util.get_script_path(), "tmp",
-                          "root", "etc", args.ide, "%s.vmoptions.README" % args.ide), "a")
-file2 = open(os.path.join(util.get_script_path(), "tmp",
-                          "root", "usr", "share", "jetbrains", args.ide, "bin", "%s.vmoptions" % args.ide), "r")
-file3 = open(os.path.join(util.get_script_path(), "tmp",
-                          "root", "usr", "share", "jetbrains", args.ide, "bin", "%s.vmoptions2" % args.ide), "w")
-file1.write("\nOriginal pycharm.vmoptions:\n")
-for line in file2:
-    file1.write(line)
-    if "yjpagent" not in line:
-        file3.write(line)
-file1.close()
-file2.close()
-file3.close()
-if not util.delete_file(os.path.join(util.get_script_path(),
-                                     "tmp", "root", "usr", "share", "jetbrains", args.ide, "bin",
-                                     "%s.vmoptions" % args.ide), logger):
-    logger.error("Error while deleting '%s'." %
-                 os.path.join(util.get_script_path(), "tmp", "root", "usr",
-                              "share", "jetbrains", args.ide, "bin", "%s.vmoptions" % args.ide))
-    cleanup(-1, logger)
-if not util.copy_file(os.path.join(util.get_script_path(),
-                                   "tmp", "root", "usr", "share", "jetbrains", args.ide, "bin",
-                                   "%s.vmoptions2" % args.ide),
-                      os.path.join(util.get_script_path(),
-                                   "tmp", "root", "usr", "share",
-                                   "jetbrains", args.ide, "bin",
-                                   "%s.vmoptions" % args.ide), logger):
-    logger.error("Error while copying '%s' to '%s'." % (os.path.join(util.get_script_path(),
-                                                                     "tmp", "root", "usr", "share", "jetbrains",
-                                                                     args.ide, "bin", "%s.vmoptions2" % args.ide),
-                                                        os.path.join(util.get_script_path(), "tmp", "root",
-                                                                     "usr", "share", "jetbrains", args.ide,
-                                                                     "bin", "%s.vmoptions" % args.ide)))
-if not util.delete_file(os.path.join(util.get_script_path(),
-                                     "tmp", "root", "usr", "share", "jetbrains", args.ide, "bin",
-                                     "%s.vmoptions2" % args.ide), logger):
-    logger.error("Error while deleting '%s'." % os.path.join(util.get_script_path(),
-                                                             "tmp", "root", "usr", "share", "jetbrains", args.ide,
-                                                             "bin", "%s.vmoptions2" % args.ide))
-    cleanup(-1, logger)
-
-# Copy files that needed fixes (inserts ide name etc.)
-copyList = [[os.path.join(util.get_script_path(), "data", args.ide, "debian", "postinst"),
-             os.path.join(util.get_script_path(), "tmp", "root", "DEBIAN", "postinst")],
-            [os.path.join(util.get_script_path(), "data", args.ide, "debian", "templates"),
-             os.path.join(util.get_script_path(), "tmp", "root", "DEBIAN", "templates")],
-            [os.path.join(util.get_script_path(), "data", args.ide, "debian", "control.in"),
-             os.path.join(util.get_script_path(), "tmp", "root", "DEBIAN", "control")]
-            ]
-
-for copyTuple in copyList:
-    # Check is destination exists
-    if util.check_file_exists(copyTuple[1]):
-        if not util.delete_file(copyTuple[1], logger, False):
-            cleanup(-1, logger)
-
-    file1 = open(copyTuple[0], "r")
-    file2 = open(copyTuple[1], "w")
-    otherEdition = 'community'
-    oldEdition = 'iu'
-    otherOldEdition = 'ic'
-    if args.edition == otherEdition:
-        otherEdition = 'professional'
-        oldEdition = "ic"
-        otherOldEdition = 'iu'
-    for line in file1:
-        file2.write(
-            line.replace("OTHER_EDITION2", otherEdition.upper())
-                .replace("OTHER_EDITION", otherEdition)
-                .replace("VERSION", version.group())
-                .replace("EDITION2", args.edition.upper())
-                .replace("EDITION", args.edition)
-                .replace("OLD1", oldEdition)
-                .replace("OLD2", oldEdition.upper())
-                .replace("OLD3", otherOldEdition)
-                .replace("OLD4", otherOldEdition.upper()))
+# Name of the package as written into the control file, e.g. pycharm-community
+def get_package_name(ide, edition, log, dataDir=None):
+    if dataDir is None:
+        dataDir = os.path.join(util.get_script_path(), "data")
+    path = os.path.join(dataDir, ide, "debian", "control.in")
+    try:
+        with open(path, "r") as file:
+            for line in file:
+                if line.startswith("Package:"):
+                    return line.split(":", 1)[1].strip().replace("EDITION", edition)
+    except OSError:
+        log.error("%s does not exist or is not readable." % path)
+        return None
+    log.error("No 'Package' field in %s." % path)
+    return None
+
+
+def check_supported(ide, edition):
+    if ide not in supportedIDEs.keys():
+        raise PackageError("Unsupported IDE '%s', supported are %s." % (ide, ", ".join(supportedIDEs.keys())))
+    if edition not in supportedEditions:
+        raise PackageError("Unsupported edition '%s', supported are %s." % (edition, ", ".join(supportedEditions)))
+
+
+# Looks up the newest release, the answer of the releases endpoint is cached for config.metadataTTL seconds
+def resolve_release(ide, edition, jdk=True, config=None, log=logger, ttl=None):
+    check_supported(ide, edition)
+    if config is None:
+        config = Config()
+    downloadInfo = get_download_info(supportedIDEs[ide][0], edition, log, jdk, config.cacheDir,
+                                     config.metadataTTL if ttl is None else ttl, config.releasesURL)
+    if downloadInfo is None:
+        raise PackageError("Could not get url for %s." % ide)
+    link = downloadInfo["link"]
+    version = re.search(supportedIDEs[ide][1], link.split("/")[-1])
+    if version is None:
+        raise PackageError("Could not parse version out of '%s'." % link.split("/")[-1])
+    return Release(ide, edition, jdk, version.group(), link, downloadInfo.get("checksumLink"),
+                   downloadInfo.get("size"))
+
+
+# Compares the newest release with the installed version, installed is the result of
+# dpkgstatus.get_installed() and read from dpkg's status file if not given
+def check_installed(ide, edition, jdk=True, config=None, log=logger, installed=None):
+    if config is None:
+        config = Config()
+    if installed is None:
+        installed = dpkgstatus.get_installed(log)
+        if installed is None:
+            raise PackageError("Could not read %s." % dpkgstatus.statusFile)
+    release = resolve_release(ide, edition, jdk, config, log)
+    packageName = get_package_name(ide, edition, log, config.dataDir)
+    if packageName is None:
+        raise PackageError("Could not check %s %s." % (ide, edition))
+    return CheckResult(release, packageName, installed.get(packageName))
+
+
+def write_metrics(runMetrics, code, config, log):
+    records = runMetrics.finish(code)
+    if config.metricsJSON is not None:
+        metrics.write_json(config.metricsJSON, records, log)
+    if config.metricsProm is not None:
+        metrics.write_prom(config.metricsProm, records, ["ide", "edition", "java"], log)
+    return records
+
+
+# Removes tmpDir in the background, the default tmp/ goes away with the last build but a --workdir is kept
+def remove_tmp(tmpDir, config, log):
+    if not workspace.remove(tmpDir, log, config.workDir is None):
+        log.error("%s does exist and can not be deleted." % tmpDir)
+        return False
+    return True
+
+
+# Raises PackageError if there is not enough space for the build in config.tmpDir. The size of the archive is taken
+# from the release or the Content-Length, the unpacked size is estimated out of it.
+def check_space(release, config, log):
+    size = release.size
+    if not size:
+        probed = download.probe(release.link, log)
+        size = probed[0] if probed is not None else -1
+    if size <= 0:
+        log.warning("Size of '%s' is unknown, not checking the free space in %s." % (release.link, config.tmpDir))
+        return
+    # the archive is written unless it is streamed without the download cache, to the cache or to tmpDir
+    archive = not config.stream or (not config.noCache and release.checksumLink is not None)
+    if not workspace.check_space(config.tmpDir, workspace.get_needed(size, archive), log):
+        raise PackageError("Not enough free space in %s for %s %s." % (config.tmpDir, release.ide, release.edition))
+
+
+# Creates output and the tmp folders of a build, checks that all data files of ide exist
+def prepare_folders(ide, tmpDir, config, log):
+    if not util.check_folder(config.outputDir, log, False, True):
+        if not util.create_folder(config.outputDir):
+            raise PackageError("%s does not exist and can not be created." % config.outputDir)
+
+    # leftovers of an earlier build are deleted in the background
+    if not workspace.remove(tmpDir, log):
+        raise PackageError("%s does exist and can not be deleted." % tmpDir)
+    workspace.clean_stale(config.tmpDir, log)
+
+    for folder in [tmpDir,
+                   os.path.join(tmpDir, "root", "usr", "share", "jetbrains", ide),
+                   os.path.join(tmpDir, "root", "usr", "share", "applications"),
+                   os.path.join(tmpDir, "root", "usr", "bin"),
+                   os.path.join(tmpDir, "root", "etc", ide),
+                   os.path.join(tmpDir, "root", "etc", "sysctl.d"),
+                   os.path.join(tmpDir, "root", "DEBIAN")]:
+        if not util.create_folder(folder):
+            raise PackageError("%s can not be created." % folder)
+
+    for folder in [config.dataDir, os.path.join(config.dataDir, ide), os.path.join(config.dataDir, ide, "debian")]:
+        if not util.check_folder(folder, log, False, False):
+            raise PackageError("%s does not exist." % folder)
+
+    # Checking files
+    for file in ["control.in", "postinst", "sysctl-99.conf"]:
+        if not util.check_file_exists(os.path.join(config.dataDir, ide, "debian", file)) and not \
+                util.check_file_readable(os.path.join(config.dataDir, ide, "debian", file)):
+            raise PackageError("%s does not exist or is not readable." % file)
+
+    for file in ["LICENSE", "Makefile", "pkginfo.in", "prototype.in", "icon.desktop", "start.sh", "vmoptions.README"]:
+        if not util.check_file_exists(os.path.join(config.dataDir, ide, file)) and not \
+                util.check_file_readable(os.path.join(config.dataDir, ide, file)):
+            raise PackageError("%s does not exist or is not readable." % file)
+
+
+# sha256 of the archive of release, the download cache is not used if it is None
+def fetch_checksum(release, config, log):
+    if config.noCache:
+        return None
+    if release.checksumLink is None:
+        log.warning("No checksum available for '%s', not using the download cache." % release.link)
+        return None
+    checksum = cache.fetch_checksum(release.checksumLink, log)
+    if checksum is None:
+        log.warning("Could not get checksum for '%s', not using the download cache." % release.link)
+    return checksum
+
+
+# Unpacks the archive of release to ideDir, from the tree cache, the download cache or the network. checksum is the
+# one of fetch_checksum().
+def unpack(release, checksum, ideDir, tmpDir, config, runMetrics, log, hook, contents):
+    link = release.link
+    # md5 and size of every file are recorded while it is written, paths are relative to the package root
+    ideRel = os.path.relpath(ideDir, os.path.join(tmpDir, "root"))
+
+    def record(name, digest, size):
+        contents.add(os.path.join(ideRel, name), digest, size)
+
+    # Look up the archive in the download cache
+    archive = None
+    if checksum is not None:
+        archive = cache.lookup(config.cacheDir, checksum)
+
+    # Paths of the pruning profile are skipped while unpacking, they are never written
+    profile = None
+    variant = None
+    exclude = None
+    if config.prune is not None:
+        profile = prune.load_profile(config.dataDir, release.ide, config.prune, log)
+        if profile is None:
+            raise PackageError("Could not load the pruning profile '%s' of %s, available are %s." %
+                               (config.prune, release.ide,
+                                ", ".join(prune.get_profiles(config.dataDir, release.ide)) or "none"))
+        variant = "prune-%s" % profile.get_key()
+        exclude = profile.exclude
+
+    # Unpacked trees of known archives are taken from the cache, download and unpacking are skipped then
+    treeCached = False
+    if checksum is not None:
+        runMetrics.begin("cache")
+        treeCached = cache.populate_tree(config.cacheDir, checksum, ideDir, log, variant=variant, record=record)
+        if treeCached and profile is not None:
+            info = cache.load_tree_info(config.cacheDir, checksum, variant) or {}
+            profile.files = info.get("pruned_files", 0)
+            profile.bytes = info.get("pruned_bytes", 0)
+
+    if not treeCached:
+        # Download URL and unpack it
+        if config.stream:
+            unpacked = "extract" if archive is not None else "download_extract"
+            runMetrics.begin(unpacked)
+            if archive is not None:
+                result = extract.extract_file(archive, ideDir, log, 1, config.extractThreads, exclude, record)
+            elif checksum is not None:
+                result = cache.stream_extract(link, config.cacheDir, checksum, ideDir, log, 1, hook,
+                                              config.extractThreads, exclude, record)
+            else:
+                result = extract.stream_extract(link, ideDir, log, 1, hook, config.extractThreads, exclude,
+                                                record)
+            if not result:
+                raise PackageError("Error while downloading and unpacking '%s' to '%s'." % (link, ideDir))
+            if archive is None:
+                runMetrics.add("bytes", release.size or 0)
+        else:
+            if archive is None:
+                runMetrics.begin("download")
+                if checksum is not None:
+                    archive = cache.download(link, config.cacheDir, checksum, log, hook, config.connections)
+                    if archive is None:
+                        raise PackageError("Error while downloading '%s' to '%s'." % (link, config.cacheDir))
+                else:
+                    # the workspace is deleted after every build, a download without the cache is not resumed
+                    archive = os.path.join(tmpDir, link.split("/")[-1])
+                    if util.check_file_exists(archive):
+                        if not util.delete_file(archive, log, False):
+                            raise PackageError("%s does exist and can not be deleted." % archive)
+
+                    if not download.ranged_download(link, archive, log, config.connections, hook=hook):
+                        raise PackageError("Error while downloading '%s'." % archive)
+                runMetrics.add("bytes", os.path.getsize(archive))
+
+            unpacked = "extract"
+            runMetrics.begin(unpacked)
+            if not extract.extract_file(archive, ideDir, log, 1, config.extractThreads, exclude, record):
+                raise PackageError("Error while unpacking '%s' to '%s'." % (archive, ideDir))
+        runMetrics.end()
+        runMetrics.add("files", metrics.count_files(ideDir)[0], unpacked)
+
+        if checksum is not None:
+            runMetrics.begin("cache")
+            info = None
+            if profile is not None:
+                info = {"pruned_files": profile.files, "pruned_bytes": profile.bytes}
+            if not cache.store_tree(config.cacheDir, checksum, ideDir, log, variant, info,
+                                    contents.get_digests(ideRel)):
+                log.warning("Could not store unpacked tree in cache %s." % config.cacheDir)
+
+    if profile is not None:
+        log.info("Pruned %d files (%s) with profile %s." % (profile.files, util.format_size(profile.bytes),
+                                                             profile.name))
+        runMetrics.set("prune_profile", profile.name)
+        runMetrics.set("pruned_files", profile.files)
+        runMetrics.set("pruned_bytes", profile.bytes)
+
+    if checksum is not None:
+        runMetrics.begin("cache")
+        treeKey = cache.get_tree_key(checksum, variant)
+        if not cache.evict(config.cacheDir, config.cacheSize * 1024 * 1024, log,
+                           [os.path.join(cache.get_archive_dir(config.cacheDir), checksum),
+                            os.path.join(cache.get_tree_dir(config.cacheDir), treeKey)]):
+            log.warning("Could not shrink download cache %s." % config.cacheDir)
+
+
+# Keeps the original vmoptions in the README and drops the profiler agent from the vmoptions
+def fix_vmoptions(ide, tmpDir, log):
+    readme = os.path.join(tmpDir, "root", "etc", ide, "%s.vmoptions.README" % ide)
+    vmoptions = os.path.join(tmpDir, "root", "usr", "share", "jetbrains", ide, "bin", "%s.vmoptions" % ide)
+    try:
+        with open(readme, "a") as file1, open(vmoptions, "r") as file2, open(vmoptions + "2", "w") as file3:
+            file1.write("\nOriginal pycharm.vmoptions:\n")
+            for line in file2:
+                file1.write(line)
+                if "yjpagent" not in line:
+                    file3.write(line)
+    except OSError:
+        raise PackageError("Error while fixing '%s'." % vmoptions)
+    if not util.move_file(vmoptions + "2", vmoptions, log):
+        raise PackageError("Error while moving '%s' to '%s'." % (vmoptions + "2", vmoptions))
+
+
+# Copies files that need fixes (inserts ide name etc.)
+def fill_templates(ide, edition, version, tmpDir, config, log):
+    copyList = [[os.path.join(config.dataDir, ide, "debian", "postinst"),
+                 os.path.join(tmpDir, "root", "DEBIAN", "postinst")],
+                [os.path.join(config.dataDir, ide, "debian", "templates"),
+                 os.path.join(tmpDir, "root", "DEBIAN", "templates")],
+                [os.path.join(config.dataDir, ide, "debian", "control.in"),
+                 os.path.join(tmpDir, "root", "DEBIAN", "control")]
+                ]
+
+    for copyTuple in copyList:
+        # Check is destination exists
+        if util.check_file_exists(copyTuple[1]):
+            if not util.delete_file(copyTuple[1], log, False):
+                raise PackageError("%s does exist and can not be deleted." % copyTuple[1])
+
+        otherEdition = 'community'
+        oldEdition = 'iu'
+        otherOldEdition = 'ic'
+        if edition == otherEdition:
+            otherEdition = 'professional'
+            oldEdition = "ic"
+            otherOldEdition = 'iu'
+        try:
+            with open(copyTuple[0], "r") as file1, open(copyTuple[1], "w") as file2:
+                for line in file1:
+                    file2.write(
+                        line.replace("OTHER_EDITION2", otherEdition.upper())
+                            .replace("OTHER_EDITION", otherEdition)
+                            .replace("VERSION", version)
+                            .replace("EDITION2", edition.upper())
+                            .replace("EDITION", edition)
+                            .replace("OLD1", oldEdition)
+                            .replace("OLD2", oldEdition.upper())
+                            .replace("OLD3", otherOldEdition)
+                            .replace("OLD4", otherOldEdition.upper()))
+        except OSError:
+            raise PackageError("Error while writing '%s' from '%s'." % (copyTuple[1], copyTuple[0]))
+
+
+# Builds tmpDir/root into deb, with fakeroot and dpkg-deb or in-process with --native
+def build_deb(tmpDir, deb, compressor, compressLevel, config, runMetrics, log):
+    if config.native:
+        runMetrics.begin("build_deb")
+        if not debwriter.build_deb(os.path.join(tmpDir, "root"), deb, log, compressor, compressLevel,
+                                   config.compressThreads):
+            raise PackageError("Error while building '%s'." % deb)
+        return
+
+    if util.check_file_exists(os.path.join(tmpDir, "fakeroot.save")):
+        if not util.delete_file(os.path.join(tmpDir, "fakeroot.save"), log, False):
+            raise PackageError("%s does exist and can not be deleted." % os.path.join(tmpDir, "fakeroot.save"))
+
+    file1 = open(os.path.join(tmpDir, "fakeroot.save"), "w")
+    file1.write("")
     file1.close()
-    file2.close()
-
-# Chmod Start Skript and sysctl
-for file in [os.path.join(util.get_script_path(), "tmp", "root", "usr", "bin", args.ide),
-             os.path.join(util.get_script_path(), "tmp", "root", "etc", "sysctl.d", "99-%s.conf" % args.ide),
-             os.path.join(util.get_script_path(), "tmp", "root", "DEBIAN", "postinst")]:
-    if not util.run_cmd("chmod +rx %s" % file, logger, False):
-        logger.error("Error while running chmod +rx on '%s'." % file)
-        cleanup(-1, logger)
-
-if util.check_file_exists(os.path.join(util.get_script_path(), "tmp", "fakeroot.save")):
-    if not util.delete_file(os.path.join(util.get_script_path(), "tmp", "fakeroot.save"), logger, False):
-        cleanup(-1, logger)
-
-file1 = open(os.path.join(util.get_script_path(), "tmp", "fakeroot.save"), "w")
-file1.write("")
-file1.close()
-
-# package it!
-cmd = "fakeroot -i %s -s %s -- chown -R root:root %s" % (os.path.join(util.get_script_path(), "tmp", "fakeroot.save"),
-                                                         os.path.join(util.get_script_path(), "tmp", "fakeroot.save"),
-                                                         os.path.join(util.get_script_path(), "tmp", "root"))
-if not util.run_cmd(cmd, logger, False):
-    logger.error("Error while exexuting '%s'." % cmd)
-    cleanup(-1, logger)
-
-cmd = "fakeroot -i %s -s %s -- dpkg-deb -b %s %s" % (os.path.join(util.get_script_path(), "tmp", "fakeroot.save"),
-                                                     os.path.join(util.get_script_path(), "tmp", "fakeroot.save"),
-                                                     os.path.join(util.get_script_path(), "tmp", "root"),
-                                                     os.path.join(util.get_script_path(),
-                                                                  "tmp", "%s-%s-%s.deb"
-                                                                  % (args.ide, args.edition, version.group())))
-if not util.run_cmd(cmd, logger, False):
-    logger.error("Error while exexuting '%s'." % cmd)
-    cleanup(-1, logger)
-
-# copy package
-if not util.check_file_exists(
-        os.path.join(util.get_script_path(), "tmp", "%s-%s-%s.deb" % (args.ide, args.edition, version.group()))):
-    logger.error("Error '%s' was not created." %
-                 os.path.join(util.get_script_path(),
-                              "tmp", "%s-%s-%s.deb" % (args.ide, args.edition, version.group())))
-    cleanup(-1, logger)
-
-if not util.copy_file(
-        os.path.join(util.get_script_path(), "tmp", "%s-%s-%s.deb" % (args.ide, args.edition, version.group())),
-        os.path.join(util.get_script_path(), "output", "%s-%s-%s.deb" % (args.ide, args.edition, version.group())),
-        logger):
-    cleanup(-1, logger)
-
-# cleanup
-# if util.check_file_exists(os.path.join(util.get_script_path(), "tmp", "fakeroot.save")):
-#     if not util.delete_file(os.path.join(util.get_script_path(), "tmp", "fakeroot.save"), logger, False):
-#         cleanup(-1, logger)
-
-print("Finished packaging %s to %s. Install now with dpkg -i %s."
-      % (args.ide,
-         os.path.join(util.get_script_path(), "output", "%s-%s-%s.deb" % (args.ide, args.edition, version.group())),
-         os.path.join(util.get_script_path(), "output", "%s-%s-%s.deb" % (args.ide, args.edition, version.group()))))
-cleanup(0, logger)
-sys.exit(0)
+
+    runMetrics.begin("chown")
+    cmd = "fakeroot -i %s -s %s -- chown -R root:root %s" % (os.path.join(tmpDir, "fakeroot.save"),
+                                                             os.path.join(tmpDir, "fakeroot.save"),
+                                                             os.path.join(tmpDir, "root"))
+    if not util.run_cmd(cmd, log, False):
+        raise PackageError("Error while exexuting '%s'." % cmd)
+
+    runMetrics.begin("dpkg_deb")
+    # --threads-max only if threads were asked for, dpkg-deb picks them itself otherwise
+    threads = ""
+    if (config.compressThreads or 0) > 0 and compression.dpkg_deb_has_threads():
+        threads = " --threads-max=%d" % config.compressThreads
+    elif (config.compressThreads or 0) > 0:
+        log.warning("dpkg-deb does not support --threads-max, ignoring --compress-threads.")
+    cmd = "fakeroot -i %s -s %s -- dpkg-deb -Z%s -z%d%s -b %s %s" % \
+          (os.path.join(tmpDir, "fakeroot.save"),
+           os.path.join(tmpDir, "fakeroot.save"),
+           compressor, compressLevel, threads,
+           os.path.join(tmpDir, "root"), deb)
+    if not util.run_cmd(cmd, log, False):
+        raise PackageError("Error while exexuting '%s'." % cmd)
+
+
+# Everything of a build up to packaging: tmpDir/root is complete afterwards. Returns the release and the
+# controlfiles.Contents of tmpDir/root.
+def stage_build(ide, edition, jdk, tmpDir, config, runMetrics, log, hook):
+    # Checking tools, only the ones the chosen mode runs
+    tools = []
+    if not config.native:
+        tools = ["fakeroot", "dpkg-deb"]
+    for tool in tools:
+        if not util.cmd_exists(tool):
+            raise PackageError("%s not found or not usable." % tool)
+    if config.compress not in ('auto', 'none') and not compression.is_available(config.compress, config.native):
+        raise PackageError("%s can not be used for the package, %s." %
+                           (config.compress, "zstd is not installed" if config.native else
+                            "dpkg-deb does not support it (zstd needs dpkg 1.21.18), use --native"))
+
+    # Get URL
+    runMetrics.begin("metadata")
+    release = resolve_release(ide, edition, jdk, config, log)
+    version = release.version
+    runMetrics.set("version", version)
+    checksum = fetch_checksum(release, config, log)
+
+    # Checking folders and free space
+    runMetrics.begin("prepare")
+    check_space(release, config, log)
+    prepare_folders(ide, tmpDir, config, log)
+
+    ideDir = os.path.join(tmpDir, "root", "usr", "share", "jetbrains", ide)
+    contents = controlfiles.Contents()
+    unpack(release, checksum, ideDir, tmpDir, config, runMetrics, log, hook, contents)
+
+    # Copy Files
+    runMetrics.begin("copy")
+    copyList = [[os.path.join(config.dataDir, ide, "start.sh"),
+                 os.path.join(tmpDir, "root", "usr", "bin", ide)],
+                [os.path.join(config.dataDir, ide, "icon.desktop"),
+                 os.path.join(tmpDir, "root", "usr", "share", "applications", "%s.desktop" % ide)],
+                [os.path.join(config.dataDir, ide, "vmoptions.README"),
+                 os.path.join(tmpDir, "root", "etc", ide, "%s.vmoptions.README" % ide)],
+                [os.path.join(config.dataDir, ide, "debian", "sysctl-99.conf"),
+                 os.path.join(tmpDir, "root", "etc", "sysctl.d", "99-%s.conf" % ide)],
+                ]
+
+    for copyTuple in copyList:
+        if not util.copy_file(copyTuple[0], copyTuple[1], log):
+            raise PackageError("Error while copying '%s' to '%s'." % (copyTuple[0], copyTuple[1]))
+
+    # Fixing vmoptions file(s)
+    runMetrics.begin("vmoptions")
+    fix_vmoptions(ide, tmpDir, log)
+
+    # Hash what was copied or changed after unpacking, the rest was hashed while it was written
+    runMetrics.begin("md5sums")
+    changed = [os.path.relpath(copyTuple[1], os.path.join(tmpDir, "root")) for copyTuple in copyList]
+    changed.append(os.path.join(os.path.relpath(ideDir, os.path.join(tmpDir, "root")), "bin", "%s.vmoptions" % ide))
+    try:
+        contents.hash_files(os.path.join(tmpDir, "root"), changed)
+    except OSError:
+        log.error("Error while hashing the files in %s." % os.path.join(tmpDir, "root"), exc_info=True)
+        raise PackageError("Error while hashing the files in %s." % os.path.join(tmpDir, "root"))
+
+    runMetrics.begin("templates")
+    fill_templates(ide, edition, version, tmpDir, config, log)
+
+    # Chmod Start Skript and sysctl
+    for file in [os.path.join(tmpDir, "root", "usr", "bin", ide),
+                 os.path.join(tmpDir, "root", "etc", "sysctl.d", "99-%s.conf" % ide),
+                 os.path.join(tmpDir, "root", "DEBIAN", "postinst")]:
+        if not util.run_cmd("chmod +rx %s" % file, log, False):
+            raise PackageError("Error while running chmod +rx on '%s'." % file)
+    return release, contents
+
+
+# Packages tmpDir/root to config.outputDir and writes delta and APT repository, returns the BuildResult.
+# md5sums, conffiles and Installed-Size are written to tmpDir/root/DEBIAN out of contents first.
+def finish_build(release, contents, tmpDir, config, runMetrics, log, writeDelta=None):
+    ide, edition, version = release.ide, release.edition, release.version
+    if writeDelta is None:
+        writeDelta = config.delta
+
+    runMetrics.begin("control")
+    if not controlfiles.write(os.path.join(tmpDir, "root"), contents, ["/etc/%s" % ide, "/etc/sysctl.d"], log):
+        raise PackageError("Error while writing the control files to %s." % os.path.join(tmpDir, "root", "DEBIAN"))
+    runMetrics.set("installed_size", contents.get_installed_size())
+
+    # Choose compression
+    compressor = config.compress
+    compressLevel = config.compressLevel
+    if compressor == 'auto':
+        runMetrics.begin("compress_benchmark")
+        # only what dpkg-deb can write as well unless the package is written natively, and no zstd from dpkg-deb
+        # if a delta is wanted (see delta.create)
+        candidates = [candidate for candidate in compression.get_candidates(config.native)
+                      if config.native or not writeDelta or candidate[0] != 'zstd']
+        chosen, benchmarks = compression.choose(os.path.join(tmpDir, "root"), config.compressPrefer,
+                                                config.compressThreads, log, candidates)
+        compressor = chosen[0]
+        if compressLevel is None:
+            compressLevel = chosen[1]
+        log.info("Using %s -%d for the package (preferring %s)." % (compressor, compressLevel,
+                                                                     config.compressPrefer))
+    if compressLevel is None:
+        compressLevel = compression.defaultLevels[compressor]
+
+    # package it!
+    debName = "%s-%s-%s.deb" % (ide, edition, version)
+    build_deb(tmpDir, os.path.join(tmpDir, debName), compressor, compressLevel, config, runMetrics, log)
+
+    # move package to output
+    runMetrics.begin("output")
+    if not util.check_file_exists(os.path.join(tmpDir, debName)):
+        raise PackageError("Error '%s' was not created." % os.path.join(tmpDir, debName))
+
+    if not util.move_file(os.path.join(tmpDir, debName), os.path.join(config.outputDir, debName), log):
+        raise PackageError("Error while moving '%s' to '%s'." % (os.path.join(tmpDir, debName), config.outputDir))
+
+    result = BuildResult(release, os.path.join(config.outputDir, debName))
+    result.compressor = compressor
+    result.compressLevel = compressLevel
+    runMetrics.set("package_bytes", os.path.getsize(result.path))
+    if runMetrics.get("prune_profile") is not None:
+        result.pruned = {"profile": runMetrics.get("prune_profile"), "files": runMetrics.get("pruned_files"),
+                         "bytes": runMetrics.get("pruned_bytes")}
+
+    if writeDelta and compressor == 'zstd' and not config.native:
+        log.warning("No delta was written for %s, delta.py apply can not compress zstd the same way as dpkg-deb. "
+                    "Build with --native to get deltas of zstd packages." % result.path)
+    elif writeDelta:
+        runMetrics.begin("delta")
+        previous = delta.find_previous(config.outputDir, "%s-%s-" % (ide, edition), version)
+        if previous is None:
+            log.warning("No older package of %s %s in %s, no delta was written." % (ide, edition, config.outputDir))
+        else:
+            deltaPath = os.path.join(config.outputDir, delta.get_delta_name(previous, version))
+            result.deltaStats = delta.create(previous, result.path, deltaPath, log, compressLevel,
+                                             config.compressThreads, tmpDir, config.native)
+            if result.deltaStats is None:
+                raise PackageError("Error while writing the delta of '%s' against '%s'." % (result.path, previous))
+            result.delta = deltaPath
+            runMetrics.set("delta_bytes", result.deltaStats["size"])
+
+    if config.aptRepo is not None:
+        runMetrics.begin("apt_repo")
+        result.published = aptrepo.publish(config.aptRepo, result.path, log, config.aptLayout, config.aptKeep)
+        if result.published is None:
+            raise PackageError("Error while publishing '%s' to '%s'." % (result.path, config.aptRepo))
+    return result
+
+
+def start_build(ide, edition, jdk, config):
+    # the free space is sampled where the build is staged
+    return metrics.Metrics({"ide": ide, "edition": edition, "java": "y" if jdk else "n"},
+                           config.tmpDir if os.path.isdir(config.tmpDir) else config.baseDir)
+
+
+# Deletes tmpDir and writes the metrics of the build, returns the metrics records
+def end_build(tmpDir, runMetrics, success, config, log):
+    runMetrics.begin("cleanup")
+    removed = remove_tmp(tmpDir, config, log)
+    records = write_metrics(runMetrics, 0 if success and removed else -1, config, log)
+    if not removed:
+        raise PackageError("%s does exist and can not be deleted." % tmpDir)
+    return records
+
+
+def set_records(result, records):
+    result.records = records
+    result.timings = dict((record["phase"], record["seconds"]) for record in records)
+
+
+# Downloads and packages the newest release of ide/edition to config.outputDir. Raises PackageError if that is
+# not possible. hook gets the download progress like urlretrieve's reporthook, None disables it.
+def build_package(ide, edition, jdk=True, config=None, log=logger, hook=util.progress_hook):
+    check_supported(ide, edition)
+    if config is None:
+        config = Config()
+    tmpDir = config.get_tmp_dir(ide, edition, jdk)
+    runMetrics = start_build(ide, edition, jdk, config)
+    result = None
+    try:
+        release, contents = stage_build(ide, edition, jdk, tmpDir, config, runMetrics, log, hook)
+        result = finish_build(release, contents, tmpDir, config, runMetrics, log)
+    finally:
+        records = end_build(tmpDir, runMetrics, result is not None, config, log)
+    set_records(result, records)
+    return result
+
+
+# One job of batch or watch mode, runs in a build process of their pool. Returns the path of the package.
+def build_job(ide, edition, java, config):
+    return build_package(ide, edition, java != 'n', config, logger, None).path
+
+
+# Builds the jobs (list of [ide, edition, java]) together. Files that are identical in several of the packages go
+# into one jetbrains-common-<hash> package, the others get symlinks to them and depend on it. Returns
+# (list of BuildResult, BuildResult of the common package or None), result.shared of the common package has the
+# statistics of common.share(). Raises PackageError if one build fails, they are only useful together.
+def build_shared_packages(jobs, config=None, log=logger, concurrency=batch.defaultJobs):
+    if config is None:
+        config = Config()
+    if len(jobs) < 2:
+        raise PackageError("Sharing files needs at least two IDEs/editions.")
+    for ide, edition, java in jobs:
+        check_supported(ide, edition)
+    builds = []
+    commonTmpDir = os.path.join(config.tmpDir, "jetbrains-common")
+    commonMetrics = None
+    results = None
+    commonResult = None
+    try:
+        for ide, edition, java in jobs:
+            builds.append([ide, edition, java != 'n', config.get_tmp_dir(ide, edition, java != 'n'),
+                           start_build(ide, edition, java != 'n', config)])
+        commonMetrics = start_build("jetbrains-common", "shared", True, config)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            staged = list(executor.map(lambda build: stage_build(build[0], build[1], build[2], build[3], config,
+                                                                 build[4], log, None), builds))
+
+        commonMetrics.begin("share")
+        if not workspace.remove(commonTmpDir, log):
+            raise PackageError("%s does exist and can not be deleted." % commonTmpDir)
+        trees = {}
+        controls = {}
+        stagedContents = {}
+        for build, (release, contents) in zip(builds, staged):
+            name = "%s %s%s" % (get_package_name(build[0], build[1], log, config.dataDir), release.version,
+                                "" if build[2] else " (without java)")
+            trees[name] = os.path.join(build[3], "root", "usr", "share", "jetbrains", build[0])
+            controls[name] = os.path.join(build[3], "root", "DEBIAN", "control")
+            stagedContents[name] = (contents, os.path.relpath(trees[name], os.path.join(build[3], "root")))
+        commonContents = controlfiles.Contents()
+        try:
+            shared = common.share(trees, os.path.join(commonTmpDir, "root"), log)
+            if shared is not None:
+                # the md5sums of the moved files go to the common package, the packages keep symlinks
+                for kind, path, paths, size in shared["items"]:
+                    for name, userPath in paths.items():
+                        contents, treeRel = stagedContents[name]
+                        taken = contents.take(os.path.join(treeRel, userPath))
+                        contents.add(os.path.join(treeRel, userPath), None, 0)
+                        if name == sorted(paths.keys())[0]:
+                            for subPath, digest, fileSize in taken:
+                                commonContents.add(os.path.join(shared["dir"].lstrip("/"), path, subPath), digest,
+                                                   fileSize)
+                for name in shared["users"]:
+                    common.add_depends(controls[name], shared["name"])
+                os.makedirs(os.path.join(commonTmpDir, "root", "DEBIAN"))
+                common.write_control(os.path.join(commonTmpDir, "root", "DEBIAN", "control"), shared["name"],
+                                     shared["users"], controls[shared["users"][0]])
+        except OSError:
+            log.error("Error while moving shared files to %s." % commonTmpDir, exc_info=True)
+            raise PackageError("Error while moving shared files to %s." % commonTmpDir)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            results = list(executor.map(lambda pair: finish_build(pair[1][0], pair[1][1], pair[0][3], config,
+                                                                  pair[0][4], log), zip(builds, staged)))
+        if shared is not None:
+            commonRelease = Release("jetbrains", shared["name"][len("jetbrains-"):], True, common.packageVersion,
+                                    None)
+            commonResult = finish_build(commonRelease, commonContents, commonTmpDir, config, commonMetrics, log,
+                                        False)
+            commonResult.shared = shared
+    finally:
+        # every build that was started is ended (and its sampler stopped), even if one workspace can not be removed
+        failed = None
+        for build in builds:
+            try:
+                records = end_build(build[3], build[4], results is not None, config, log)
+            except PackageError as error:
+                failed = error
+                continue
+            if results is not None:
+                set_records(results[builds.index(build)], records)
+        if commonMetrics is not None:
+            try:
+                records = end_build(commonTmpDir, commonMetrics, results is not None, config, log)
+                if commonResult is not None:
+                    set_records(commonResult, records)
+            except PackageError as error:
+                failed = error
+        if failed is not None:
+            raise failed
+    return results, commonResult
+
+
+def get_config(args):
+    return Config(work_dir=args.workdir, cache_dir=args.cache_dir, cache_size=args.cache_size, no_cache=args.no_cache,
+                  metadata_ttl=args.metadata_ttl, releases_url=args.releases_url, connections=args.connections,
+                  stream=args.stream, extract_threads=args.extract_threads, native=args.native,
+                  compress=args.compress, compress_level=args.compress_level, compress_threads=args.compress_threads,
+                  compress_prefer=args.compress_prefer, apt_repo=args.apt_repo, apt_layout=args.apt_layout,
+                  apt_keep=args.apt_keep, delta=args.delta, prune=args.prune, metrics_json=args.metrics_json,
+                  metrics_prom=args.metrics_prom)
+
+
+# Jobs of --matrix or of all given IDEs and editions, None if the matrix file is invalid
+def get_jobs(args, log):
+    if args.matrix is not None:
+        return batch.parse_matrix(args.matrix, supportedIDEs.keys(), supportedEditions, log)
+    return batch.get_jobs(args.ide, args.edition, args.java)
+
+
+def get_parser():
+    # Configure ArgumentParser
+    parser = argparse.ArgumentParser(prog="package.py", epilog="Supported IDEs: %s\nSupported Editions: %s"
+                                                               % (list(supportedIDEs.keys()), supportedEditions),
+                                     description="Packages Jetbrains IDEs for Debian/Ubuntu.",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-e", "--edition", metavar="EDITION", default=supportedEditions[:1],
+                        type=choice_list(supportedEditions),
+                        help="Which Edition should be packaged? Several editions can be given separated by commas.")
+    parser.add_argument("-i", "--ide", metavar="IDE", default=list(supportedIDEs.keys())[:1],
+                        type=choice_list(list(supportedIDEs.keys())),
+                        help="Which IDE should be packaged? Several IDEs can be given separated by commas.")
+    parser.add_argument("-j", "--java", metavar="JAVA", choices={'y','n'}, default='y',
+                        help="Which IDE should be packaged?")
+    parser.add_argument("-s", "--stream", action='store_true',
+                        help="unpack while downloading instead of saving the archive to tmp first")
+    parser.add_argument("--workdir", metavar="DIR",
+                        help="stage the builds in DIR (e.g. a tmpfs or a fast disk) instead of tmp/ next to "
+                             "package.py")
+    parser.add_argument("--extract-threads", metavar="N", type=int, default=0,
+                        help="threads that write the unpacked files, 0 picks a default for the machine "
+                             "(default: %(default)s)")
+    parser.add_argument("--native", action='store_true',
+                        help="build the .deb in-process with root ownership instead of running fakeroot and dpkg-deb")
+    parser.add_argument("--compress", metavar="TYPE", default=compression.defaultCompressor,
+                        choices=compression.supportedCompressors + ['auto'],
+                        help="compression of the package payload: %s or auto (default: %%(default)s)"
+                             % ", ".join(compression.supportedCompressors))
+    parser.add_argument("--compress-level", metavar="LEVEL", type=int,
+                        help="compression level (gzip 1-9, xz 0-9, zstd 1-22), defaults to the level dpkg-deb uses "
+                             "for the compressor")
+    parser.add_argument("--compress-threads", metavar="N", type=int, default=0,
+                        help="threads used by xz and zstd, 0 uses all cores (default: %(default)s)")
+    parser.add_argument("--compress-prefer", metavar="GOAL", choices=['speed', 'size'], default='size',
+                        help="what --compress auto optimizes for: speed (e.g. CI builds) or size (e.g. releases) "
+                             "(default: %(default)s)")
+    parser.add_argument("--connections", metavar="N", type=int, default=download.defaultConnections,
+                        help="number of parallel connections used for downloading, an interrupted download is "
+                             "resumed if the cache is used (default: %(default)s)")
+    parser.add_argument("--cache-dir", metavar="DIR", default=cache.get_default_cache_dir(),
+                        help="where downloaded archives are cached (default: %(default)s)")
+    parser.add_argument("--cache-size", metavar="MB", type=int, default=cache.defaultCacheSize,
+                        help="maximum size of the download cache in MiB (default: %(default)s)")
+    parser.add_argument("--no-cache", action='store_true',
+                        help="do not use the download cache, interrupted downloads are not resumed")
+    parser.add_argument("--metadata-ttl", metavar="SECONDS", type=int, default=releases.defaultTTL,
+                        help="how long release information is used from the cache before it is revalidated "
+                             "(default: %(default)s)")
+    parser.add_argument("--releases-url", metavar="URL", default=newVersionURL,
+                        help="releases endpoint, %%s is replaced by the product codes (default: %(default)s)")
+    parser.add_argument("--apt-repo", metavar="DIR",
+                        help="also publish the package to the APT repository in DIR and update its indices")
+    parser.add_argument("--apt-layout", metavar="LAYOUT", choices=aptrepo.supportedLayouts,
+                        default=aptrepo.defaultLayout,
+                        help="flat (deb URL ./) or pool (deb URL %s %s) (default: %%(default)s)"
+                             % (aptrepo.defaultDist, aptrepo.defaultComponent))
+    parser.add_argument("--apt-keep", metavar="N", type=int, default=aptrepo.defaultKeep,
+                        help="versions of every package kept in the APT repository, 0 keeps all (default: %(default)s)")
+    parser.add_argument("--prune", metavar="PROFILE",
+                        help="leave out what data/<ide>/PROFILE.prune excludes (e.g. default or minimal), the paths "
+                             "are skipped while unpacking")
+    parser.add_argument("--delta", action='store_true',
+                        help="also write a delta against the newest older package in output/, delta.py apply "
+                             "rebuilds the package out of the older one and the delta")
+    parser.add_argument("--common", action='store_true',
+                        help="build all given IDEs/editions together and move files that are identical in several "
+                             "of them into a shared jetbrains-common-<hash> package")
+    parser.add_argument("--matrix", metavar="FILE",
+                        help="build all jobs listed in FILE, one '<ide> <edition> [y|n]' per line")
+    parser.add_argument("--jobs", metavar="N", type=int, default=batch.defaultJobs,
+                        help="number of builds that run at the same time in batch mode (default: %(default)s)")
+    parser.add_argument("--watch", action='store_true',
+                        help="keep running, poll for new versions of all given IDEs/editions and build them")
+    parser.add_argument("--watch-interval", metavar="SECONDS", type=int, default=watch.defaultInterval,
+                        help="seconds between two polls in watch mode (default: %(default)s)")
+    parser.add_argument("--watch-debounce", metavar="SECONDS", type=int, default=watch.defaultDebounce,
+                        help="a new version is built when it was seen for that long (default: %(default)s)")
+    parser.add_argument("--metrics-json", metavar="FILE",
+                        help="append the duration and throughput of every phase as json lines to FILE")
+    parser.add_argument("--metrics-prom", metavar="FILE",
+                        help="write the same metrics to FILE for the textfile collector of the Prometheus node "
+                             "exporter")
+    parser.add_argument("-l", "--list", action='store_true', help="list all supported IDEs")
+    parser.add_argument("-c", "--check", action='store_true',
+                        help="check if installed version is older than the newest version available "
+                             "(reads dpkg's status file)")
+    parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    levelError = compression.check_level(args.compress, args.compress_level)
+    if levelError is not None:
+        parser.error(levelError)
+
+    # Configure Logging
+    logLevel = logging.WARN
+    logging.basicConfig(level=logLevel)
+
+    if args.list:
+        print("Supported JetBrains IDEs:")
+        for key in supportedIDEs.keys():
+            print(key)
+        return 0
+
+    config = get_config(args)
+
+    # Watch mode, polls with conditional requests and builds new versions in a pool of processes
+    if args.watch:
+        jobs = get_jobs(args, logger)
+        if jobs is None:
+            return -1
+
+        def get_versions():
+            # revalidates the cached releases, the jobs below read them from memory
+            releases.get_releases(config.releasesURL, get_all_codes(), config.cacheDir, 0, logger)
+            versions = {}
+            for ide, edition, java in jobs:
+                try:
+                    versions[(ide, edition, java)] = resolve_release(ide, edition, java != 'n', config, logger,
+                                                                     args.watch_interval).version
+                except PackageError as error:
+                    logger.error(str(error))
+                    versions[(ide, edition, java)] = None
+            return versions
+
+        return watch.watch(jobs, get_versions, lambda ide, edition: get_package_name(ide, edition, logger,
+                                                                                     config.dataDir),
+                           functools.partial(build_job, config=config), config.cacheDir, args.watch_interval,
+                           args.watch_debounce, args.jobs, logger)
+
+    # Check all given IDEs and editions, only the status file of dpkg is read
+    if args.check:
+        jobs = get_jobs(args, logger)
+        if jobs is None:
+            return -1
+        installed = dpkgstatus.get_installed(logger)
+        if installed is None:
+            return -1
+        returncode = 0
+        checked = []
+        for ide, edition, java in jobs:
+            # the version does not depend on the bundled java
+            if (ide, edition) in checked:
+                continue
+            checked.append((ide, edition))
+            try:
+                result = check_installed(ide, edition, java != 'n', config, logger, installed)
+            except PackageError as error:
+                logger.error("Could not check %s %s: %s" % (ide, edition, error))
+                returncode = -1
+                continue
+            if not result.is_installed():
+                print("%s %s is not installed." % (ide, edition))
+            elif result.is_update():
+                print("There is a newer version of %s (%s) than installed (%s) available!" %
+                      (result.package, result.available, result.installed))
+                if returncode == 0:
+                    returncode = 1
+        return returncode
+
+    # there is nothing to share with a single package
+    if args.common:
+        jobs = get_jobs(args, logger)
+        if jobs is None:
+            return -1
+        if len(jobs) < 2:
+            logger.error("--common needs at least two IDEs/editions.")
+            return -1
+
+    # Batch mode, every job runs in a process of a pool, they share the release metadata through the cache file
+    if args.matrix is not None or len(args.ide) > 1 or len(args.edition) > 1:
+        jobs = get_jobs(args, logger)
+        if jobs is None:
+            return -1
+        # one lookup for all jobs, they find the answer in the cache afterwards
+        releases.get_releases(config.releasesURL, get_all_codes(), config.cacheDir, config.metadataTTL, logger)
+        if args.common:
+            try:
+                results, commonResult = build_shared_packages(jobs, config, logger, args.jobs)
+            except PackageError as error:
+                logger.error(str(error))
+                return -1
+            for result in results:
+                print("Finished packaging %s %s to %s." % (result.release.ide, result.release.edition, result.path))
+            if commonResult is None:
+                print("No files are shared between the packages.")
+            else:
+                print("Shared %s of %s in %s (saves %s)." % (util.format_size(commonResult.shared["bytes"]),
+                                                             ", ".join(commonResult.shared["users"]),
+                                                             commonResult.path,
+                                                             util.format_size(commonResult.shared["saved"])))
+            return 0
+        results = batch.run_batch(jobs, functools.partial(build_job, config=config), args.jobs)
+        batch.print_summary(results)
+        return batch.get_returncode(results)
+
+    try:
+        result = build_package(args.ide[0], args.edition[0], args.java != 'n', config, logger)
+    except PackageError as error:
+        logger.error(str(error))
+        return -1
+
+    if args.compress == 'auto':
+        print("Used %s -%d for the package (preferring %s)." % (result.compressor, result.compressLevel,
+                                                                args.compress_prefer))
+    if result.delta is not None:
+        print("Wrote %s (%s, %.1f%% of the package)." % (result.delta, util.format_size(result.deltaStats["size"]),
+                                                          result.deltaStats["size"] * 100.0 /
+                                                          max(1, result.deltaStats["packageSize"])))
+    if result.pruned is not None:
+        print("Pruned %d files (%s) with profile %s." % (result.pruned["files"],
+                                                         util.format_size(result.pruned["bytes"]),
+                                                         result.pruned["profile"]))
+    if result.published is not None:
+        print("Published %s to the APT repository %s." % (result.published, args.apt_repo))
+    print("Finished packaging %s to %s. Install now with dpkg -i %s." % (args.ide[0], result.path, result.path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import fnmatch
+import hashlib
+import json
+import os
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+extension = ".prune"
+hashLength = 12
+maxIncludes = 16  # include chains longer than that are a loop
+
+
+# Paths of an IDE that are not unpacked, read from data/<ide>/<name>.prune. Every line is one of
+#   exclude <glob>   path relative to the IDE folder, * and ? do not match /, ** matches any number of folders.
+#                    A matching folder is excluded with everything below it.
+#   plugin <name>    bundled plugin, the same as exclude plugins/<name>
+#   include <name>   everything of the profile data/<ide>/<name>.prune
+# Empty lines and lines starting with # are ignored. files and bytes count the regular files that were left out.
+class Profile(object):
+    def __init__(self, name, excludes, plugins):
+        self.name = name
+        self.excludes = excludes
+        self.plugins = plugins
+        self.patterns = [pattern.strip("/").split("/") for pattern in excludes] + \
+                        [["plugins", plugin] for plugin in plugins]
+        self.files = 0
+        self.bytes = 0
+
+    # Identifies what the profile excludes, unpacked trees of different profiles are cached separately
+    def get_key(self):
+        content = [sorted(set(self.excludes)), sorted(set(self.plugins))]
+        return hashlib.sha256(json.dumps(content).encode('utf-8')).hexdigest()[:hashLength]
+
+    def is_excluded(self, path):
+        parts = [part for part in path.split("/") if part not in ("", ".")]
+        return any(match_prefix(pattern, parts) for pattern in self.patterns)
+
+    # Called by extract.extract_stream for every member, size is None for directories, links etc.
+    def exclude(self, path, size):
+        if not self.is_excluded(path):
+            return False
+        if size is not None:
+            self.files += 1
+            self.bytes += size
+        return True
+
+
+# True if pattern (split at /) matches path (split at /) or one of the folders above it
+def match_prefix(pattern, parts):
+    if len(pattern) == 0:
+        return True
+    if pattern[0] == "**":
+        return any(match_prefix(pattern[1:], parts[index:]) for index in range(len(parts) + 1))
+    if len(parts) == 0:
+        return False
+    return fnmatch.fnmatchcase(parts[0], pattern[0]) and match_prefix(pattern[1:], parts[1:])
+
+
+def get_profile_path(data_dir, ide, name):
+    return os.path.join(data_dir, ide, name + extension)
+
+
+# Names of the profiles of ide
+def get_profiles(data_dir, ide):
+    try:
+        return sorted(name[:-len(extension)] for name in os.listdir(os.path.join(data_dir, ide))
+                      if name.endswith(extension))
+    except OSError:
+        return []
+
+
+def read_rules(data_dir, ide, name, logger, excludes, plugins, depth=0):
+    path = get_profile_path(data_dir, ide, name)
+    if depth > maxIncludes:
+        logger.error("Too many includes in %s." % path)
+        return False
+    try:
+        with open(path, "r") as file:
+            lines = file.read().split("\n")
+    except OSError:
+        logger.error("%s does not exist or is not readable." % path)
+        return False
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        fields = line.split(None, 1)
+        if len(fields) != 2 or fields[0] not in ("exclude", "plugin", "include"):
+            logger.error("Invalid line %d in %s: '%s'." % (number, path, line))
+            return False
+        keyword, value = fields[0], fields[1].strip()
+        if keyword == "include":
+            if not read_rules(data_dir, ide, value, logger, excludes, plugins, depth + 1):
+                return False
+        elif keyword == "plugin":
+            if "/" in value:
+                logger.error("Invalid plugin name in line %d of %s: '%s'." % (number, path, value))
+                return False
+            plugins.append(value)
+        else:
+            if ".." in value.split("/") or value.strip("/") == "":
+                logger.error("Invalid path in line %d of %s: '%s'." % (number, path, value))
+                return False
+            excludes.append(value)
+    return True
+
+
+# Reads the profile name of ide, returns None if it does not exist or is invalid
+def load_profile(data_dir, ide, name, logger):
+    excludes = []
+    plugins = []
+    if not read_rules(data_dir, ide, name, logger, excludes, plugins):
+        return None
+    return Profile(name, excludes, plugins)
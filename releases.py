@@ -0,0 +1,189 @@
+import gzip
+import http.client
+import json
+import os
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import util
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+defaultTTL = 600  # seconds
+maxRedirects = 5
+
+# Open keep-alive connections, key = (scheme, host:port)
+connections = {}
+# Builds of one process share the connections, a connection serves one request at a time
+connectionLock = util.ForkSafeLock()
+# Answers this process has already read or fetched, key = url, later builds do not parse the cache file again
+loaded = {}
+# mtime of the cache file when it was read or written by this process, key = url. A newer file was revalidated
+# by another process (e.g. the watch loop for its build processes), it is read again.
+loadedMTimes = {}
+
+
+# Build processes forked from a batch or watch process open their own connections
+def reset_connections():
+    connections.clear()
+
+
+os.register_at_fork(after_in_child=reset_connections)
+
+
+def get_cache_path(cache_dir):
+    return os.path.join(cache_dir, "releases.json")
+
+
+# GET on a pooled keep-alive connection, returns (status, headers, body). Redirects are followed, requests that
+# go through a proxy (http_proxy/https_proxy/no_proxy) are made with urllib.
+def http_get(url, headers, timeout=10):
+    for redirect in range(maxRedirects + 1):
+        if uses_proxy(url):
+            return urlopen_get(url, headers, timeout)
+        with connectionLock:
+            status, responseHeaders, body = pooled_get(url, headers, timeout)
+        if status not in (301, 302, 303, 307, 308) or responseHeaders.get("Location") is None:
+            return status, responseHeaders, body
+        url = urllib.parse.urljoin(url, responseHeaders["Location"])
+    raise http.client.HTTPException("More than %d redirects." % maxRedirects)
+
+
+def uses_proxy(url):
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme in urllib.request.getproxies().keys() and not urllib.request.proxy_bypass(parts.hostname)
+
+
+# Same as pooled_get with urlopen, which follows redirects and knows about proxies
+def urlopen_get(url, headers, timeout):
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+    except urllib.error.HTTPError as error:
+        # e.g. 304, the caller decides what to do with it
+        response = error
+    with response:
+        body = response.read()
+        if response.headers.get("Content-Encoding", "") == "gzip":
+            body = gzip.decompress(body)
+        return response.getcode(), response.headers, body
+
+
+def pooled_get(url, headers, timeout):
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    path = parts.path
+    if parts.query != "":
+        path += "?" + parts.query
+    for attempt in range(2):
+        connection = connections.get(key)
+        if connection is None:
+            if parts.scheme == "https":
+                connection = http.client.HTTPSConnection(parts.netloc, timeout=timeout)
+            else:
+                connection = http.client.HTTPConnection(parts.netloc, timeout=timeout)
+            connections[key] = connection
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError):
+            # the server may have closed an idle connection, retry once on a new one
+            connection.close()
+            connections.pop(key, None)
+            if attempt == 1:
+                raise
+            continue
+        if response.getheader("Connection", "").lower() == "close":
+            connection.close()
+            connections.pop(key, None)
+        if response.getheader("Content-Encoding", "") == "gzip":
+            body = gzip.decompress(body)
+        return response.status, response.headers, body
+
+
+def get_cache_mtime(cache_dir):
+    try:
+        return os.stat(get_cache_path(cache_dir)).st_mtime
+    except OSError:
+        return None
+
+
+def load_cache(cache_dir, url):
+    try:
+        with open(get_cache_path(cache_dir), "r") as file:
+            cached = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if cached.get("url") != url or "data" not in cached.keys():
+        return None
+    return cached
+
+
+def save_cache(cache_dir, cached, logger):
+    if not util.check_folder(cache_dir, logger, False, True):
+        if not util.create_folder(cache_dir):
+            logger.warning("%s does not exist and can not be created." % cache_dir)
+            return
+    try:
+        with open(get_cache_path(cache_dir) + ".%s" % util.get_tmp_suffix(), "w") as file:
+            json.dump(cached, file)
+        os.replace(get_cache_path(cache_dir) + ".%s" % util.get_tmp_suffix(), get_cache_path(cache_dir))
+        loadedMTimes[cached["url"]] = get_cache_mtime(cache_dir)
+    except OSError:
+        logger.warning("Could not write %s." % get_cache_path(cache_dir), exc_info=True)
+
+
+# Returns the parsed releases json for all codes with one request. Answers younger than ttl seconds are
+# taken from memory or cache_dir, older ones are revalidated with If-None-Match/If-Modified-Since.
+def get_releases(url_template, codes, cache_dir, ttl, logger):
+    url = url_template % ",".join(codes)
+    cached = loaded.get(url)
+    stored = None
+    if cache_dir is not None:
+        # another process may have revalidated the answer in the meantime
+        mtime = get_cache_mtime(cache_dir)
+        if cached is None or time.time() - cached["fetched"] >= ttl or mtime != loadedMTimes.get(url):
+            stored = load_cache(cache_dir, url)
+            loadedMTimes[url] = mtime
+        if stored is not None and (cached is None or stored.get("fetched", 0) > cached["fetched"]):
+            stored.setdefault("fetched", 0)
+            cached = stored
+            loaded[url] = cached
+    if cached is not None and time.time() - cached["fetched"] < ttl:
+        return cached["data"]
+    headers = {"Accept-Encoding": "gzip", "Accept": "application/json"}
+    if cached is not None:
+        if cached.get("etag") is not None:
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("lastModified") is not None:
+            headers["If-Modified-Since"] = cached["lastModified"]
+    try:
+        status, responseHeaders, body = http_get(url, headers)
+    except (http.client.HTTPException, OSError):
+        if cached is not None:
+            logger.warning("Error while opening %s, using cached releases from %s." %
+                           (url, time.ctime(cached.get("fetched", 0))))
+            return cached["data"]
+        logger.error("Error while opening %s." % url, exc_info=True)
+        return None
+    if status == 304 and cached is not None:
+        cached["fetched"] = time.time()
+        if cache_dir is not None:
+            save_cache(cache_dir, cached, logger)
+        return cached["data"]
+    if status != 200:
+        logger.error("Error while opening %s: status %s." % (url, status))
+        return None
+    try:
+        data = json.loads(body.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        logger.error("Error while parsing json from %s." % url, exc_info=True)
+        return None
+    loaded[url] = {"url": url, "fetched": time.time(), "etag": responseHeaders.get("ETag"),
+                   "lastModified": responseHeaders.get("Last-Modified"), "data": data}
+    if cache_dir is not None:
+        save_cache(cache_dir, loaded[url], logger)
+    return data
@@ -0,0 +1,65 @@
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import compression  # noqa: E402
+import debwriter  # noqa: E402
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+
+class CompressionTest(unittest.TestCase):
+    def test_check_level(self):
+        for compressor, level in [("gzip", 1), ("gzip", 9), ("xz", 0), ("xz", 9), ("zstd", 1), ("zstd", 22),
+                                  ("auto", 9), ("gzip", None)]:
+            self.assertIsNone(compression.check_level(compressor, level), "%s %s" % (compressor, level))
+        for compressor, level in [("gzip", 0), ("gzip", 12), ("xz", 10), ("xz", -1), ("zstd", 0), ("zstd", 23),
+                                  ("auto", 19)]:
+            self.assertIsNotNone(compression.check_level(compressor, level), "%s %s" % (compressor, level))
+
+    def test_dpkg_deb_compressors(self):
+        old = b"  -Z<type>  Set the compression type used when building.\n"
+        new = old + b"                Allowed types: gzip, xz, zstd, none.\n"
+        with mock.patch("compression.get_dpkg_deb_help", return_value=old):
+            self.assertFalse(compression.dpkg_deb_has_compressor("zstd"))
+            self.assertTrue(compression.dpkg_deb_has_compressor("xz"))
+            self.assertNotIn("zstd", [candidate[0] for candidate in compression.get_candidates(False)])
+        with mock.patch("compression.get_dpkg_deb_help", return_value=new):
+            self.assertTrue(compression.dpkg_deb_has_compressor("zstd"))
+            self.assertFalse(compression.dpkg_deb_has_compressor("bzip2"))
+
+    def test_roundtrip(self):
+        data = b"compressed " * 10000
+        for compressor in ["gzip", "xz", "none"]:
+            out = io.BytesIO()
+            compressed = compression.Compressor(compressor, 1, 1, out)
+            compressed.write(data)
+            compressed.close()
+            self.assertGreater(len(out.getvalue()), 0)
+
+    def test_build_deb_invalid_level(self):
+        folder = tempfile.mkdtemp()
+        try:
+            root = os.path.join(folder, "root")
+            os.makedirs(os.path.join(root, "DEBIAN"))
+            with open(os.path.join(root, "DEBIAN", "control"), "w") as file:
+                file.write("Package: a\nVersion: 1\nArchitecture: all\nMaintainer: m\nDescription: d\n")
+            logger = logging.getLogger("test_compression")
+            for compressor, level in [("gzip", 12), ("xz", 12)]:
+                with self.assertLogs(logger, logging.ERROR):
+                    self.assertFalse(debwriter.build_deb(root, os.path.join(folder, "a.deb"), logger, compressor,
+                                                         level, 1))
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import debwriter  # noqa: E402
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+control = """Package: idea-test
+Version: 2099.1.0
+Architecture: all
+Maintainer: Test <test@example.com>
+Description: Test package
+ written by the native writer and by dpkg-deb
+"""
+
+
+def has_tools():
+    return shutil.which("dpkg-deb") is not None and shutil.which("fakeroot") is not None
+
+
+def write(path, data, mode):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(data)
+    os.chmod(path, mode)
+
+
+# Staged tree like package.py builds it: executables, plain files, empty folders, absolute and relative symlinks
+def stage(root):
+    write(os.path.join(root, "DEBIAN", "control"), control, 0o644)
+    write(os.path.join(root, "DEBIAN", "postinst"), "#!/bin/sh\nexit 0\n", 0o755)
+    write(os.path.join(root, "DEBIAN", "conffiles"), "/etc/idea/idea.vmoptions.README\n", 0o644)
+    write(os.path.join(root, "etc", "idea", "idea.vmoptions.README"), "-Xmx2g\n", 0o644)
+    write(os.path.join(root, "opt", "idea", "bin", "idea.sh"), "#!/bin/sh\n", 0o755)
+    write(os.path.join(root, "opt", "idea", "bin", "idea.vmoptions"), "-Xms128m\n", 0o640)
+    write(os.path.join(root, "opt", "idea", "lib", "app.jar"), "jar" * 1000, 0o644)
+    write(os.path.join(root, "opt", "idea", "lib", "b.jar"), "", 0o644)
+    os.makedirs(os.path.join(root, "opt", "idea", "plugins", "empty"))
+    os.makedirs(os.path.join(root, "usr", "bin"))
+    os.symlink("/opt/idea/bin/idea.sh", os.path.join(root, "usr", "bin", "idea"))
+    os.symlink("app.jar", os.path.join(root, "opt", "idea", "lib", "a.jar"))
+    os.symlink("../lib", os.path.join(root, "opt", "idea", "bin", "lib"))
+    for dirpath, dirnames, filenames in os.walk(root):
+        os.chmod(dirpath, 0o755)
+
+
+def run(args):
+    return subprocess.run(args, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def get_data_tar(deb):
+    return subprocess.run(["dpkg-deb", "--fsys-tarfile", deb], check=True, stdout=subprocess.PIPE).stdout
+
+
+# dpkg-deb -I without the sizes of the package and the control archive, they depend on the compressor
+def get_info(deb):
+    return [line for line in run(["dpkg-deb", "-I", deb]).split("\n")
+            if "Debian package" not in line and "control archive" not in line]
+
+
+@unittest.skipUnless(has_tools(), "dpkg-deb and fakeroot are needed")
+class DebWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.root = os.path.join(self.folder, "root")
+        stage(self.root)
+        self.native = os.path.join(self.folder, "native.deb")
+        self.dpkg = os.path.join(self.folder, "dpkg.deb")
+        self.assertTrue(debwriter.build_deb(self.root, self.native, logging.getLogger("test_debwriter"), "xz", 6))
+        environment = dict(os.environ)
+        environment.pop("SOURCE_DATE_EPOCH", None)
+        subprocess.run(["fakeroot", "dpkg-deb", "-Zxz", "-z6", "-b", self.root, self.dpkg], check=True,
+                       stdout=subprocess.DEVNULL, env=environment)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_info(self):
+        self.assertEqual(get_info(self.native), get_info(self.dpkg))
+
+    def test_contents(self):
+        # owners, modes, sizes, times, link targets and the order of the members
+        self.assertEqual(run(["dpkg-deb", "-c", self.native]), run(["dpkg-deb", "-c", self.dpkg]))
+
+    def test_data_tar(self):
+        # the uncompressed data.tar is the same byte for byte, only the compressed size may differ
+        self.assertEqual(get_data_tar(self.native), get_data_tar(self.dpkg))
+
+    def test_symlinks_last(self):
+        names = [line.split()[5] for line in run(["dpkg-deb", "-c", self.native]).strip().split("\n")]
+        links = ["./opt/idea/bin/lib", "./opt/idea/lib/a.jar", "./usr/bin/idea"]
+        self.assertEqual(names[-len(links):], links)
+        self.assertEqual(debwriter.get_sorted_paths(self.root, ["DEBIAN"])[-len(links):],
+                         [link[2:] for link in links])
+
+    def test_fields(self):
+        for field in ["Package", "Version"]:
+            self.assertEqual(run(["dpkg-deb", "-f", self.native, field]), run(["dpkg-deb", "-f", self.dpkg, field]))
+
+
+if __name__ == "__main__":
+    unittest.main()
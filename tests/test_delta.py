@@ -0,0 +1,159 @@
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cache  # noqa: E402
+import compression  # noqa: E402
+import debwriter  # noqa: E402
+import delta  # noqa: E402
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+control = """Package: idea-test
+Version: %s
+Architecture: all
+Maintainer: Test <test@example.com>
+Description: Test package
+ for deltas
+"""
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def has_tools():
+    return shutil.which("dpkg-deb") is not None and shutil.which("fakeroot") is not None
+
+
+# Builds a package of version with files {path: data}, compressed by the lzma module (xz with one thread),
+# or by dpkg-deb with compressor
+def build(folder, version, files, compressor=None):
+    root = os.path.join(folder, "root-%s" % version)
+    write(os.path.join(root, "DEBIAN", "control"), (control % version).encode('ascii'))
+    for path, data in files.items():
+        write(os.path.join(root, path), data)
+    deb = os.path.join(folder, "idea-test-%s.deb" % version)
+    if compressor is not None:
+        subprocess.run(["fakeroot", "dpkg-deb", "-Z%s" % compressor, "-b", root, deb], check=True,
+                       stdout=subprocess.DEVNULL)
+    elif not debwriter.build_deb(root, deb, logging.getLogger("test_delta"), "xz", 6, 1):
+        raise OSError("Could not build %s" % deb)
+    return deb
+
+
+# Replaces delta.json in the container delta with change(info)
+def change_info(path, change):
+    with tarfile.open(path, mode="r:") as container:
+        members = [(member, container.extractfile(member).read()) for member in container]
+    with tarfile.open(path, mode="w:", format=tarfile.GNU_FORMAT) as container:
+        for member, data in members:
+            if member.name == "delta.json":
+                data = json.dumps(change(json.loads(data.decode('utf-8')))).encode('utf-8')
+                member.size = len(data)
+            container.addfile(member, io.BytesIO(data))
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.logger = logging.getLogger("test_delta")
+        same = bytes(range(256)) * 400
+        self.old = build(self.folder, "1.0", {"opt/idea/lib/same.jar": same, "opt/idea/lib/changed.jar": b"a" * 9000,
+                                              "opt/idea/build.txt": b"1.0\n"})
+        self.new = build(self.folder, "1.1", {"opt/idea/lib/same.jar": same, "opt/idea/lib/changed.jar": b"b" * 9000,
+                                              "opt/idea/lib/new.jar": os.urandom(5000), "opt/idea/build.txt": b"1.1\n"})
+        self.delta = os.path.join(self.folder, "idea-test-1.0_1.1.delta")
+        self.dest = os.path.join(self.folder, "rebuilt.deb")
+        self.assertIsNotNone(delta.create(self.old, self.new, self.delta, self.logger, 6, 1, native=True))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_apply(self):
+        self.assertEqual(delta.apply(self.old, self.delta, self.dest, self.logger), self.dest)
+        self.assertEqual(cache.hash_file(self.dest), cache.hash_file(self.new))
+
+    def test_other_compressor(self):
+        # a compressor that writes other bytes for the same data, like another version of xz would
+        original = compression.Compressor
+
+        def create(compressor, level, threads, out):
+            return original(compressor, 1, threads, out)
+
+        with mock.patch("compression.Compressor", side_effect=create), \
+                self.assertLogs(self.logger, logging.ERROR) as logs:
+            self.assertIsNone(delta.apply(self.old, self.delta, self.dest, self.logger))
+        self.assertIn("Its content is right", "\n".join(logs.output))
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(self.dest + ".tmp"))
+
+    def test_other_version(self):
+        change_info(self.delta, lambda info: dict(info, compressorVersion="liblzma 0.0.1"))
+        with self.assertLogs(self.logger, logging.WARNING) as logs:
+            self.assertEqual(delta.apply(self.old, self.delta, self.dest, self.logger), self.dest)
+        self.assertIn("liblzma 0.0.1", "\n".join(logs.output))
+
+    def test_corrupt(self):
+        change_info(self.delta, lambda info: dict(info, new=dict(info["new"], data="0" * 64)))
+        with self.assertLogs(self.logger, logging.ERROR) as logs:
+            self.assertIsNone(delta.apply(self.old, self.delta, self.dest, self.logger))
+        self.assertIn("is corrupt", "\n".join(logs.output))
+        self.assertNotIn("content is right", "\n".join(logs.output))
+
+    def test_wrong_old(self):
+        with self.assertLogs(self.logger, logging.ERROR):
+            self.assertIsNone(delta.apply(self.new, self.delta, self.dest, self.logger))
+
+
+@unittest.skipUnless(has_tools(), "dpkg-deb and fakeroot are needed")
+class DpkgDebDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.logger = logging.getLogger("test_delta")
+        self.delta = os.path.join(self.folder, "idea-test-1.0_1.1.delta")
+        self.dest = os.path.join(self.folder, "rebuilt.deb")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def build(self, compressor):
+        same = bytes(range(256)) * 400
+        old = build(self.folder, "1.0", {"opt/idea/lib/same.jar": same, "opt/idea/build.txt": b"1.0\n"}, compressor)
+        new = build(self.folder, "1.1", {"opt/idea/lib/same.jar": same, "opt/idea/lib/new.jar": os.urandom(5000),
+                                         "opt/idea/build.txt": b"1.1\n"}, compressor)
+        return old, new
+
+    def test_apply(self):
+        for compressor in ["xz", "gzip"]:
+            old, new = self.build(compressor)
+            self.assertIsNotNone(delta.create(old, new, self.delta, self.logger))
+            self.assertEqual(delta.apply(old, self.delta, self.dest, self.logger), self.dest, compressor)
+            self.assertEqual(cache.hash_file(self.dest), cache.hash_file(new), compressor)
+            os.remove(self.dest)
+
+    @unittest.skipUnless(shutil.which("zstd") is not None, "zstd is needed")
+    def test_zstd(self):
+        # dpkg-deb compresses with libzstd, the zstd command line tool writes other bytes
+        old, new = self.build("zstd")
+        with self.assertLogs(self.logger, logging.ERROR) as logs:
+            self.assertIsNone(delta.create(old, new, self.delta, self.logger))
+        self.assertIn("--native", "\n".join(logs.output))
+        self.assertFalse(os.path.exists(self.delta))
+
+
+if __name__ == "__main__":
+    unittest.main()
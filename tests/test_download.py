@@ -0,0 +1,184 @@
+import hashlib
+import http.server
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench"))
+
+import download  # noqa: E402
+import server  # noqa: E402
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+archiveName = "ideaIU-2099.1.0.tar.gz"
+archiveSize = 400 * 1024
+segmentSize = 64 * 1024
+
+
+# Records the Range header of every request and ignores it if ranges is False
+class RecordingHandler(server.Handler):
+    ranges = True
+    requests = []
+
+    def answer_file(self, path, send_body):
+        self.requests.append(self.headers.get("Range"))
+        if not self.ranges:
+            del self.headers["Range"]
+        server.Handler.answer_file(self, path, send_body)
+
+    def send_header(self, keyword, value):
+        if keyword != "Accept-Ranges" or self.ranges:
+            server.Handler.send_header(self, keyword, value)
+
+
+# Sends only the first half of every requested range, with a Content-Range that matches what is sent
+class ShortHandler(RecordingHandler):
+    def answer_file(self, path, send_body):
+        if self.headers.get("Range") is None:
+            RecordingHandler.answer_file(self, path, send_body)
+            return
+        self.requests.append(self.headers.get("Range"))
+        start, end = [int(value) for value in self.headers["Range"][len("bytes="):].split("-")]
+        end = start + (end - start) // 2
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, os.path.getsize(path)))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if send_body:
+            with open(path, "rb") as file:
+                file.seek(start)
+                self.wfile.write(file.read(end - start + 1))
+
+
+# Answers with a range that starts somewhere else than requested
+class MismatchHandler(RecordingHandler):
+    def answer_file(self, path, send_body):
+        if self.headers.get("Range") is not None:
+            self.headers.replace_header("Range", "bytes=0-%d" % (segmentSize - 1))
+        RecordingHandler.answer_file(self, path, send_body)
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.data = os.urandom(archiveSize)
+        with open(os.path.join(self.folder, archiveName), "wb") as file:
+            file.write(self.data)
+        self.dest = os.path.join(self.folder, "download")
+        self.logger = logging.getLogger("test_download")
+        self.servers = []
+
+    def tearDown(self):
+        for running in self.servers:
+            running.shutdown()
+            running.server_close()
+        shutil.rmtree(self.folder)
+
+    def get_handler(self, handler, ranges, requests):
+        return type("TestHandler", (handler,), {"folder": self.folder, "bandwidth": 0, "latency": 0.0,
+                                                "checksums": {}, "ranges": ranges, "requests": requests})
+
+    # Starts a bench server with handler on a free port, returns the link of the archive and the recorded requests
+    def serve(self, handler=RecordingHandler, ranges=True):
+        requests = []
+        running = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self.get_handler(handler, ranges, requests))
+        threading.Thread(target=running.serve_forever, daemon=True).start()
+        self.servers.append(running)
+        return "http://127.0.0.1:%d/%s" % (running.server_address[1], archiveName), requests
+
+    def read_dest(self):
+        with open(self.dest, "rb") as file:
+            return file.read()
+
+    def test_download(self):
+        link, requests = self.serve()
+        self.assertTrue(download.ranged_download(link, self.dest, self.logger, 4, segmentSize))
+        self.assertEqual(self.read_dest(), self.data)
+        self.assertEqual(len([value for value in requests if value is not None]), archiveSize // segmentSize + 1)
+        self.assertFalse(os.path.exists(download.get_state_path(self.dest)))
+
+    def test_checksum(self):
+        link, requests = self.serve()
+        hasher = hashlib.sha256()
+        self.assertTrue(download.ranged_download(link, self.dest, self.logger, 4, segmentSize, hasher=hasher))
+        self.assertEqual(hasher.hexdigest(), hashlib.sha256(self.data).hexdigest())
+
+    def test_resume(self):
+        link, requests = self.serve()
+        # the first two segments and half of the third one were written before the download was interrupted
+        done = 2 * segmentSize + segmentSize // 2
+        with open(self.dest, "wb") as file:
+            file.write(self.data[:done] + bytes(archiveSize - done))
+        state = download.load_state(self.dest, link, archiveSize, segmentSize)
+        state["segments"][0][2] = segmentSize
+        state["segments"][1][2] = segmentSize
+        state["segments"][2][2] = segmentSize // 2
+        with open(download.get_state_path(self.dest), "w") as file:
+            json.dump(state, file)
+
+        hasher = hashlib.sha256()
+        self.assertTrue(download.ranged_download(link, self.dest, self.logger, 4, segmentSize, hasher=hasher))
+        self.assertEqual(self.read_dest(), self.data)
+        self.assertEqual(hasher.hexdigest(), hashlib.sha256(self.data).hexdigest())
+        ranges = [value for value in requests if value is not None]
+        self.assertIn("bytes=%d-%d" % (done, 3 * segmentSize - 1), ranges)
+        self.assertFalse(any(value.startswith("bytes=0-") or value.startswith("bytes=%d-" % segmentSize)
+                             for value in ranges))
+        self.assertFalse(os.path.exists(download.get_state_path(self.dest)))
+
+    def test_state_of_other_link(self):
+        link, requests = self.serve()
+        with open(self.dest, "wb") as file:
+            file.write(bytes(archiveSize))
+        state = download.load_state(self.dest, link + "?other", archiveSize, segmentSize)
+        for segment in state["segments"]:
+            segment[2] = segment[1] - segment[0] + 1
+        with open(download.get_state_path(self.dest), "w") as file:
+            json.dump(state, file)
+        self.assertTrue(download.ranged_download(link, self.dest, self.logger, 4, segmentSize))
+        self.assertEqual(self.read_dest(), self.data)
+
+    def test_no_ranges(self):
+        link, requests = self.serve(ranges=False)
+        with open(download.get_state_path(self.dest), "w") as file:
+            file.write("{}")
+        with mock.patch("download.single_download", wraps=download.single_download) as single:
+            self.assertTrue(download.ranged_download(link, self.dest, self.logger, 4, segmentSize))
+        single.assert_called_once()
+        self.assertEqual(self.read_dest(), self.data)
+        self.assertFalse(os.path.exists(download.get_state_path(self.dest)))
+
+    def test_short_range(self):
+        link, requests = self.serve(ShortHandler)
+        self.assertFalse(download.ranged_download(link, self.dest, self.logger, 4, segmentSize))
+        # what was received is kept, the next run with a working server completes it
+        with open(download.get_state_path(self.dest), "r") as file:
+            state = json.load(file)
+        self.assertGreater(state["segments"][0][2], 0)
+        self.assertTrue(all(segment[2] <= segment[1] - segment[0] for segment in state["segments"]))
+        requests = []
+        self.servers[0].RequestHandlerClass = self.get_handler(RecordingHandler, True, requests)
+        self.assertTrue(download.ranged_download(link, self.dest, self.logger, 4, segmentSize))
+        self.assertEqual(self.read_dest(), self.data)
+        self.assertTrue(all(not value.startswith("bytes=0-") for value in requests if value is not None))
+
+    def test_mismatched_range(self):
+        link, requests = self.serve(MismatchHandler)
+        self.assertFalse(download.ranged_download(link, self.dest, self.logger, 4, segmentSize))
+        with open(download.get_state_path(self.dest), "r") as file:
+            state = json.load(file)
+        # only the first segment got the range it asked for
+        self.assertEqual([segment[2] for segment in state["segments"]][1:], [0] * (len(state["segments"]) - 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
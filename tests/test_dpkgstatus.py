@@ -0,0 +1,105 @@
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dpkgstatus  # noqa: E402
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+# (a, b, sign of the comparison) as dpkg --compare-versions answers it
+versions = [
+    # ~ sorts before everything, even the end of the version
+    ("1.0~rc1", "1.0", -1),
+    ("1.0~", "1.0", -1),
+    ("1.0~~", "1.0~", -1),
+    ("1.0~~a", "1.0~~", 1),
+    ("1.0-1~bpo1", "1.0-1", -1),
+    # epochs
+    ("1:1.0", "2.0", 1),
+    ("0:1.0", "1.0", 0),
+    ("1:1.0", "1:1.1", -1),
+    ("2:0.1", "1:9.9", 1),
+    # a missing revision is the same as 0 and older than any other
+    ("1.0", "1.0-0", 0),
+    ("1.0", "1.0-1", -1),
+    ("1.0-1ubuntu1", "1.0-1", 1),
+    ("1.2-3-4", "1.2-3-5", -1),
+    # letters sort before everything else but ~, in ASCII order
+    ("1.0a", "1.0+", -1),
+    ("1.0a", "1.0.", -1),
+    ("1.0+", "1.0.", -1),
+    ("1.0a", "1.0", 1),
+    ("1.0-a", "1.0-B", 1),
+    ("a", "b", -1),
+    # numbers are compared as numbers
+    ("1.0", "1.0.0", -1),
+    ("2099.1.0", "2099.1", 1),
+    ("2023.10", "2023.9", 1),
+    ("1.001", "1.1", 0),
+    ("2024.1.2", "2024.1.2", 0),
+]
+
+status = """Package: idea-professional
+Status: install ok installed
+Version: 2024.1.2
+Description: installed
+ Version: 1.0 is a continuation line, not a field
+
+Package: pycharm-community
+Status: deinstall ok config-files
+Version: 2023.3
+
+Package: no-status
+Version: 1.0
+
+Package: no-version
+Status: install ok installed
+
+Package: idea-community
+Version: 1:2023.3-1
+Status: hold ok installed"""
+
+
+def sign(value):
+    return (value > 0) - (value < 0)
+
+
+class DpkgStatusTest(unittest.TestCase):
+    def test_compare_versions(self):
+        for a, b, expected in versions:
+            self.assertEqual(sign(dpkgstatus.compare_versions(a, b)), expected, "%s %s" % (a, b))
+            self.assertEqual(sign(dpkgstatus.compare_versions(b, a)), -expected, "%s %s" % (b, a))
+
+    @unittest.skipUnless(shutil.which("dpkg") is not None, "dpkg is needed")
+    def test_table_against_dpkg(self):
+        for a, b, expected in versions:
+            for operator, result in [("lt", -1), ("eq", 0), ("gt", 1)]:
+                answer = subprocess.run(["dpkg", "--compare-versions", a, operator, b]).returncode == 0
+                self.assertEqual(answer, expected == result, "%s %s %s" % (a, operator, b))
+
+    def test_get_installed(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, "status")
+            with open(path, "w") as file:
+                file.write(status)
+            self.assertEqual(dpkgstatus.get_installed(logging.getLogger("test_dpkgstatus"), path),
+                             {"idea-professional": "2024.1.2", "idea-community": "1:2023.3-1"})
+        finally:
+            shutil.rmtree(folder)
+
+    def test_get_installed_missing(self):
+        logger = logging.getLogger("test_dpkgstatus")
+        with self.assertLogs(logger, logging.ERROR):
+            self.assertIsNone(dpkgstatus.get_installed(logger, "/nonexistent/status"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import hashlib
+import io
+import logging
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import extract  # noqa: E402
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+
+# Files of random bytes, the compressed archive is about as large as its content
+def get_archive(count=50):
+    generator = random.Random(count)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for index in range(count):
+            data = b"file %d " % index + generator.randbytes(20000)
+            info = tarfile.TarInfo("ide-1.0/lib/file%d" % index)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+# Returns the data up to limit, raises zlib.error after that like a corrupt gzip stream in the decompressor
+class CorruptReader(object):
+    def __init__(self, data, limit):
+        self.data = io.BytesIO(data)
+        self.limit = limit
+
+    def read(self, size=-1):
+        if self.data.tell() >= self.limit:
+            raise zlib.error("Error -3 while decompressing data: invalid distance too far back")
+        return self.data.read(size)
+
+
+class ExtractTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.logger = logging.getLogger("test_extract")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_extract(self):
+        recorded = {}
+        self.assertTrue(extract.extract_stream(io.BytesIO(get_archive()), self.folder, self.logger, threads=4,
+                                               record=lambda name, digest, size: recorded.update({name: digest})))
+        with open(os.path.join(self.folder, "lib", "file7"), "rb") as file:
+            data = file.read()
+        self.assertTrue(data.startswith(b"file 7 "))
+        self.assertEqual(len(data), len(b"file 7 ") + 20000)
+        self.assertEqual(recorded["lib/file7"], hashlib.md5(data).hexdigest())
+
+    def test_truncated(self):
+        data = get_archive()
+        with self.assertLogs(self.logger, logging.ERROR):
+            self.assertFalse(extract.extract_stream(io.BytesIO(data[:len(data) // 2]), self.folder, self.logger))
+
+    def test_corrupt(self):
+        data = get_archive()
+        with self.assertLogs(self.logger, logging.ERROR):
+            self.assertFalse(extract.extract_stream(CorruptReader(data, len(data) // 2), self.folder, self.logger,
+                                                    threads=4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import io
+import logging
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import extract  # noqa: E402
+import prune  # noqa: E402
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+
+def add(tar, name, kind=tarfile.REGTYPE, data=b"", linkname=""):
+    info = tarfile.TarInfo(name)
+    info.type = kind
+    info.linkname = linkname
+    info.size = len(data)
+    info.mode = 0o755 if kind == tarfile.DIRTYPE else 0o644
+    tar.addfile(info, io.BytesIO(data) if kind == tarfile.REGTYPE else None)
+
+
+def get_archive():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        add(tar, "idea-1.0/bin", tarfile.DIRTYPE)
+        add(tar, "idea-1.0/bin/idea.sh", data=b"#!/bin/sh\n")
+        add(tar, "idea-1.0/plugins/android", tarfile.DIRTYPE)
+        add(tar, "idea-1.0/plugins/android/lib", tarfile.DIRTYPE)
+        add(tar, "idea-1.0/plugins/android/lib/android.jar", data=b"a" * 1000)
+        add(tar, "idea-1.0/plugins/android/lib/empty.jar")
+        add(tar, "idea-1.0/plugins/android/lib/current.jar", tarfile.SYMTYPE, linkname="android.jar")
+        add(tar, "idea-1.0/plugins/android/lib/copy.jar", tarfile.LNKTYPE,
+            linkname="idea-1.0/plugins/android/lib/android.jar")
+        add(tar, "idea-1.0/lib/app.jar", data=b"b" * 500)
+        add(tar, "idea-1.0/lib/android.jar", tarfile.LNKTYPE, linkname="idea-1.0/plugins/android/lib/android.jar")
+        add(tar, "idea-1.0/lib/app.log", data=b"c" * 20)
+    return buffer.getvalue()
+
+
+class PruneTest(unittest.TestCase):
+    def test_is_excluded(self):
+        profile = prune.Profile("test", ["lib/*.log", "**/test"], ["android"])
+        self.assertTrue(profile.is_excluded("plugins/android"))
+        self.assertTrue(profile.is_excluded("plugins/android/lib/android.jar"))
+        self.assertTrue(profile.is_excluded("lib/app.log"))
+        self.assertTrue(profile.is_excluded("a/b/test/c"))
+        self.assertFalse(profile.is_excluded("lib/sub/app.log"))
+        self.assertFalse(profile.is_excluded("plugins/android-ndk"))
+
+    def test_counts_regular_files(self):
+        folder = tempfile.mkdtemp()
+        try:
+            profile = prune.Profile("test", ["lib/*.log"], ["android"])
+            self.assertTrue(extract.extract_stream(io.BytesIO(get_archive()), folder,
+                                                   logging.getLogger("test_prune"), exclude=profile.exclude))
+            # android.jar, empty.jar and app.log, not the folders, the symlink and the hardlinks
+            self.assertEqual(profile.files, 3)
+            self.assertEqual(profile.bytes, 1020)
+            self.assertEqual(sorted(os.listdir(os.path.join(folder, "lib"))), ["app.jar"])
+            self.assertFalse(os.path.exists(os.path.join(folder, "plugins", "android")))
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    unittest.main()
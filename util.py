@@ -1,11 +1,17 @@
+import errno
+import fcntl
 import os
 import shutil
 import subprocess
 import sys
+import threading
+import time
 
 __author__ = 'Andreas Bader'
 __version__ = "0.02"
 
+FICLONE = 0x40049409
+
 
 def check_file_readable(filename):
     if check_file_exists(filename) and os.access(filename, os.R_OK):
@@ -64,24 +70,88 @@ def delete_file(path, logger, no_error=False):
         return False
 
 
-def copy_folder(path1, path2, logger):
+# Reflink (FICLONE) clone of path1, only works on filesystems with copy-on-write support (btrfs, xfs, ...)
+def clone_file(path1, path2):
+    with open(path1, "rb") as file1, open(path2, "wb") as file2:
+        fcntl.ioctl(file2.fileno(), FICLONE, file1.fileno())
+
+
+# In-kernel copy without passing the data through user space
+def copy_file_range(path1, path2):
+    with open(path1, "rb") as file1, open(path2, "wb") as file2:
+        size = os.fstat(file1.fileno()).st_size
+        copied = 0
+        while copied < size:
+            count = os.copy_file_range(file1.fileno(), file2.fileno(), size - copied)
+            if count == 0:
+                break
+            copied += count
+
+
+def link_file(path1, path2):
+    if os.path.lexists(path2):
+        os.remove(path2)
+    os.link(path1, path2)
+
+
+# Copies path1 to path2 with the cheapest method available: reflink, copy_file_range and a plain copy as last
+# resort. If link is True a hardlink is tried before copy_file_range, path2 then shares its data and metadata
+# with path1 and must not be modified in place.
+def fast_copy(path1, path2, link=False):
+    methods = [clone_file, copy_file_range]
+    if link:
+        methods = [clone_file, link_file, copy_file_range]
+    for method in methods:
+        try:
+            method(path1, path2)
+            return path2
+        except (AttributeError, OSError):
+            pass
+    shutil.copyfile(path1, path2)
+    return path2
+
+
+def copy_folder(path1, path2, logger, link=False, symlinks=False):
     try:
-        shutil.copytree(path1, path2, symlinks=False, ignore=None)
+        shutil.copytree(path1, path2, symlinks=symlinks, ignore=None,
+                        copy_function=lambda src, dst: shutil.copystat(src, fast_copy(src, dst, link)))
     except OSError:
         logger.error('Failed to copy %s to %s.' % (path1, path2), exc_info=True)
         return False
     return True
 
 
-def copy_file(path1, path2, logger):
+def copy_file(path1, path2, logger, link=False):
     try:
-        shutil.copyfile(path1, path2)
+        fast_copy(path1, path2, link)
     except OSError:
         logger.error('Failed to copy %s to %s.' % (path1, path2), exc_info=True)
         return False
     return True
 
 
+# Moves path1 to path2, path2 is replaced atomically: it either is the old or the complete new file.
+# Between filesystems the file is copied next to path2 first and renamed afterwards.
+def move_file(path1, path2, logger):
+    try:
+        os.replace(path1, path2)
+        return True
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            logger.error('Failed to move %s to %s.' % (path1, path2), exc_info=True)
+            return False
+    tmp = os.path.join(os.path.dirname(path2), ".%s.%s.part" % (os.path.basename(path2), get_tmp_suffix()))
+    try:
+        fast_copy(path1, tmp)
+        os.replace(tmp, path2)
+        os.remove(path1)
+    except OSError:
+        logger.error('Failed to move %s to %s.' % (path1, path2), exc_info=True)
+        delete_file(tmp, logger, True)
+        return False
+    return True
+
+
 def clean_space(line):
     string = line
     while string[0] == ' ':
@@ -143,9 +213,31 @@ def get_script_path():
     return os.path.dirname(os.path.realpath(__file__))
 
 
+# Lock for module state that build processes forked from a batch or watch process use as well. Another thread may
+# hold the lock while the process is forked, the child gets a new one.
+class ForkSafeLock:
+    def __init__(self):
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.lock.release()
+
+
+# Unique for every process and thread, for temporary files next to their target
+def get_tmp_suffix():
+    return "%d.%d" % (os.getpid(), threading.get_ident())
+
+
 def cmd_exists(cmd):
-    return subprocess.call("type " + cmd, shell=True,
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
+    return shutil.which(cmd) is not None
 
 
 def run_cmd(cmd, logger, return_output=False, no_error=False):
@@ -162,15 +254,44 @@ def run_cmd(cmd, logger, return_output=False, no_error=False):
         else:
             return None
 
+def format_size(size):
+    for unit in ["B", "KiB", "MiB"]:
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f GiB" % size
+
+
+# State of the running download for progress_hook
+progressState = {}
+
+
+# reporthook in urlretrieve's format, prints a bar with rate and ETA. If totalsize is unknown (<= 0) only the
+# downloaded size and the rate are printed.
 def progress_hook(blocknum, blocksize, totalsize):
-    max_blocks = round(totalsize/blocksize)
-    act_percent = 0
-    if blocknum != 0:
-        act_percent = float(blocknum)/max_blocks*100.0
-    full_str=""
-    empty_str=""
-    for i in range(1,round(act_percent),10):
-        full_str+="#"
-    empty_str+=" "*(10-len(full_str))
-    sys.stdout.write("\rDownloading [%s%s] %d%%" % (full_str,empty_str,act_percent))
-    sys.stdout.flush()
\ No newline at end of file
+    done = blocknum * blocksize
+    if totalsize > 0:
+        done = min(done, totalsize)
+    now = time.monotonic()
+    if "start" not in progressState.keys() or done < progressState["done"]:
+        # a new download (or the first call of a resumed one)
+        progressState.update({"start": now, "startDone": done, "printed": 0})
+    progressState["done"] = done
+    finished = totalsize > 0 and done >= totalsize
+    if now - progressState["printed"] < 0.1 and not finished:
+        return
+    progressState["printed"] = now
+    elapsed = now - progressState["start"]
+    rate = 0
+    if elapsed > 0:
+        rate = (done - progressState["startDone"]) / elapsed
+    if totalsize > 0:
+        percent = done * 100.0 / totalsize
+        eta = "--:--"
+        if rate > 0:
+            eta = "%d:%02d" % divmod(int((totalsize - done) / rate), 60)
+        line = "Downloading [%-10s] %3d%% %s/s ETA %s" % ("#" * int(percent / 10), percent, format_size(rate), eta)
+    else:
+        line = "Downloading %s %s/s" % (format_size(done), format_size(rate))
+    sys.stdout.write("\r%-60s" % line)
+    sys.stdout.flush()
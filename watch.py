@@ -0,0 +1,178 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import signal
+import sys
+import time
+
+import dpkgstatus
+import util
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+defaultInterval = 3600  # seconds between two polls
+defaultDebounce = 300   # a new version has to be seen that long before it is built
+
+
+def get_state_path(cache_dir):
+    return os.path.join(cache_dir, "watch-state.json")
+
+
+def get_key(job):
+    return "%s-%s-%s" % job
+
+
+def load_state(cache_dir):
+    try:
+        with open(get_state_path(cache_dir), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(cache_dir, state, logger):
+    if not util.check_folder(cache_dir, logger, False, True):
+        if not util.create_folder(cache_dir):
+            logger.warning("%s does not exist and can not be created." % cache_dir)
+            return
+    try:
+        with open(get_state_path(cache_dir) + ".tmp", "w") as file:
+            json.dump(state, file, indent=1, sort_keys=True)
+        os.replace(get_state_path(cache_dir) + ".tmp", get_state_path(cache_dir))
+    except OSError:
+        logger.warning("Could not write %s." % get_state_path(cache_dir), exc_info=True)
+
+
+class Watcher(object):
+    # get_versions(): returns {job: version or None}, called in a thread, may block
+    # get_package_name(ide, edition): name of the package in dpkg's status file
+    # build(ide, edition, java): builds the job in a process of a pool, returns the path of the package or raises an
+    #                            exception. It has to be picklable (e.g. a functools.partial of a module function).
+    def __init__(self, jobs, get_versions, get_package_name, build, cache_dir, interval, debounce, concurrency,
+                 logger):
+        self.jobs = jobs
+        self.get_versions = get_versions
+        self.get_package_name = get_package_name
+        self.build_job = build
+        self.cacheDir = cache_dir
+        self.interval = interval
+        self.debounce = debounce
+        self.logger = logger
+        self.state = load_state(cache_dir)
+        self.running = {}
+        self.concurrency = concurrency
+        self.semaphore = None
+        self.stop = None
+        self.executor = None
+
+    # Jobs without state start with the installed version, so nothing is built that is installed already
+    def init_state(self):
+        installed = None
+        for job in self.jobs:
+            if get_key(job) in self.state.keys():
+                continue
+            if installed is None:
+                installed = dpkgstatus.get_installed(self.logger) or {}
+            packageName = self.get_package_name(job[0], job[1])
+            self.state[get_key(job)] = {"built": installed.get(packageName), "seen": None, "since": None}
+
+    async def build(self, job, version):
+        ide, edition, java = job
+        async with self.semaphore:
+            print("Building %s %s (java: %s) %s." % (ide, edition, java, version))
+            sys.stdout.flush()
+            start = time.monotonic()
+            try:
+                package = await asyncio.get_running_loop().run_in_executor(self.executor, self.build_job, ide,
+                                                                           edition, java)
+                error = None
+            except concurrent.futures.process.BrokenProcessPool as exception:
+                # a build process died, the pool can not be used anymore
+                error = exception
+                self.executor.shutdown(wait=False)
+                self.executor = get_executor(self.concurrency)
+            except Exception as exception:
+                error = exception
+        if error is None:
+            self.state[get_key(job)]["built"] = version
+            save_state(self.cacheDir, self.state, self.logger)
+            print("Finished %s %s (java: %s) %s in %.1fs: %s" %
+                  (ide, edition, java, version, time.monotonic() - start, package))
+        else:
+            # seen again with the next poll, so the build is retried after the debounce time
+            self.state[get_key(job)]["since"] = time.time()
+            self.logger.error("Building %s %s (java: %s) %s failed: %s" %
+                              (ide, edition, java, version, str(error) or error.__class__.__name__))
+        sys.stdout.flush()
+        del self.running[get_key(job)]
+
+    # Returns the seconds until the next poll
+    async def poll(self):
+        try:
+            versions = await asyncio.get_running_loop().run_in_executor(None, self.get_versions)
+        except Exception:
+            self.logger.error("Error while polling for new versions.", exc_info=True)
+            return self.interval
+        wait = self.interval
+        now = time.time()
+        for job in self.jobs:
+            version = versions.get(job)
+            entry = self.state[get_key(job)]
+            if version is None or get_key(job) in self.running.keys():
+                continue
+            if entry["built"] is not None and dpkgstatus.compare_versions(version, entry["built"]) <= 0:
+                entry["seen"] = None
+                entry["since"] = None
+                continue
+            if entry["seen"] != version:
+                print("New version %s of %s %s (java: %s) seen." % ((version,) + job))
+                entry["seen"] = version
+                entry["since"] = now
+            remaining = entry["since"] + self.debounce - now
+            if remaining > 0:
+                wait = min(wait, remaining)
+                continue
+            self.running[get_key(job)] = asyncio.ensure_future(self.build(job, version))
+        save_state(self.cacheDir, self.state, self.logger)
+        sys.stdout.flush()
+        return wait
+
+    async def run(self):
+        self.semaphore = asyncio.Semaphore(max(1, self.concurrency))
+        self.executor = get_executor(self.concurrency)
+        self.stop = asyncio.Event()
+        self.init_state()
+        loop = asyncio.get_running_loop()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, self.stop.set)
+        while not self.stop.is_set():
+            wait = await self.poll()
+            try:
+                await asyncio.wait_for(self.stop.wait(), timeout=max(1, wait))
+            except asyncio.TimeoutError:
+                pass
+        # running builds are finished, they are not interrupted
+        if len(self.running) > 0:
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+        self.executor.shutdown()
+        save_state(self.cacheDir, self.state, self.logger)
+
+
+# Build processes ignore SIGINT/SIGTERM, the watch process lets running builds finish when it gets them
+def ignore_signals():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+# Builds run in processes, unpacking and packaging is mostly Python code and would wait for each other in threads
+def get_executor(concurrency):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max(1, concurrency), initializer=ignore_signals)
+
+
+def watch(jobs, get_versions, get_package_name, build, cache_dir, interval, debounce, concurrency, logger):
+    watcher = Watcher(jobs, get_versions, get_package_name, build, cache_dir, interval, debounce, concurrency,
+                      logger)
+    asyncio.run(watcher.run())
+    return 0
@@ -0,0 +1,111 @@
+import itertools
+import os
+import shutil
+import threading
+
+import util
+
+__author__ = 'Andreas Bader'
+__version__ = '0.02'
+
+unpackRatio = 2.5  # unpacked size of an IDE per byte of its .tar.gz, a bit more than the IDEs need
+minFree = 256 * 1024 * 1024  # bytes that are left free besides the estimate
+suffix = ".deleting"
+
+lock = util.ForkSafeLock()
+deleting = set()  # folders this process is deleting at the moment
+counter = itertools.count()  # the same thread may remove the same path again before the first one is deleted
+
+
+# Free bytes of the file system of path, path does not need to exist yet
+def get_free(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+# Bytes a build needs in its workspace: the unpacked IDE and the package, the archive as well if it is downloaded
+# into the workspace. size is the size of the archive (the Content-Length).
+def get_needed(size, archive=True):
+    return int(size * unpackRatio) + size + (size if archive else 0)
+
+
+# Returns False if there are less than needed bytes (and minFree) free at path
+def check_space(path, needed, logger):
+    try:
+        free = get_free(path)
+    except OSError:
+        logger.warning("Could not get the free space of %s." % path, exc_info=True)
+        return True
+    if free < needed + minFree:
+        logger.error("Not enough free space in %s: %s needed, %s free." % (path, util.format_size(needed + minFree),
+                                                                           util.format_size(free)))
+        return False
+    return True
+
+
+def remove_parent(path):
+    try:
+        # only succeeds if nothing else uses the parent at the moment
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+
+def delete(path, logger, removeParent):
+    try:
+        shutil.rmtree(path)
+    except OSError:
+        # another process may clean up the same leftovers
+        if os.path.lexists(path):
+            logger.warning("Failed to delete %s." % path, exc_info=True)
+    finally:
+        with lock:
+            deleting.discard(path)
+    if removeParent:
+        remove_parent(path)
+
+
+def start_delete(path, logger, removeParent=False):
+    with lock:
+        deleting.add(path)
+    # not a daemon thread: Python waits for it before the process (or a build process of a batch) exits
+    threading.Thread(target=delete, args=(path, logger, removeParent), name="delete %s" % path).start()
+
+
+# Removes the folder path without waiting for it: it is renamed (so path can be used again right away) and
+# deleted by a background thread. The process exits after the thread is done. removeParent also removes the
+# folder above path if it is empty afterwards. Returns False if path can not be removed.
+def remove(path, logger, removeParent=False):
+    if not os.path.lexists(path):
+        return True
+    stale = os.path.join(os.path.dirname(path), ".%s.%s.%d%s" % (os.path.basename(path), util.get_tmp_suffix(),
+                                                                  next(counter), suffix))
+    try:
+        os.rename(path, stale)
+    except OSError:
+        # e.g. path is a mount point, it is deleted right away then
+        logger.warning("Could not rename %s, deleting it now." % path, exc_info=True)
+        if not util.delete_folder(path, logger, True):
+            return False
+        if removeParent:
+            remove_parent(path)
+        return True
+    start_delete(stale, logger, removeParent)
+    return True
+
+
+# Deletes what interrupted runs left in folder, in the background like remove()
+def clean_stale(folder, logger):
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(folder, name)
+        with lock:
+            if not name.startswith(".") or not name.endswith(suffix) or path in deleting:
+                continue
+        logger.info("Deleting %s left by an interrupted run." % path)
+        start_delete(path, logger)